@@ -11,11 +11,107 @@
 # WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
-
+from __future__ import with_statement
+from threading import Lock
 import simplejson
 import base64
 import re
 
+class NetlocTable:
+    """
+    Interns netloc strings as small integer IDs, so that a set of location
+    hints can be stored as a bitmask in which bit i is set if the object is
+    held at the netloc with ID i. IDs are local to the process and never
+    appear in a serialized reference: as_tuple() always emits netloc strings.
+    On the master, the worker pool registers each worker as it joins.
+    """
+
+    # Bound on the number of decoded masks that we keep.
+    MAX_CACHED_MASKS = 65536
+
+    def __init__(self):
+        self.ids = {}
+        self.netlocs = []
+        self.decoded = {0 : frozenset()}
+        self._lock = Lock()
+
+    def get_id(self, netloc):
+        try:
+            return self.ids[netloc]
+        except KeyError:
+            with self._lock:
+                try:
+                    return self.ids[netloc]
+                except KeyError:
+                    id = len(self.netlocs)
+                    self.netlocs.append(netloc)
+                    self.ids[netloc] = id
+                    return id
+
+    def get_netloc(self, id):
+        return self.netlocs[id]
+
+    def get_bit(self, netloc):
+        return 1 << self.get_id(netloc)
+
+    def mask_for_netlocs(self, netlocs):
+        mask = 0
+        for netloc in netlocs:
+            mask |= 1 << self.get_id(netloc)
+        return mask
+
+    def netlocs_for_mask(self, mask):
+        """Returns a frozenset of the netlocs in the given mask."""
+        try:
+            return self.decoded[mask]
+        except KeyError:
+            pass
+        netlocs = []
+        id = 0
+        remaining = mask
+        while remaining:
+            if remaining & 1:
+                netlocs.append(self.netlocs[id])
+            remaining >>= 1
+            id += 1
+        netlocs = frozenset(netlocs)
+        if len(self.decoded) >= NetlocTable.MAX_CACHED_MASKS:
+            self.decoded = {0 : frozenset()}
+        self.decoded[mask] = netlocs
+        return netlocs
+
+    def mask_contains(self, mask, netloc):
+        try:
+            return (mask >> self.ids[netloc]) & 1 == 1
+        except KeyError:
+            return False
+
+def count_bits(mask):
+    count = 0
+    while mask:
+        mask &= mask - 1
+        count += 1
+    return count
+
+netloc_table = NetlocTable()
+
+class NetlocMaskState:
+    """
+    Pickles the netloc mask in a reference as a list of netlocs, since the
+    IDs in a mask are only meaningful in the process that created it.
+    """
+
+    mask_attribute = 'location_mask'
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state[self.mask_attribute] = list(netloc_table.netlocs_for_mask(state[self.mask_attribute]))
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        setattr(self, self.mask_attribute, netloc_table.mask_for_netlocs(state[self.mask_attribute]))
+
 class SWRealReference:
     
     def as_tuple(self):
@@ -69,18 +165,28 @@ class SW2_FutureReference(SWRealReference):
     def __repr__(self):
         return 'SW2_FutureReference(%s)' % (repr(self.id), )
         
-class SW2_ConcreteReference(SWRealReference):
+class SW2_ConcreteReference(SWRealReference, NetlocMaskState):
         
     def __init__(self, id, size_hint=None, location_hints=None):
         self.id = id
         self.size_hint = size_hint
         if location_hints is not None:
-            self.location_hints = set(location_hints)
+            self.location_mask = netloc_table.mask_for_netlocs(location_hints)
         else:
-            self.location_hints = set()
-        
+            self.location_mask = 0
+
+    @property
+    def location_hints(self):
+        try:
+            return netloc_table.decoded[self.location_mask]
+        except KeyError:
+            return netloc_table.netlocs_for_mask(self.location_mask)
+
     def add_location_hint(self, netloc):
-        self.location_hints.add(netloc)
+        self.location_mask |= netloc_table.get_bit(netloc)
+
+    def has_location_hint(self, netloc):
+        return netloc_table.mask_contains(self.location_mask, netloc)
         
     def combine_with(self, ref):
         """Add the location hints from ref to this object."""
@@ -93,13 +199,13 @@ class SW2_ConcreteReference(SWRealReference):
                 self.size_hint = ref.size_hint
             
             # We calculate the union of the two sets of location hints.
-            self.location_hints.update(ref.location_hints)
+            self.location_mask |= ref.location_mask
         
     def as_tuple(self):
         return('c2', str(self.id), self.size_hint, list(self.location_hints))
 
     def __str__(self):
-        return "<ConcreteRef: %s..., length %s, held in %d locations>" % (self.id[:10], str(self.size_hint) if self.size_hint is not None else "Unknown", len(self.location_hints))
+        return "<ConcreteRef: %s..., length %s, held in %d locations>" % (self.id[:10], str(self.size_hint) if self.size_hint is not None else "Unknown", count_bits(self.location_mask))
         
     def __repr__(self):
         return 'SW2_ConcreteReference(%s, %s, %s)' % (repr(self.id), repr(self.size_hint), repr(self.location_hints))
@@ -113,7 +219,9 @@ class SW2_SweetheartReference(SW2_ConcreteReference):
     @staticmethod
     def from_concrete(ref, sweet_netloc):
         assert isinstance(ref, SW2_ConcreteReference)
-        return SW2_SweetheartReference(ref.id, sweet_netloc, ref.size_hint, ref.location_hints)
+        sweetheart = SW2_SweetheartReference(ref.id, sweet_netloc, ref.size_hint)
+        sweetheart.location_mask = ref.location_mask
+        return sweetheart
         
     def combine_with(self, ref):
         """Add the location hints from ref to this object."""
@@ -145,17 +253,27 @@ class SW2_FixedReference(SWRealReference):
     def __repr__(self):
         return 'SW2_FixedReference(%s, %s)' % (repr(self.id), repr(self.fixed_netloc))
         
-class SW2_StreamReference(SWRealReference):
+class SW2_StreamReference(SWRealReference, NetlocMaskState):
     
     def __init__(self, id, location_hints=None):
         self.id = id
         if location_hints is not None:
-            self.location_hints = set(location_hints)
+            self.location_mask = netloc_table.mask_for_netlocs(location_hints)
         else:
-            self.location_hints = set()
-        
+            self.location_mask = 0
+
+    @property
+    def location_hints(self):
+        try:
+            return netloc_table.decoded[self.location_mask]
+        except KeyError:
+            return netloc_table.netlocs_for_mask(self.location_mask)
+
     def add_location_hint(self, netloc):
-        self.location_hints.add(netloc)
+        self.location_mask |= netloc_table.get_bit(netloc)
+
+    def has_location_hint(self, netloc):
+        return netloc_table.mask_contains(self.location_mask, netloc)
 
     def combine_with(self, ref):
         """Add the location hints from ref to this object."""
@@ -166,13 +284,13 @@ class SW2_StreamReference(SWRealReference):
             # available from the merging reference.
             
             # We calculate the union of the two sets of location hints.
-            self.location_hints.update(ref.location_hints)
+            self.location_mask |= ref.location_mask
         
     def as_tuple(self):
         return('s2', str(self.id), list(self.location_hints))
 
     def __str__(self):
-        return "<StreamRef: %s..., held in %d locations>" % (self.id[:10], len(self.location_hints))
+        return "<StreamRef: %s..., held in %d locations>" % (self.id[:10], count_bits(self.location_mask))
         
     def __repr__(self):
         return 'SW2_StreamReference(%s, %s)' % (repr(self.id), repr(self.location_hints))
@@ -193,20 +311,26 @@ class SW2_SocketStreamReference(SW2_StreamReference):
     def __repr__(self):
         return 'SW2_SocketStreamReference(%s, %s, %s)' % (repr(self.id), repr(self.socket_netloc), repr(self.socket_port))
 
-class SW2_TombstoneReference(SWRealReference):
+class SW2_TombstoneReference(SWRealReference, NetlocMaskState):
+
+    mask_attribute = 'netloc_mask'
     
     def __init__(self, id, netlocs=None):
         self.id = id
         if netlocs is not None:
-            self.netlocs = set(netlocs)
+            self.netloc_mask = netloc_table.mask_for_netlocs(netlocs)
         else:
-            self.netlocs = set()
+            self.netloc_mask = 0
+
+    @property
+    def netlocs(self):
+        return netloc_table.netlocs_for_mask(self.netloc_mask)
             
     def is_consumable(self):
         return False        
     
     def add_netloc(self, netloc):
-        self.netlocs.add(netloc)
+        self.netloc_mask |= netloc_table.get_bit(netloc)
         
     def as_tuple(self):
         return ('t2', str(self.id), list(self.netlocs))
@@ -307,32 +431,23 @@ def json_decode_object_hook(dict_):
         else:
             return dict_
 
+# Mapping from the tag in a reference tuple to the reference class and the
+# number of fields that follow the tag.
+REFERENCE_TUPLE_TYPES = {'val' : (SWDataValue, 2),
+                         'err' : (SWErrorReference, 3),
+                         'f2' : (SW2_FutureReference, 1),
+                         'c2' : (SW2_ConcreteReference, 3),
+                         '<3' : (SW2_SweetheartReference, 4),
+                         's2' : (SW2_StreamReference, 2),
+                         'ss2' : (SW2_SocketStreamReference, 3),
+                         'fx' : (SW2_FixedReference, 2),
+                         't2' : (SW2_TombstoneReference, 2),
+                         'fetch2' : (SW2_FetchReference, 2),
+                         'completed2' : (SW2_CompletedReference, 1)}
+
 def build_reference_from_tuple(reference_tuple):
-    ref_type = reference_tuple[0]
-    if ref_type == 'val':
-        return SWDataValue(reference_tuple[1], reference_tuple[2])
-    elif ref_type == 'err':
-        return SWErrorReference(reference_tuple[1], reference_tuple[2], reference_tuple[3])
-    elif ref_type == 'f2':
-        return SW2_FutureReference(reference_tuple[1])
-    elif ref_type == 'c2':
-        return SW2_ConcreteReference(reference_tuple[1], reference_tuple[2], reference_tuple[3])
-    elif ref_type == '<3':
-        return SW2_SweetheartReference(reference_tuple[1], reference_tuple[2], reference_tuple[3], reference_tuple[4])
-    elif ref_type == 's2':
-        return SW2_StreamReference(reference_tuple[1], reference_tuple[2])
-    elif ref_type == 'ss2':
-        return SW2_SocketStreamReference(reference_tuple[1], reference_tuple[2], reference_tuple[3])
-    elif ref_type == 'fx':
-        return SW2_FixedReference(reference_tuple[1], reference_tuple[2])
-    elif ref_type == 't2':
-        return SW2_TombstoneReference(reference_tuple[1], reference_tuple[2])
-    elif ref_type == 'fetch2':
-        return SW2_FetchReference(reference_tuple[1], reference_tuple[2])
-    elif ref_type == "completed2":
-        return SW2_CompletedReference(reference_tuple[1])
-    else:
-        raise KeyError(ref_type)
+    ref_class, num_fields = REFERENCE_TUPLE_TYPES[reference_tuple[0]]
+    return ref_class(*reference_tuple[1:num_fields + 1])
     
 def combine_references(original, update):
 
@@ -345,7 +460,7 @@ def combine_references(original, update):
     # Sweetheart reference over other non-vals; combine location hints if any available.
     if (isinstance(update, SW2_SweetheartReference)):
         if (isinstance(original, SW2_ConcreteReference)):
-            update.location_hints.update(original.location_hints)
+            update.location_mask |= original.location_mask
         return update
 
     # Concrete reference > streaming reference > future reference.
@@ -367,8 +482,8 @@ def combine_references(original, update):
         return original
     
     if (isinstance(original, SW2_ConcreteReference) or isinstance(original, SW2_StreamReference)) and isinstance(update, SW2_TombstoneReference):
-        original.location_hints.difference_update(update.netlocs)
-        if len(original.location_hints) == 0:
+        original.location_mask &= ~update.netloc_mask
+        if original.location_mask == 0:
             return original.as_future()
         else:
             return original
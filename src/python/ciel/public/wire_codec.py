@@ -0,0 +1,198 @@
+# Copyright (c) 2011 Derek Murray <Derek.Murray@cl.cam.ac.uk>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""
+Codecs for control messages between the master and its workers.
+
+A message is encoded either as JSON, or in a compact binary form that
+starts with BINARY_MAGIC. The binary form is a struct-packed header (magic and
+payload length) followed by a payload in the
+marshal format, which is a tag, length and payload for each value and is
+encoded and decoded in C. Since marshal cannot encode references, each
+reference is replaced by its as_tuple() representation, so that it decodes
+to the same object as it would from JSON. Tuples decode as lists, as they
+do in JSON. The marshal format depends on the Python version, so the name
+of the binary codec includes the marshal version.
+
+The codec is negotiated when a worker registers: each side lists the codecs
+that it accepts, and a sender only uses the binary codec if the receiver has
+listed it. A binary message is sent with BINARY_CONTENT_TYPE, and a receiver
+only decodes it if it accepts the binary codec; any other message is decoded
+as JSON, so JSON may always be sent (e.g. when debugging with curl). Like
+JSON, the binary codec is only intended for trusted peers.
+"""
+
+from ciel.public.references import SWRealReference, SWReferenceJSONEncoder,\
+    json_decode_object_hook, build_reference_from_tuple
+import marshal
+import simplejson
+import struct
+
+CODEC_JSON = 'json'
+CODEC_BINARY = 'binary%d' % marshal.version
+
+# In order of preference.
+SUPPORTED_CODECS = [CODEC_BINARY, CODEC_JSON]
+
+# JSON text never starts with a NUL byte.
+BINARY_MAGIC = '\x00CB\x01'
+BINARY_HEADER = struct.Struct('!4sI')
+
+JSON_CONTENT_TYPE = 'application/json'
+BINARY_CONTENT_TYPE = 'application/x-ciel-%s' % CODEC_BINARY
+
+def get_codec_preferences(codec):
+    """Returns the codecs that an endpoint accepts, given the name of its
+    preferred codec ('binary' or 'json'). Every endpoint accepts JSON."""
+    if codec == CODEC_JSON:
+        return [CODEC_JSON]
+    elif codec == 'binary' or codec == CODEC_BINARY:
+        return list(SUPPORTED_CODECS)
+    else:
+        raise ValueError('Unknown wire codec: %s' % codec)
+
+def negotiate_codec(local_codecs, remote_codecs):
+    """Returns the codec that should be used to send messages to an endpoint
+    that accepts remote_codecs."""
+    for codec in local_codecs:
+        if codec in remote_codecs:
+            return codec
+    return CODEC_JSON
+
+def get_content_type(codec):
+    if codec == CODEC_BINARY:
+        return BINARY_CONTENT_TYPE
+    else:
+        return JSON_CONTENT_TYPE
+
+def get_codec_for_content_type(content_type, codecs):
+    """Returns the codec of a message with the given content type, for a
+    receiver that accepts codecs. Raises ValueError if the message is binary
+    and the receiver does not accept the binary codec."""
+    if content_type == BINARY_CONTENT_TYPE:
+        if CODEC_BINARY not in codecs:
+            raise ValueError('Binary codec is not accepted')
+        return CODEC_BINARY
+    else:
+        return CODEC_JSON
+
+# In the marshalled payload, a tuple marks a value that must be rebuilt:
+# a reference, or a list or dict that (transitively) contains one. Lists
+# and dicts without references are marshalled as they are, and are not
+# visited again when the message is decoded.
+_MARK_REFERENCE = 0
+_MARK_LIST = 1
+_MARK_DICT = 2
+
+def _convert(obj):
+    # Returns the marshallable form of obj, and True if it contains a
+    # reference.
+    t = type(obj)
+    if t is dict:
+        result = {}
+        has_refs = False
+        for key, value in obj.iteritems():
+            result[key], value_has_refs = _convert(value)
+            has_refs = has_refs or value_has_refs
+        if has_refs:
+            return (_MARK_DICT, result), True
+        return result, False
+    elif t is list or t is tuple:
+        result = []
+        has_refs = False
+        append = result.append
+        for item in obj:
+            item, item_has_refs = _convert(item)
+            append(item)
+            has_refs = has_refs or item_has_refs
+        if has_refs:
+            return (_MARK_LIST, result), True
+        return result, False
+    elif isinstance(obj, SWRealReference):
+        return (_MARK_REFERENCE, obj.as_tuple()), True
+    else:
+        return obj, False
+
+def encode_binary(obj):
+    payload, _ = _convert(obj)
+    try:
+        payload = marshal.dumps(payload, 2)
+    except ValueError:
+        raise TypeError('%r is not serializable by the binary codec' % (obj, ))
+    return BINARY_HEADER.pack(BINARY_MAGIC, len(payload)) + payload
+
+def _rebuild(marked):
+    kind, value = marked
+    if kind == _MARK_REFERENCE:
+        return build_reference_from_tuple(value)
+    elif kind == _MARK_LIST:
+        for i, item in enumerate(value):
+            if type(item) is tuple:
+                if item[0] == _MARK_REFERENCE:
+                    value[i] = build_reference_from_tuple(item[1])
+                else:
+                    value[i] = _rebuild(item)
+        return value
+    elif kind == _MARK_DICT:
+        for key, item in value.iteritems():
+            if type(item) is tuple:
+                if item[0] == _MARK_REFERENCE:
+                    value[key] = build_reference_from_tuple(item[1])
+                else:
+                    value[key] = _rebuild(item)
+        return value
+    else:
+        raise ValueError('Invalid marker in binary message: %r' % (kind, ))
+
+def decode_binary(data):
+    magic, length = BINARY_HEADER.unpack_from(data)
+    if magic != BINARY_MAGIC:
+        raise ValueError('Message is not in the binary format')
+    if length != len(data) - BINARY_HEADER.size:
+        raise ValueError('Binary message has %d bytes of payload, expected %d' % (len(data) - BINARY_HEADER.size, length))
+    obj = marshal.loads(data[BINARY_HEADER.size:])
+    if type(obj) is tuple:
+        return _rebuild(obj)
+    return obj
+
+def encode_message(obj, codec=CODEC_JSON):
+    if codec == CODEC_BINARY:
+        return encode_binary(obj)
+    else:
+        return simplejson.dumps(obj, cls=SWReferenceJSONEncoder)
+
+def decode_message(data, codec=CODEC_JSON):
+    if codec == CODEC_BINARY:
+        return decode_binary(data)
+    else:
+        return simplejson.loads(data, object_hook=json_decode_object_hook)
+
+def write_framed_message(obj, fp, codec=CODEC_JSON):
+    message = encode_message(obj, codec)
+    fp.write(struct.pack('!I', len(message)))
+    fp.write(message)
+    fp.flush()
+
+def read_framed_message(fp, codec=CODEC_JSON):
+    """Returns the next message from fp, or None at the end of fp. Raises
+    ValueError if the message is truncated."""
+    prefix = fp.read(4)
+    if len(prefix) == 0:
+        return None
+    elif len(prefix) < 4:
+        raise ValueError('Truncated message length')
+    message_len, = struct.unpack('!I', prefix)
+    message = fp.read(message_len)
+    if len(message) < message_len:
+        raise ValueError('Truncated message: got %d bytes, expected %d' % (len(message), message_len))
+    return decode_message(message, codec)
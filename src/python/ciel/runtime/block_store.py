@@ -12,6 +12,9 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 from __future__ import with_statement
+import base64
+import hashlib
+import itertools
 import random
 import os
 import uuid
@@ -20,6 +23,7 @@ import tempfile
 import logging
 import re
 import threading
+import time
 from datetime import datetime
 
 # XXX: Hack because urlparse doesn't nicely support custom schemes.
@@ -33,8 +37,26 @@ urlparse.uses_netloc.append("swbs")
 
 BLOCK_LIST_RECORD_STRUCT = struct.Struct("!120pQ")
 
+# Two 64-bit hashes of a block ID, from which the bit indices for a
+# BlockDigest are derived.
+BLOCK_DIGEST_HASH_STRUCT = struct.Struct("!QQ")
+
+# Blocks are stored in a two-level directory tree, keyed on the MD5 hash of
+# the block ID (e.g. base_dir/3f/a2/<id>), so that no directory grows too
+# large. The fetch and producer files for a block, and fixed references, are
+# stored alongside it. The IDs of pinned blocks are kept in a single file.
+PIN_SET_FILENAME = '.pin_set'
+
+# Older block stores kept every file directly in base_dir, and pinned a block
+# by creating an empty file with this prefix.
 PIN_PREFIX = '.__pin__:'
 
+# How a block came to be in the local store. Blocks that were already in the
+# store when it started have an unknown origin.
+BLOCK_ORIGIN_FETCHED = 'fetched'
+BLOCK_ORIGIN_PRODUCED = 'produced'
+BLOCK_ORIGIN_UNKNOWN = 'unknown'
+
 length_regex = re.compile("^Content-Length:\s*([0-9]+)")
 http_response_regex = re.compile("^HTTP/1.1 ([0-9]+)")
 
@@ -54,6 +76,73 @@ def sw_to_external_url(url):
     else:
         return url
 
+class BlockDigest:
+    """
+    A Bloom filter of block IDs. A worker sends a digest of its blocks to the
+    master when it registers, so that the master can find out which of the
+    blocks that it needs might be stored on the worker without transferring
+    the whole block list. A false positive costs the master a lookup on the
+    worker, and there are no false negatives.
+    """
+
+    def __init__(self, num_bits, num_hashes, bits=None):
+        self.num_bits = max(num_bits, 8)
+        self.num_hashes = num_hashes
+        if bits is None:
+            bits = bytearray((self.num_bits + 7) / 8)
+        elif len(bits) != (self.num_bits + 7) / 8:
+            raise ValueError('Block digest has %d bytes, expected %d' % (len(bits), (self.num_bits + 7) / 8))
+        self.bits = bits
+
+    def get_bit_indices(self, id):
+        h1, h2 = BLOCK_DIGEST_HASH_STRUCT.unpack(hashlib.md5(str(id)).digest())
+        num_bits = self.num_bits
+        return [(h1 + i * h2) % num_bits for i in range(self.num_hashes)]
+
+    def add(self, id):
+        bits = self.bits
+        for i in self.get_bit_indices(id):
+            bits[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, id):
+        bits = self.bits
+        for i in self.get_bit_indices(id):
+            if not bits[i >> 3] & (1 << (i & 7)):
+                return False
+        return True
+
+    def as_descriptor(self):
+        return {'num_bits': self.num_bits, 'num_hashes': self.num_hashes, 'bits': base64.b64encode(str(self.bits))}
+
+def build_block_digest(ids, bits_per_block=10):
+    # With the optimal number of hashes, 10 bits per block gives a false
+    # positive rate of about 1%.
+    digest = BlockDigest(len(ids) * bits_per_block, max(1, int(round(bits_per_block * 0.693))))
+    for id in ids:
+        digest.add(id)
+    return digest
+
+def build_block_digest_from_descriptor(descriptor):
+    return BlockDigest(descriptor['num_bits'], descriptor['num_hashes'], bytearray(base64.b64decode(descriptor['bits'])))
+
+def get_shard_path(id):
+    digest = hashlib.md5(str(id)).hexdigest()
+    return os.path.join(digest[0:2], digest[2:4])
+
+class BlockInfo(object):
+    """The block store's index entry for a locally-stored block."""
+
+    __slots__ = ['size', 'pinned', 'atime', 'origin']
+
+    def __init__(self, size, pinned, atime, origin):
+        self.size = size
+        self.pinned = pinned
+        self.atime = atime
+        self.origin = origin
+
+    def as_descriptor(self):
+        return {'size': self.size, 'pinned': self.pinned, 'atime': self.atime, 'origin': self.origin}
+
 class BlockStore:
 
     def __init__(self, hostname, port, base_dir, ignore_blocks=False):
@@ -69,6 +158,24 @@ class BlockStore:
         self.ignore_blocks = ignore_blocks
         self.lock = threading.Lock()
 
+        # Mapping from block ID to BlockInfo for every block in base_dir (but
+        # not the dot-files for fetches, producers, pins and fixed
+        # references). This is built by check_local_blocks(), and thereafter
+        # the store never needs to look at base_dir to find a block.
+        self.blocks = {}
+
+        # Blocks that are still in the flat layout, until they are migrated.
+        self.flat_blocks = set()
+        self.migration_thread = None
+
+        # Blocks that have been migrated since the last start. Their flat
+        # names remain until the next start, because a running task or the
+        # web server may still open them.
+        self.migrated_blocks = set()
+
+        self.shard_dirs = set()
+        self.pin_set_fp = None
+
         global singleton_blockstore
         assert singleton_blockstore is None
         singleton_blockstore = self
@@ -80,8 +187,23 @@ class BlockStore:
     def allocate_new_id(self):
         return str(uuid.uuid1())
     
-    def pin_filename(self, id): 
-        return os.path.join(self.base_dir, PIN_PREFIX + id)
+    def pin_set_filename(self):
+        return os.path.join(self.base_dir, PIN_SET_FILENAME)
+
+    def shard_dir(self, id):
+        return os.path.join(self.base_dir, get_shard_path(id))
+
+    def make_shard_dir(self, shard_dir):
+        # Only called before writing a file, so that looking up a block
+        # never creates directories.
+        if shard_dir not in self.shard_dirs:
+            try:
+                os.makedirs(shard_dir)
+            except OSError as e:
+                if e.errno != 17: # File exists
+                    raise
+            self.shard_dirs.add(shard_dir)
+        return shard_dir
     
     class OngoingFetch:
 
@@ -90,29 +212,53 @@ class BlockStore:
             self.filename = None
             self.block_store = block_store
             while self.filename is None:
-                possible_name = os.path.join(block_store.base_dir, ".fetch:%s:%s" % (datetime.now().microsecond, ref.id))
+                possible_name = os.path.join(block_store.make_shard_dir(block_store.shard_dir(ref.id)), ".fetch:%s:%s" % (datetime.now().microsecond, ref.id))
                 if not os.path.exists(possible_name):
                     self.filename = possible_name
 
         def commit(self):
-            self.block_store.commit_file(self.filename, self.block_store.filename_for_ref(self.ref))
+            self.block_store.commit_file(self.filename, self.block_store.filename_for_ref(self.ref), BLOCK_ORIGIN_FETCHED)
 
     def create_fetch_file_for_ref(self, ref):
         with self.lock:
             return BlockStore.OngoingFetch(ref, self)
     
     def producer_filename(self, id):
-        return os.path.join(self.base_dir, '.producer:%s' % id)
+        return os.path.join(self.shard_dir(id), '.producer:%s' % id)
+
+    def create_producer_file(self, id):
+        filename = os.path.join(self.make_shard_dir(self.shard_dir(id)), '.producer:%s' % id)
+        open(filename, 'wb').close()
+        return filename
     
     def filename(self, id):
-        return os.path.join(self.base_dir, str(id))
+        if id in self.flat_blocks:
+            return os.path.join(self.base_dir, str(id))
+        return os.path.join(self.shard_dir(id), str(id))
 
     def filename_for_ref(self, ref):
         if isinstance(ref, SW2_FixedReference):
-            return os.path.join(self.base_dir, '.__fixed__.%s' % ref.id)
+            return os.path.join(self.shard_dir(ref.id), '.__fixed__.%s' % ref.id)
         else:
             return self.filename(ref.id)
         
+    def is_block_local(self, id):
+        try:
+            block_info = self.blocks[id]
+        except KeyError:
+            return False
+        block_info.atime = time.time()
+        return True
+
+    def has_block_for_ref(self, ref):
+        if isinstance(ref, SW2_FixedReference):
+            # Fixed references are written in place, so they are not indexed.
+            return os.path.exists(self.filename_for_ref(ref))
+        return self.is_block_local(ref.id)
+
+    def get_block_info(self, id):
+        return self.blocks[id]
+        
     def is_ref_local(self, ref):
         assert isinstance(ref, SWRealReference)
 
@@ -122,7 +268,7 @@ class BlockStore:
         if isinstance(ref, SW2_FixedReference):
             assert ref.fixed_netloc == self.netloc
             
-        if os.path.exists(self.filename_for_ref(ref)):
+        if self.has_block_for_ref(ref):
             return True
         if isinstance(ref, SWDataValue):
             create_datavalue_file(ref)
@@ -130,8 +276,9 @@ class BlockStore:
 
         return False
 
-    def commit_file(self, old_name, new_name):
+    def commit_file(self, old_name, new_name, origin=BLOCK_ORIGIN_UNKNOWN):
 
+        self.make_shard_dir(os.path.dirname(new_name))
         try:
             os.link(old_name, new_name)
         except OSError as e:
@@ -146,9 +293,15 @@ class BlockStore:
             else:
                 raise
 
+        id = os.path.basename(new_name)
+        if not id.startswith('.'):
+            with self.lock:
+                if id not in self.blocks:
+                    self.blocks[id] = BlockInfo(os.path.getsize(new_name), id in self.pin_set, time.time(), origin)
+
     def commit_producer(self, id):
         ciel.log.error('Committing file for output %s' % id, 'BLOCKSTORE', logging.DEBUG)
-        self.commit_file(self.producer_filename(id), self.filename(id))
+        self.commit_file(self.producer_filename(id), self.filename(id), BLOCK_ORIGIN_PRODUCED)
         
     def choose_best_netloc(self, netlocs):
         for netloc in netlocs:
@@ -166,35 +319,145 @@ class BlockStore:
                     return url
             return random.choice(urls)
 
+    def check_local_block_file(self, dir, block_name, blocks):
+        if not block_name.startswith('.'):
+            block_stat = os.stat(os.path.join(dir, block_name))
+            blocks[block_name] = BlockInfo(block_stat.st_size, block_name in self.pin_set, block_stat.st_atime, BLOCK_ORIGIN_UNKNOWN)
+            return True
+        elif block_name.startswith('.fetch:'):
+            # No fetches are in progress, so the file is either incomplete or
+            # a link to a block that has been committed.
+            os.remove(os.path.join(dir, block_name))
+        elif block_name.startswith('.producer:'):
+            if block_name[10:] not in blocks and not os.path.exists(os.path.join(dir, block_name[10:])):
+                ciel.log("Deleting incomplete block %s" % block_name, "BLOCKSTORE", logging.WARNING)
+                os.remove(os.path.join(dir, block_name))
+        return False
+
     def check_local_blocks(self):
         ciel.log("Looking for local blocks", "BLOCKSTORE", logging.DEBUG)
+        blocks = {}
+        flat_blocks = set()
         try:
-            for block_name in os.listdir(self.base_dir):
-                if block_name.startswith('.fetch:'):
-                    if not os.path.exists(os.path.join(self.base_dir, block_name[7:])):
-                        ciel.log("Deleting incomplete block %s" % block_name, "BLOCKSTORE", logging.WARNING)
-                        os.remove(os.path.join(self.base_dir, block_name))
-                elif block_name.startswith('.producer:'):
-                    if not os.path.exists(os.path.join(self.base_dir, block_name[10:])):
-                        ciel.log("Deleting incomplete block %s" % block_name, "BLOCKSTORE", logging.WARNING)
-                        os.remove(os.path.join(self.base_dir, block_name))                        
+            for name in os.listdir(self.base_dir):
+                path = os.path.join(self.base_dir, name)
+                if len(name) == 2 and os.path.isdir(path):
+                    for shard_name in os.listdir(path):
+                        shard_dir = os.path.join(path, shard_name)
+                        self.shard_dirs.add(shard_dir)
+                        for block_name in os.listdir(shard_dir):
+                            self.check_local_block_file(shard_dir, block_name, blocks)
+                elif name.startswith(PIN_PREFIX) or name == PIN_SET_FILENAME or name.startswith(PIN_SET_FILENAME + '.'):
+                    # Handled by build_pin_set().
+                    pass
+                elif name.startswith('.__fixed__.'):
+                    # Fixed references are few, so they move to the sharded
+                    # layout immediately.
+                    os.rename(path, os.path.join(self.make_shard_dir(self.shard_dir(name[11:])), name))
+                elif not name.startswith('.') and os.path.exists(os.path.join(self.base_dir, get_shard_path(name), name)):
+                    # The block was migrated before the last restart.
+                    os.remove(path)
+                elif self.check_local_block_file(self.base_dir, name, blocks):
+                    flat_blocks.add(name)
+                elif name.startswith('.producer:') and os.path.exists(path):
+                    # The block is complete, and the producer file is no
+                    # longer used.
+                    os.remove(path)
         except OSError as e:
             ciel.log("Couldn't enumerate existing blocks: %s" % e, "BLOCKSTORE", logging.WARNING)
+        with self.lock:
+            self.blocks = blocks
+            self.flat_blocks = flat_blocks
+        ciel.log("Found %d local blocks" % len(blocks), "BLOCKSTORE", logging.DEBUG)
+
+        if len(flat_blocks) > 0:
+            self.migration_thread = threading.Thread(target=self.migrate_flat_blocks)
+            self.migration_thread.daemon = True
+            self.migration_thread.start()
+
+    def migrate_flat_blocks(self, batch_size=1000, batch_interval=0.1):
+        """Moves the blocks in the flat layout into the sharded layout, while
+        the block store is in use. The flat names are removed at the next
+        start."""
+        ciel.log('Migrating %d blocks to the sharded layout' % len(self.flat_blocks), 'BLOCKSTORE', logging.INFO)
+        migrated = 0
+        while True:
+            with self.lock:
+                batch = list(itertools.islice(self.flat_blocks, batch_size))
+            if len(batch) == 0:
+                break
+            for id in batch:
+                old_name = os.path.join(self.base_dir, id)
+                # Hold the lock so that the block is not flushed meanwhile.
+                with self.lock:
+                    if id not in self.flat_blocks:
+                        continue
+                    try:
+                        os.link(old_name, os.path.join(self.make_shard_dir(self.shard_dir(id)), id))
+                    except OSError as e:
+                        if e.errno != 17: # File exists
+                            ciel.log('Error migrating block %s: %s' % (id, e), 'BLOCKSTORE', logging.ERROR)
+                            return
+                    self.flat_blocks.discard(id)
+                    self.migrated_blocks.add(id)
+                migrated += 1
+            time.sleep(batch_interval)
+        ciel.log('Migrated %d blocks to the sharded layout' % migrated, 'BLOCKSTORE', logging.INFO)
 
     def block_list_generator(self):
         ciel.log.error('Generating block list for local consumption', 'BLOCKSTORE', logging.DEBUG)
-        for block_name in os.listdir(self.base_dir):
-            if not block_name.startswith('.'):
-                block_size = os.path.getsize(os.path.join(self.base_dir, block_name))
-                yield block_name, block_size
+        for block_name, block_info in self.blocks.items():
+            yield block_name, block_info.size
+    
+    def generate_block_digest(self):
+        ciel.log.error('Generating block digest', 'BLOCKSTORE', logging.DEBUG)
+        return build_block_digest(self.blocks.keys())
+
+    def get_block_sizes(self, ids):
+        """Returns a list of (id, size) for each of the given blocks that is
+        stored locally."""
+        ret = []
+        blocks = self.blocks
+        for id in ids:
+            try:
+                ret.append((id, blocks[id].size))
+            except KeyError:
+                pass
+        return ret
     
     def build_pin_set(self):
         ciel.log.error('Building pin set', 'BLOCKSTORE', logging.DEBUG)
         initial_size = len(self.pin_set)
-        for filename in os.listdir(self.base_dir):
-            if filename.startswith(PIN_PREFIX):
-                self.pin_set.add(filename[len(PIN_PREFIX):])
-                ciel.log.error('Pinning block %s' % filename[len(PIN_PREFIX):], 'BLOCKSTORE', logging.DEBUG)
+        try:
+            with open(self.pin_set_filename(), 'r') as pin_set_file:
+                for line in pin_set_file:
+                    id = line.strip()
+                    if len(id) > 0:
+                        self.pin_set.add(id)
+        except IOError:
+            pass
+
+        # Migrate the pins from the flat layout.
+        pin_filenames = [filename for filename in os.listdir(self.base_dir) if filename.startswith(PIN_PREFIX)]
+        for filename in pin_filenames:
+            self.pin_set.add(filename[len(PIN_PREFIX):])
+            ciel.log.error('Pinning block %s' % filename[len(PIN_PREFIX):], 'BLOCKSTORE', logging.DEBUG)
+
+        # Rewrite the pin set file, which also removes any duplicates.
+        with self.lock:
+            if self.pin_set_fp is not None:
+                self.pin_set_fp.close()
+            new_filename = self.pin_set_filename() + '.new'
+            with open(new_filename, 'w') as pin_set_file:
+                for id in self.pin_set:
+                    pin_set_file.write('%s\n' % id)
+                pin_set_file.flush()
+                os.fsync(pin_set_file.fileno())
+            os.rename(new_filename, self.pin_set_filename())
+            self.pin_set_fp = open(self.pin_set_filename(), 'a')
+
+        for filename in pin_filenames:
+            os.remove(os.path.join(self.base_dir, filename))
         ciel.log.error('Pinned %d new blocks' % (len(self.pin_set) - initial_size), 'BLOCKSTORE', logging.DEBUG)
     
     def generate_block_list_file(self):
@@ -208,25 +471,45 @@ class BlockStore:
     def generate_pin_refs(self):
         ret = []
         for id in self.pin_set:
-            ret.append(SW2_ConcreteReference(id, os.path.getsize(self.filename(id)), [self.netloc]))
+            try:
+                ret.append(SW2_ConcreteReference(id, self.blocks[id].size, [self.netloc]))
+            except KeyError:
+                # The block was pinned before it was stored here.
+                pass
         return ret
 
     def pin_ref_id(self, id):
-        open(self.pin_filename(id), 'w').close()
-        self.pin_set.add(id)
+        with self.lock:
+            if id not in self.pin_set:
+                if self.pin_set_fp is None:
+                    self.pin_set_fp = open(self.pin_set_filename(), 'a')
+                self.pin_set_fp.write('%s\n' % id)
+                self.pin_set_fp.flush()
+                os.fsync(self.pin_set_fp.fileno())
+                self.pin_set.add(id)
+            try:
+                self.blocks[id].pinned = True
+            except KeyError:
+                pass
         ciel.log.error('Pinned block %s' % id, 'BLOCKSTORE', logging.DEBUG)
         
     def flush_unpinned_blocks(self, really=True):
         ciel.log.error('Flushing unpinned blocks', 'BLOCKSTORE', logging.DEBUG)
         files_kept = 0
         files_removed = 0
-        for block_name in os.listdir(self.base_dir):
-            if block_name not in self.pin_set and not block_name.startswith(PIN_PREFIX):
-                if really:
-                    os.remove(os.path.join(self.base_dir, block_name))
-                files_removed += 1
-            elif not block_name.startswith(PIN_PREFIX):
-                files_kept += 1
+        with self.lock:
+            for block_name, block_info in self.blocks.items():
+                if not block_info.pinned:
+                    if really:
+                        os.remove(self.filename(block_name))
+                        if block_name in self.migrated_blocks:
+                            os.remove(os.path.join(self.base_dir, block_name))
+                            self.migrated_blocks.discard(block_name)
+                        del self.blocks[block_name]
+                        self.flat_blocks.discard(block_name)
+                    files_removed += 1
+                else:
+                    files_kept += 1
         if really:
             ciel.log.error('Flushed block store, kept %d blocks, removed %d blocks' % (files_kept, files_removed), 'BLOCKSTORE', logging.DEBUG)
         else:
@@ -234,7 +517,7 @@ class BlockStore:
         return (files_kept, files_removed)
 
     def is_empty(self):
-        return self.ignore_blocks or len(os.listdir(self.base_dir)) == 0
+        return self.ignore_blocks or len(self.blocks) == 0
 
 ### Stateless functions
 
@@ -267,6 +550,9 @@ def create_fetch_file_for_ref(ref):
 def producer_filename(id):
     return singleton_blockstore.producer_filename(id)
 
+def create_producer_file(id):
+    return singleton_blockstore.create_producer_file(id)
+
 def filename(id):
     return singleton_blockstore.filename(id)
 
@@ -276,6 +562,9 @@ def filename_for_ref(ref):
 def is_ref_local(ref):
     return singleton_blockstore.is_ref_local(ref)
 
+def has_block_for_ref(ref):
+    return singleton_blockstore.has_block_for_ref(ref)
+
 def create_datavalue_file(ref):
     bs_ctx = create_fetch_file_for_ref(ref)
     with open(bs_ctx.filename, 'w') as obj_file:
@@ -26,7 +26,7 @@ import os
 from ciel.runtime.pycurl_data_fetch import HttpTransferContext
 from ciel.runtime.tcp_data_fetch import TcpTransferContext
 from ciel.runtime.block_store import filename_for_ref, producer_filename,\
-    get_own_netloc, create_datavalue_file
+    get_own_netloc, create_datavalue_file, has_block_for_ref
 from ciel.runtime.producer import get_producer_for_id,\
     ref_from_external_file, ref_from_string
 from ciel.runtime.exceptions import ErrorReferenceError,\
@@ -216,7 +216,7 @@ class FetchInProgress:
 
     def use_local_file(self):
         filename = filename_for_ref(self.ref)
-        if os.path.exists(filename):
+        if has_block_for_ref(self.ref):
             self.set_filename(filename, True)
             self.result(True, None)
         else:
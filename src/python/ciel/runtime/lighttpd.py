@@ -132,6 +132,19 @@ fastcgi.server             = ( "/control/" =>
                    "check-local" => "disable",
                    "docroot" => "/",
                                  )
+                               ),
+                               # Blocks are stored in a sharded directory
+                               # tree, so the application finds them and
+                               # lighttpd sends them.
+                               "/data/" =>
+                               ( "cherrypy" =>
+                                 (
+                                   "socket" => "{ciel_socket}",
+                   "max-procs" => 1,
+                   "check-local" => "disable",
+                   "docroot" => "/",
+                   "allow-x-send-file" => "enable",
+                                 )
                                )
                             )
 
@@ -18,10 +18,13 @@ from ciel.runtime.master.deferred_work import DeferredWorkPlugin
 from ciel.runtime.master.hot_standby import BackupSender, \
     MasterRecoveryMonitor
 from ciel.runtime.master.job_pool import JobPool
+from ciel.runtime.master.journal_writer import JournalWriter
 from ciel.runtime.master.master_view import MasterRoot
+from ciel.runtime.master.memo import MemoTable
 from ciel.runtime.master.recovery import RecoveryManager, \
     TaskFailureInvestigator
 from ciel.runtime.master.worker_pool import WorkerPool
+from ciel.public.wire_codec import get_codec_preferences
 from ciel.runtime.task_executor import TaskExecutorPlugin
 from ciel.runtime.pycurl_rpc import post_string
 from ciel.runtime.pycurl_thread import create_pycurl_thread
@@ -44,20 +47,33 @@ def master_main(options):
 
     create_pycurl_thread(ciel.engine)
 
-    deferred_worker = DeferredWorkPlugin(ciel.engine)
+    deferred_worker = DeferredWorkPlugin(ciel.engine, num_shards=options.deferred_threads)
     deferred_worker.subscribe()
 
-    worker_pool = WorkerPool(ciel.engine, deferred_worker, None)
+    worker_pool = WorkerPool(ciel.engine, deferred_worker, None, get_codec_preferences(options.wire_codec))
     worker_pool.subscribe()
 
     task_failure_investigator = TaskFailureInvestigator(worker_pool, deferred_worker)
+
+    if options.memoize:
+        # The memo table is kept next to the job journals, so that it
+        # outlives the master.
+        if options.journaldir is not None:
+            memo_filename = os.path.normpath(options.journaldir) + '.memo'
+        else:
+            memo_filename = None
+        memo_table = MemoTable(memo_filename, options.memo_entries)
+    else:
+        memo_table = None
     
-    job_pool = JobPool(ciel.engine, options.journaldir, None, task_failure_investigator, deferred_worker, worker_pool, options.task_log_root)
+    journal_writer = JournalWriter(sync_interval=options.journal_sync_ms / 1000.0, sync_bytes=options.journal_sync_bytes, compress_level=options.journal_compress)
+    
+    job_pool = JobPool(ciel.engine, options.journaldir, None, task_failure_investigator, deferred_worker, worker_pool, options.task_log_root, options.fair_share, memo_table, journal_writer)
     job_pool.subscribe()
     
     worker_pool.job_pool = job_pool
 
-    backup_sender = BackupSender(cherrypy.engine)
+    backup_sender = BackupSender(cherrypy.engine, options.replication_window, options.replication_batch, codecs=worker_pool.codecs)
     backup_sender.subscribe()
 
     if options.hostname is not None:
@@ -83,14 +99,17 @@ def master_main(options):
     block_store.build_pin_set()
     block_store.check_local_blocks()
 
+    if memo_table is not None:
+        memo_table.block_store = block_store
+
     # TODO: Re-enable this and test thoroughly.
     #if options.master is not None:
-    #    monitor = MasterRecoveryMonitor(cherrypy.engine, 'http://%s/' % master_netloc, options.master, job_pool)
+    #    monitor = MasterRecoveryMonitor(cherrypy.engine, 'http://%s/' % master_netloc, options.master, job_pool, codecs=worker_pool.codecs)
     #    monitor.subscribe()
     #else:
     monitor = None
 
-    recovery_manager = RecoveryManager(ciel.engine, job_pool, block_store, deferred_worker)
+    recovery_manager = RecoveryManager(ciel.engine, job_pool, block_store, deferred_worker, options.recovery_processes)
     recovery_manager.subscribe()
   
     root = MasterRoot(worker_pool, block_store, job_pool, backup_sender, monitor)
@@ -143,6 +162,17 @@ def main(args=sys.argv):
     parser.add_option("-o", "--logfile", action="store", dest="logfile", help="If daemonised, log to FILE", default="/dev/null", metavar="FILE")
     parser.add_option("-v", "--verbose", action="callback", callback=lambda w, x, y, z: ciel.set_log_level(logging.DEBUG), help="Turns on debugging output")
     parser.add_option("-6", "--task-log-root", action="store", dest="task_log_root", help="Path to store task state log", metavar="PATH", default=None)
+    parser.add_option("-F", "--fair-share", action="store", dest="fair_share", help="Policy for sharing workers between running jobs (drf, weighted or none)", metavar="POLICY", default="drf")
+    parser.add_option("-T", "--deferred-threads", action="store", dest="deferred_threads", help="Number of threads that run deferred work, which is sharded by job", metavar="N", type="int", default=4)
+    parser.add_option("-W", "--wire-codec", action="store", dest="wire_codec", help="Preferred codec for messages to and from workers and backup masters (binary or json)", metavar="CODEC", default="binary")
+    parser.add_option("--journal-sync-ms", action="store", dest="journal_sync_ms", help="Interval between commits of the job journals", metavar="MS", type="float", default=5.0)
+    parser.add_option("--journal-sync-bytes", action="store", dest="journal_sync_bytes", help="Commit the job journals early once this many bytes are waiting", metavar="N", type="int", default=1048576)
+    parser.add_option("--journal-compress", action="store", dest="journal_compress", help="zlib compression level for the job journals (0 to disable)", metavar="LEVEL", type="int", default=1)
+    parser.add_option("--recovery-processes", action="store", dest="recovery_processes", help="Number of processes that read job journals when the master restarts (default: one per CPU)", metavar="N", type="int", default=None)
+    parser.add_option("--replication-window", action="store", dest="replication_window", help="Maximum number of records that hot standbys may lag behind before the master waits for them", metavar="N", type="int", default=100000)
+    parser.add_option("--replication-batch", action="store", dest="replication_batch", help="Maximum number of records sent to a hot standby in each frame", metavar="N", type="int", default=1000)
+    parser.add_option("-M", "--memoize", action="store_true", dest="memoize", help="Reuse the outputs of tasks that have already run in a previous job", default=False)
+    parser.add_option("--memo-entries", action="store", dest="memo_entries", help="Maximum number of tasks in the memo table, beyond which unpinned tasks are evicted", metavar="N", type="int", default=100000)
     parser.add_option("-i", "--pidfile", action="store", dest="pidfile", help="Record the PID of the process", default=None);
     (options, args) = parser.parse_args(args=args)
 
@@ -15,7 +15,6 @@ from ciel.runtime.master.job_pool import JOB_STATE_NAMES
 from cherrypy._cperror import HTTPError
 from ciel.runtime.task import TASK_STATES, TASK_STATE_NAMES
 import cherrypy
-import time
 from ciel.public.references import SWDataValue, decode_datavalue
 
 def table_row(key, *args):
@@ -36,6 +35,9 @@ def ref_id_link(job, ref_id):
 def task_link(job, task):
     return '<a href="/control/browse/task/%s/%s">%s</a>' % (job.id, task.task_id, task.task_id)
 
+def task_id_link(job, task_id):
+    return '<a href="/control/browse/task/%s/%s">%s</a>' % (job.id, task_id, task_id)
+
 def swbs_link(netloc, ref_id):
     return '<a href="http://%s/data/%s">Link</a>' % (netloc, ref_id)
 
@@ -81,6 +83,9 @@ class JobBrowserRoot:
                 job_string += table_row('Tasks ' + name, job.task_state_counts[state])
             except KeyError:
                 job_string += table_row('Tasks ' + name, 0)
+        job_string += span_row('Locality')
+        job_string += table_row('Locality hits', job.locality_hits)
+        job_string += table_row('Locality misses', job.locality_misses)
         job_string += span_row('Task type/duration', 5)
         job_string += table_row('*', str(job.all_tasks.get()), str(job.all_tasks.min), str(job.all_tasks.max), str(job.all_tasks.count))
         for type, avg in job.all_tasks_by_type.items():
@@ -104,7 +109,10 @@ class TaskBrowserRoot:
         try:
             task = job.task_graph.get_task(task_id)
         except KeyError:
-            raise HTTPError(404)
+            try:
+                return self.retired_task(job, job.get_retired_task_descriptor(task_id))
+            except KeyError:
+                raise HTTPError(404)
         
         task_string = '<html><head><title>Task Browser</title></head>'
         task_string += '<body><table>'
@@ -112,6 +120,9 @@ class TaskBrowserRoot:
         task_string += table_row('State', TASK_STATE_NAMES[task.state])
         for worker in [task.get_worker()]:
             task_string += table_row('Worker', worker.netloc if worker is not None else None)
+        task_string += table_row('Locality hits', task.locality_hits)
+        task_string += table_row('Locality misses', task.locality_misses)
+        task_string += table_row('Time queued', task.sched_wait)
         task_string += span_row('Dependencies')
         for local_id, ref in task.dependencies.items():
             task_string += table_row(local_id, ref_link(job, ref))
@@ -119,8 +130,8 @@ class TaskBrowserRoot:
         for i, output_id in enumerate(task.expected_outputs):
             task_string += table_row(i, ref_id_link(job, output_id))
         task_string += span_row('History')
-        for t, name in task.history:
-            task_string += table_row(time.mktime(t.timetuple()) + t.microsecond / 1e6, name)
+        for t, name in task.get_history():
+            task_string += table_row(t, name)
         if len(task.children) > 0:
             task_string += span_row('Children')
             for i, child in enumerate(task.children):
@@ -128,6 +139,31 @@ class TaskBrowserRoot:
         task_string += '</table></body></html>'
         return task_string
 
+    def retired_task(self, job, descriptor):
+        task_string = '<html><head><title>Task Browser</title></head>'
+        task_string += '<body><table>'
+        task_string += table_row('ID', descriptor['task_id'])
+        task_string += table_row('State', '%s (retired)' % descriptor['state'])
+        task_string += table_row('Worker', descriptor['worker'])
+        task_string += table_row('Locality hits', descriptor['locality_hits'])
+        task_string += table_row('Locality misses', descriptor['locality_misses'])
+        task_string += table_row('Time queued', descriptor['sched_wait'])
+        task_string += span_row('Dependencies')
+        for ref in descriptor['dependencies']:
+            task_string += table_row(ref.id, ref_link(job, ref))
+        task_string += span_row('Outputs')
+        for i, output_id in enumerate(descriptor['expected_outputs']):
+            task_string += table_row(i, ref_id_link(job, output_id))
+        task_string += span_row('History')
+        for t, name in descriptor['history']:
+            task_string += table_row(t, name)
+        if len(descriptor['children']) > 0:
+            task_string += span_row('Children')
+            for i, child_id in enumerate(descriptor['children']):
+                task_string += table_row(i, task_id_link(job, child_id))
+        task_string += '</table></body></html>'
+        return task_string
+
 class RefBrowserRoot:
     
     def __init__(self, job_pool):
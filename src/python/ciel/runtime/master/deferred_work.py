@@ -3,35 +3,162 @@ Created on 17 Aug 2010
 
 @author: dgm36
 '''
-from ciel.runtime.plugins import AsynchronousExecutePlugin
-from threading import Timer
+from __future__ import with_statement
+from ciel.runtime.plugins import AsynchronousExecutePlugin, THREAD_TERMINATOR
+from threading import Lock, Timer
+from Queue import Queue
+import ciel
+import logging
+import threading
+import time
+
+class DeferredWorkShard:
+    """
+    A queue of deferred work that is executed in order by a single thread,
+    with metrics on the queue depth and the latency of each item.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.queue = Queue()
+        # The number of keys that are assigned to this shard.
+        self.num_keys = 0
+        self._lock = Lock()
+        self.max_depth = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run = 0.0
+        self.max_run = 0.0
+
+    def put(self, callable):
+        self.queue.put((time.time(), callable))
+        with self._lock:
+            self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def record(self, queued_at, started_at, finished_at):
+        wait = started_at - queued_at
+        run = finished_at - started_at
+        with self._lock:
+            self.completed += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.total_run += run
+            self.max_run = max(self.max_run, run)
+
+    def as_descriptor(self):
+        with self._lock:
+            completed = self.completed
+            return {'shard' : self.index,
+                    'depth' : self.queue.qsize(),
+                    'max_depth' : self.max_depth,
+                    'completed' : completed,
+                    'mean_wait' : self.total_wait / completed if completed > 0 else 0.0,
+                    'max_wait' : self.max_wait,
+                    'mean_run' : self.total_run / completed if completed > 0 else 0.0,
+                    'max_run' : self.max_run}
 
 class DeferredWorkPlugin(AsynchronousExecutePlugin):
-    
-    def __init__(self, bus, event_name="deferred_work"):
-        AsynchronousExecutePlugin.__init__(self, bus, 1, event_name)
+    """
+    Executes deferred work on one or more threads. Work is sharded by its
+    key (typically a job ID), so that work with the same key is executed in
+    the order that it was deferred, and work for different keys may run in
+    parallel. Each key is assigned to the shard with the fewest keys the
+    first time that it is seen, and keeps that shard until release_key() is
+    called. Work without a key always runs on the first shard.
+    """
+
+    def __init__(self, bus, event_name="deferred_work", num_shards=1):
+        AsynchronousExecutePlugin.__init__(self, bus, num_shards, event_name)
+        self.shards = [DeferredWorkShard(i) for i in range(num_shards)]
+        # Mapping from key to the shard that runs its work.
+        self.key_shards = {}
+        self._shard_lock = Lock()
         self.timers = {}
         self.current_timer_id = 0
-    
+        self._timer_lock = Lock()
+
+    def start(self):
+        self.is_running = True
+        for shard in self.shards:
+            t = threading.Thread(target=self.shard_main, args=(shard, ))
+            self.threads.append(t)
+            t.start()
+
     def stop(self):
-        for timer in self.timers.values():
+        with self._timer_lock:
+            timers = self.timers.values()
+        for timer in timers:
             timer.cancel()
-        AsynchronousExecutePlugin.stop(self)
-    
+        self.is_running = False
+        for shard in self.shards:
+            shard.put(THREAD_TERMINATOR)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def shard_main(self, shard):
+        while self.is_running:
+            queued_at, input = shard.queue.get()
+            if input is THREAD_TERMINATOR:
+                break
+            started_at = time.time()
+            try:
+                self.handle_input(input)
+            except Exception:
+                ciel.log.error('Error handling deferred work on shard %d' % shard.index, 'DEFERRED', logging.ERROR, True)
+            shard.record(queued_at, started_at, time.time())
+
+    def receive_input(self, input=None):
+        self.do_deferred(input)
+
     def handle_input(self, input):
         input()
-        
-    def do_deferred(self, callable):
-        self.receive_input(callable)
-        
+
+    def get_shard(self, key):
+        if key is None or len(self.shards) == 1:
+            return self.shards[0]
+        with self._shard_lock:
+            try:
+                return self.key_shards[key]
+            except KeyError:
+                shard = min(self.shards, key=lambda s: (s.num_keys, s.queue.qsize(), s.index))
+                shard.num_keys += 1
+                self.key_shards[key] = shard
+                return shard
+
+    def release_key(self, key):
+        """Frees the shard of a key that will defer no more work (e.g. the ID
+        of a completed job). The work that is already queued for the key runs
+        first, so if more work arrives, it still runs in order."""
+        with self._shard_lock:
+            try:
+                shard = self.key_shards[key]
+            except KeyError:
+                return
+        shard.put(lambda: self._forget_key(key, shard))
+
+    def _forget_key(self, key, shard):
+        with self._shard_lock:
+            if self.key_shards.get(key) is shard:
+                del self.key_shards[key]
+                shard.num_keys -= 1
+
+    def get_shard_metrics(self):
+        return [shard.as_descriptor() for shard in self.shards]
+
+    def do_deferred(self, callable, key=None):
+        self.get_shard(key).put(callable)
+
     def _handle_deferred_after(self, callable, timer_id):
-        del self.timers[timer_id]
+        with self._timer_lock:
+            del self.timers[timer_id]
         callable()
-        
-    def do_deferred_after(self, secs, callable):
-        timer_id = self.current_timer_id
-        self.current_timer_id += 1
-        t = Timer(secs, self.do_deferred, args=(lambda: self._handle_deferred_after(callable, timer_id), ))
-        self.timers[timer_id] = t
+
+    def do_deferred_after(self, secs, callable, key=None):
+        with self._timer_lock:
+            timer_id = self.current_timer_id
+            self.current_timer_id += 1
+            t = Timer(secs, self.do_deferred, args=(lambda: self._handle_deferred_after(callable, timer_id), key))
+            self.timers[timer_id] = t
         t.start()
-        
\ No newline at end of file
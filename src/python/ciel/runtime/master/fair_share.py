@@ -0,0 +1,197 @@
+# Copyright (c) 2011 Derek Murray <Derek.Murray@cl.cam.ac.uk>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+from __future__ import with_statement
+from threading import Lock
+import ciel
+import heapq
+import logging
+import time
+
+class FairShareAllocator:
+    """
+    Divides the slots in each scheduling class between the active jobs.
+
+    Each job has a weight (the 'share_weight' job option, default 1.0) and a
+    demand in each class, which is the number of slots that it is using plus
+    the number of tasks that it has waiting to run. Slots are handed out one
+    at a time to the job with the lowest weighted share:
+
+     - 'weighted' computes an independent max-min fair share in each class.
+     - 'drf' uses dominant resource fairness, where a job's share is its
+       largest fraction of any class. [Ghodsi et al. NSDI 2011]
+
+    Capacity that no job demands is added to every job's quota, so that a
+    job whose demand grows between recomputations is not held back while
+    the cluster is idle.
+    """
+
+    def __init__(self, worker_pool, policy='drf', interval=1.0):
+        self.worker_pool = worker_pool
+        self.policy = policy
+        self.interval = interval
+        self.jobs = set()
+        self.quotas = {}
+        self.shares = {}
+        self.last_computed = None
+        self.dirty = True
+        # Incremented by invalidate(), so that a recomputation can tell if
+        # the capacities that it read have since changed.
+        self.version = 0
+        self._lock = Lock()
+
+    def register_job(self, job):
+        with self._lock:
+            self.jobs.add(job)
+            self.dirty = True
+
+    def unregister_job(self, job):
+        version, capacities = self.get_capacities()
+        with self._lock:
+            self.jobs.discard(job)
+            try:
+                del self.quotas[job]
+                del self.shares[job]
+            except KeyError:
+                pass
+            woken = self.recompute(version, capacities)
+        for job in woken:
+            job.schedule()
+
+    def invalidate(self):
+        with self._lock:
+            self.dirty = True
+            self.version += 1
+
+    def is_stale(self):
+        return self.dirty or self.last_computed is None or time.time() - self.last_computed >= self.interval
+
+    def get_capacities(self):
+        # The worker pool calls invalidate() while holding its own lock, so
+        # the capacities must be read before self._lock is taken.
+        version = self.version
+        return version, self.worker_pool.get_scheduling_class_capacities()
+
+    def get_quota(self, job):
+        """Returns a dictionary mapping each scheduling class to the number of
+        slots that the job may occupy, or None if the job is not limited."""
+        # A stale answer without the lock only delays the recomputation
+        # until the next call.
+        if self.is_stale():
+            version, capacities = self.get_capacities()
+        else:
+            capacities = None
+        with self._lock:
+            if capacities is not None and self.is_stale():
+                woken = self.recompute(version, capacities)
+            else:
+                woken = []
+            try:
+                quota = self.quotas[job]
+            except KeyError:
+                quota = None
+        for other_job in woken:
+            if other_job is not job:
+                other_job.schedule()
+        return quota
+
+    def get_share(self, job):
+        with self._lock:
+            try:
+                return self.shares[job]
+            except KeyError:
+                return 0.0
+
+    def recompute(self, version, capacities):
+        # Called under self._lock, with the capacities that were read at
+        # version. Returns the jobs whose quota has grown.
+        self.dirty = self.version != version
+        self.last_computed = time.time()
+
+        demands = {}
+        weights = {}
+        for job in self.jobs:
+            demands[job] = job.get_slot_demand(capacities)
+            weights[job] = job.get_share_weight()
+
+        if self.policy == 'weighted':
+            allocations = {}
+            for job in self.jobs:
+                allocations[job] = {}
+            for scheduling_class, capacity in capacities.items():
+                class_demands = {}
+                for job in self.jobs:
+                    class_demands[job] = {scheduling_class : demands[job].get(scheduling_class, 0)}
+                class_allocations, _ = self.progressive_fill({scheduling_class : capacity}, class_demands, weights)
+                for job, allocation in class_allocations.items():
+                    allocations[job][scheduling_class] = allocation[scheduling_class]
+            remaining = {}
+            for scheduling_class, capacity in capacities.items():
+                remaining[scheduling_class] = capacity - sum([allocation[scheduling_class] for allocation in allocations.values()])
+        else:
+            allocations, remaining = self.progressive_fill(capacities, demands, weights)
+
+        woken = []
+        for job in self.jobs:
+            quota = {}
+            for scheduling_class in capacities:
+                quota[scheduling_class] = allocations[job].get(scheduling_class, 0) + remaining[scheduling_class]
+            try:
+                previous_quota = self.quotas[job]
+                if [c for c in quota if quota[c] > previous_quota.get(c, 0)]:
+                    woken.append(job)
+            except KeyError:
+                pass
+            self.quotas[job] = quota
+            self.shares[job] = self.dominant_share(allocations[job], capacities)
+
+        ciel.log('Recomputed fair shares for %d jobs' % len(self.jobs), 'FAIR_SHARE', logging.DEBUG)
+        return woken
+
+    def dominant_share(self, allocation, capacities):
+        share = 0.0
+        for scheduling_class, slots in allocation.items():
+            if capacities.get(scheduling_class, 0) > 0:
+                share = max(share, slots / float(capacities[scheduling_class]))
+        return share
+
+    def progressive_fill(self, capacities, demands, weights):
+        """Allocates one slot at a time to the job with the lowest weighted
+        dominant share, in the class where it has the most unmet demand.
+        Returns the allocations and the remaining capacity in each class."""
+        remaining = dict(capacities)
+        allocations = {}
+        unmet = {}
+        heap = []
+        for i, job in enumerate(demands):
+            allocations[job] = dict([(c, 0) for c in capacities])
+            unmet[job] = dict(demands[job])
+            heap.append((0.0, i, job))
+        heapq.heapify(heap)
+
+        while len(heap) > 0:
+            _, i, job = heapq.heappop(heap)
+            best_class = None
+            for scheduling_class, demand in unmet[job].items():
+                if demand > 0 and remaining.get(scheduling_class, 0) > 0:
+                    if best_class is None or demand > unmet[job][best_class]:
+                        best_class = scheduling_class
+            if best_class is None:
+                # This job cannot use any more slots.
+                continue
+            allocations[job][best_class] += 1
+            unmet[job][best_class] -= 1
+            remaining[best_class] -= 1
+            heapq.heappush(heap, (self.dominant_share(allocations[job], capacities) / weights[job], i, job))
+
+        return allocations, remaining
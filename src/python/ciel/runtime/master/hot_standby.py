@@ -11,10 +11,18 @@
 # WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+from __future__ import with_statement
 from urlparse import urljoin
+from ciel.public.wire_codec import CODEC_JSON, SUPPORTED_CODECS,\
+    encode_message, get_content_type, negotiate_codec
+from ciel.runtime.producer import ref_from_string
+from ciel.runtime.task_graph import TaskGraphUpdate
+import collections
 import httplib2
+import itertools
 import logging
 import simplejson
+import time
 
 from cherrypy.process import plugins
 from Queue import Queue, Empty
@@ -32,17 +40,21 @@ class MasterRecoveryMonitor(plugins.SimplePlugin):
     It operates as follows:
     
     1. The backup master registers with the primary master to receive journal
-       events.
+       events. The primary streams them to the backup as a sequence-numbered
+       replication log (see BackupSender).
        
     2. The backup periodically pings the master to find out if it has failed.
+       Meanwhile, it applies the replication log to its own job pool, and
+       acknowledges each record once it has been applied.
     
-    3. When the primary is deemed to have failed, the backup instructs the
-       workers to re-register with it.
+    3. When the primary is deemed to have failed, the backup replays the
+       records that it has received but not yet acknowledged, and instructs
+       the workers to re-register with it.
 
     4. The backup takes over at this point.
     '''
     
-    def __init__(self, bus, my_url, master_url, job_pool, ping_timeout=5):
+    def __init__(self, bus, my_url, master_url, job_pool, ping_timeout=5, apply_batch=1000, codecs=[CODEC_JSON]):
         plugins.SimplePlugin.__init__(self, bus)
         self.queue = Queue()
         self.non_urgent_queue = Queue()
@@ -50,16 +62,32 @@ class MasterRecoveryMonitor(plugins.SimplePlugin):
         self.is_primary = False
         self.is_connected = False
         self.is_running = False
+        self.is_applying = False
         
         self.thread = None
+        self.apply_thread = None
         self.my_url = my_url
         self.master_url = master_url
+        # The codecs that this backup accepts for the replication log.
+        self.codecs = codecs
         self.ping_timeout = ping_timeout
         
         self.job_pool = job_pool
         
         self._lock = threading.Lock()
         self.workers = set()
+
+        # The replication log from the primary. Records are received in
+        # sequence-number order, and acknowledged once they have been applied.
+        self.apply_batch = apply_batch
+        self.stream_first_seq = None
+        self.received_seq = 0
+        self.acked_seq = 0
+        self.pending_records = collections.deque()
+        self.records_applied = 0
+        self.frames_received = 0
+        self._log_cond = threading.Condition(threading.Lock())
+        self._apply_lock = threading.Lock()
                 
     def subscribe(self):
         self.bus.subscribe('start', self.start, 75)
@@ -76,6 +104,7 @@ class MasterRecoveryMonitor(plugins.SimplePlugin):
             self.is_running = True
             self.thread = threading.Thread(target=self.thread_main, args=())
             self.thread.start()
+            self.start_applying()
     
     def stop(self):
         if self.is_running:
@@ -83,13 +112,26 @@ class MasterRecoveryMonitor(plugins.SimplePlugin):
             self.queue.put(THREAD_TERMINATOR)
             self.thread.join()
             self.thread = None
+            self.stop_applying()
+
+    def start_applying(self):
+        self.is_applying = True
+        self.apply_thread = threading.Thread(target=self.apply_thread_main, args=())
+        self.apply_thread.start()
+
+    def stop_applying(self):
+        with self._log_cond:
+            self.is_applying = False
+            self._log_cond.notify_all()
+        self.apply_thread.join()
+        self.apply_thread = None
         
     def poke(self):
         self.queue.put(PINGER_POKER)
         
     def register_as_backup(self):
         h = httplib2.Http()
-        h.request(urljoin(self.master_url, '/backup/'), 'POST', simplejson.dumps(self.my_url))
+        h.request(urljoin(self.master_url, '/control/backup/'), 'POST', simplejson.dumps({'url' : self.my_url, 'codecs' : self.codecs}))
     
     def ping_master(self):
         h = httplib2.Http()
@@ -107,6 +149,113 @@ class MasterRecoveryMonitor(plugins.SimplePlugin):
         with self._lock:
             self.workers.add(worker)
     
+    def receive_frame(self, frame):
+        '''
+        Adds the records in a frame of the replication log to the pending
+        records, and returns the last sequence number received and the last
+        sequence number acknowledged.
+        '''
+        first_seq = frame['first']
+        if first_seq != self.stream_first_seq:
+            # The primary has (re-)registered this backup, and started a new
+            # stream. Finish applying the old one before renumbering.
+            if self.stream_first_seq is not None:
+                ciel.log('Primary master restarted the replication log at %d' % first_seq, 'MONITOR', logging.WARN)
+            self.apply_pending_records()
+            with self._log_cond:
+                self.stream_first_seq = first_seq
+                self.received_seq = first_seq - 1
+                self.acked_seq = first_seq - 1
+
+        with self._log_cond:
+            self.frames_received += 1
+            for record in frame['records']:
+                seq = record[0]
+                if seq == self.received_seq + 1:
+                    self.pending_records.append(record)
+                    self.received_seq = seq
+                elif seq > self.received_seq + 1:
+                    # The primary will resend from the last record received.
+                    ciel.log('Gap in the replication log: expected %d, got %d' % (self.received_seq + 1, seq), 'MONITOR', logging.WARN)
+                    break
+            self._log_cond.notify_all()
+            return self.received_seq, self.acked_seq
+
+    def apply_record(self, record):
+        record_type = record[0]
+        if record_type == 'P':
+            _, job_id, task_id, refs = record
+            job = self.job_pool.get_job_by_id(job_id)
+            try:
+                task = job.task_graph.get_task(task_id)
+            except KeyError:
+                task = None
+            tx = TaskGraphUpdate()
+            for ref in refs:
+                tx.publish(ref, task)
+            tx.commit(job.task_graph)
+        elif record_type == 'J':
+            _, job_id, root_task_descriptor, job_options = record
+            job = self.job_pool.create_job_for_task(root_task_descriptor, job_options, job_id=job_id)
+            ciel.log('Registering job, but not starting it: %s' % job.id, 'MONITOR', logging.INFO)
+        elif record_type == 'W':
+            self.add_worker(record[1]['netloc'])
+        elif record_type == 'D':
+            ref_from_string(record[2], record[1])
+        else:
+            raise ValueError('Invalid record type in the replication log: %r' % (record_type, ))
+
+    def apply_pending_records(self, max_records=None):
+        '''
+        Applies up to max_records pending records (or all of them, if
+        max_records is None), and acknowledges them. Returns the number of
+        records applied.
+        '''
+        with self._apply_lock:
+            with self._log_cond:
+                if max_records is None:
+                    num_records = len(self.pending_records)
+                else:
+                    num_records = min(max_records, len(self.pending_records))
+                records = [self.pending_records.popleft() for _ in range(num_records)]
+            if len(records) == 0:
+                return 0
+            for seq, _, record in records:
+                try:
+                    self.apply_record(record)
+                except:
+                    ciel.log('Error applying record %d of the replication log' % seq, 'MONITOR', logging.WARN, True)
+            with self._log_cond:
+                self.acked_seq = records[-1][0]
+                self.records_applied += len(records)
+            return len(records)
+
+    def apply_thread_main(self):
+        while True:
+            with self._log_cond:
+                while self.is_applying and len(self.pending_records) == 0:
+                    self._log_cond.wait()
+                if not self.is_applying:
+                    return
+            self.apply_pending_records(self.apply_batch)
+
+    def get_replication_metrics(self):
+        with self._log_cond:
+            if len(self.pending_records) > 0:
+                # Measured against the primary's clock.
+                apply_lag = time.time() - self.pending_records[0][1]
+            else:
+                apply_lag = 0.0
+            return {'primary' : self.master_url,
+                    'is_primary' : self.is_primary,
+                    'first_seq' : self.stream_first_seq,
+                    'received_seq' : self.received_seq,
+                    'acked_seq' : self.acked_seq,
+                    'lag_records' : len(self.pending_records),
+                    'lag_seconds' : apply_lag,
+                    'frames_received' : self.frames_received,
+                    'records_applied' : self.records_applied}
+
     def notify_all_workers(self):
         master_details = simplejson.dumps({'master' : self.my_url})
         with self._lock:
@@ -161,69 +310,239 @@ class MasterRecoveryMonitor(plugins.SimplePlugin):
         if not self.is_running:
             return
         
+        # Everything up to the last acknowledged record has already been
+        # applied, so only the remainder of the log must be replayed.
+        replayed = self.apply_pending_records()
+        ciel.log('Replayed %d unacknowledged records from the replication log (last record %d)' % (replayed, self.acked_seq), 'MONITOR', logging.INFO)
+        
         # This master is now the primary.
         self.is_primary = True
         
         self.job_pool.start_all_jobs()
         self.notify_all_workers()
+
+class ReplicationStream:
+    '''
+    The state of the replication log at one backup master.
+    '''
+    
+    def __init__(self, url, first_seq, codec):
+        self.url = url
+        self.first_seq = first_seq
+        self.codec = codec
+        # Records up to sent_seq have been received by the backup, and records
+        # up to acked_seq have been applied.
+        self.sent_seq = first_seq - 1
+        self.acked_seq = first_seq - 1
+        self.last_send_time = 0.0
+        self.retry_time = 0.0
+        self.errors = 0
+        self.frames = 0
+        self.bytes = 0
+        # Reused for every frame, so that the connection is kept alive.
+        self.http = httplib2.Http()
             
 class BackupSender:
+    '''
+    Streams a replication log to the backup masters.
+
+    Each call to publish_refs(), add_worker(), add_job() or add_data() appends
+    a sequence-numbered record to an in-memory window. A sender thread sends
+    the records to each backup in frames of up to max_batch records over a
+    persistent connection, and does not wait for a frame to be applied before
+    sending the next one. The backup acknowledges records once it has applied
+    them, and they leave the window once every backup has acknowledged them.
+    When the window holds max_window records, callers block until the backups
+    catch up.
+    '''
     
-    def __init__(self, bus):
+    def __init__(self, bus, max_window=100000, max_batch=1000, ack_interval=0.1, max_errors=3, codecs=SUPPORTED_CODECS):
         self.bus = bus
-        self.standby_urls = set()
-        self.queue = Queue()
+        self.max_window = max_window
+        self.max_batch = max_batch
+        self.ack_interval = ack_interval
+        self.max_errors = max_errors
+        # The codecs that this master may use, in order of preference. Each
+        # stream uses the first one that its backup accepts.
+        self.codecs = codecs
+
+        # Mapping from backup URL to ReplicationStream.
+        self.streams = {}
+
+        # The records that have not been acknowledged by every backup, as
+        # (sequence number, timestamp, record) tuples.
+        self.window = collections.deque()
+        self.next_seq = 1
+
+        self.records_sent = 0
+        self.frames_sent = 0
+        self.blocked_time = 0.0
+        self.last_full_warning_time = 0.0
+        self.dropped_streams = 0
+
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
         
+        self.thread = None
         self.is_running = False
         self.is_logging = False
     
-    def register_standby_url(self, url):
-        self.is_logging = True
-        self.queue.put(('U', url))
+    def register_standby_url(self, url, codecs=[CODEC_JSON]):
+        with self._lock:
+            if url in self.streams:
+                ciel.log('Backup master %s registered again' % url, 'BACKUP_SENDER', logging.WARN)
+            # The backup receives the records that are appended from now on.
+            self.streams[url] = ReplicationStream(url, self.next_seq, negotiate_codec(self.codecs, codecs))
+            self.is_logging = True
+            self._trim_window()
 
-    def publish_refs(self, task_id, ref):
+    def publish_refs(self, job_id, task_id, refs):
         if not self.is_logging:
             return
-        self.queue.put(('P', task_id, ref))
+        self.append_record(('P', job_id, task_id, refs))
         
-    def add_worker(self, worker_netloc):
+    def add_worker(self, worker_descriptor):
         if not self.is_logging:
             return
-        self.queue.put(('W', worker_netloc))
+        self.append_record(('W', worker_descriptor))
         
-    def add_job(self, id, root_task_descriptor):
+    def add_job(self, id, root_task_descriptor, job_options):
         if not self.is_logging:
             return
-        self.queue.put(('J', id, root_task_descriptor))
+        self.append_record(('J', id, root_task_descriptor, job_options))
         
     def add_data(self, id, data):
         if not self.is_logging:
             return
-        self.queue.put(('D', id, data))
+        self.append_record(('D', id, data))
 
-    def do_publish_refs(self, task_id, ref):
-        for url in self.standby_urls:
-            spawn_url = urljoin(url, '/task/%s/publish' % task_id)
-            h = httplib2.Http()
-            h.request(spawn_url, 'POST', ref)        
+    def append_record(self, record):
+        with self._lock:
+            if len(self.window) >= self.max_window:
+                start = time.time()
+                if start - self.last_full_warning_time >= 10.0:
+                    ciel.log('Replication window is full: waiting for backup masters to catch up', 'BACKUP_SENDER', logging.WARN)
+                    self.last_full_warning_time = start
+                while self.is_running and len(self.streams) > 0 and len(self.window) >= self.max_window:
+                    self._cond.wait()
+                self.blocked_time += time.time() - start
+            if len(self.streams) == 0:
+                return
+            self.window.append((self.next_seq, time.time(), record))
+            self.next_seq += 1
+            self._cond.notify_all()
 
-    def do_add_job(self, id, root_task_descriptor):
-        for url in self.standby_urls:
-            spawn_url = urljoin(url, '/job/%s' % id)
-            h = httplib2.Http()
-            h.request(spawn_url, 'POST', root_task_descriptor)
-            
-    def do_add_data(self, id, data):
-        for url in self.standby_urls:
-            spawn_url = urljoin(url, '/data/%s' % id)
-            h = httplib2.Http()
-            h.request(spawn_url, 'POST', data)        
-        
-    def do_add_worker(self, worker_descriptor):
-        for url in self.standby_urls:
-            spawn_url = urljoin(url, '/worker/')
-            h = httplib2.Http()
-            h.request(spawn_url, 'POST', worker_descriptor)
+    def _trim_window(self):
+        # Called under self._lock.
+        if len(self.streams) > 0:
+            min_acked_seq = min([stream.acked_seq for stream in self.streams.values()])
+        else:
+            min_acked_seq = self.next_seq - 1
+        while len(self.window) > 0 and self.window[0][0] <= min_acked_seq:
+            self.window.popleft()
+        self._cond.notify_all()
+
+    def _drop_stream(self, stream):
+        # Called under self._lock.
+        if self.streams.get(stream.url) is stream:
+            del self.streams[stream.url]
+            self.dropped_streams += 1
+            self.is_logging = len(self.streams) > 0
+            self._trim_window()
+
+    def _get_frames(self):
+        # Called under self._lock.
+        now = time.time()
+        if len(self.window) > 0:
+            window_first_seq = self.window[0][0]
+        else:
+            window_first_seq = self.next_seq
+        frames = []
+        for stream in self.streams.values():
+            if now < stream.retry_time:
+                continue
+            elif stream.sent_seq + 1 < self.next_seq:
+                start = stream.sent_seq + 1 - window_first_seq
+                frames.append((stream, list(itertools.islice(self.window, start, start + self.max_batch))))
+            elif stream.acked_seq < stream.sent_seq and now - stream.last_send_time >= self.ack_interval:
+                # Poll for acknowledgements of the records already sent.
+                frames.append((stream, []))
+        return frames
+
+    def post_frame(self, stream, message):
+        response, content = stream.http.request(urljoin(stream.url, '/control/backup/replicate'), 'POST', message, headers={'Content-Type': get_content_type(stream.codec)})
+        if response['status'] != '200':
+            raise Exception('Got status %s from backup master' % response['status'])
+        received_seq, acked_seq = simplejson.loads(content)
+        return received_seq, acked_seq
+
+    def send_frame(self, stream, records):
+        message = encode_message({'first' : stream.first_seq, 'records' : records}, stream.codec)
+        try:
+            received_seq, acked_seq = self.post_frame(stream, message)
+        except:
+            with self._lock:
+                stream.errors += 1
+                if stream.errors >= self.max_errors:
+                    ciel.log('Error streaming the replication log to %s: dropping the backup master' % stream.url, 'BACKUP_SENDER', logging.ERROR, True)
+                    self._drop_stream(stream)
+                else:
+                    ciel.log('Error streaming the replication log to %s' % stream.url, 'BACKUP_SENDER', logging.WARN, True)
+                    stream.retry_time = time.time() + stream.errors * self.ack_interval
+            return
+        with self._lock:
+            if received_seq < stream.acked_seq:
+                # The records that the backup is missing may have left the
+                # window, so it must register again to start a new stream.
+                ciel.log('Backup master %s has lost records that it acknowledged: dropping it' % stream.url, 'BACKUP_SENDER', logging.ERROR)
+                self._drop_stream(stream)
+                return
+            stream.errors = 0
+            stream.last_send_time = time.time()
+            stream.frames += 1
+            stream.bytes += len(message)
+            self.frames_sent += 1
+            self.records_sent += len(records)
+            # The next frame starts after the last record that the backup has
+            # received, which skips nothing and resends nothing in the common
+            # case.
+            stream.sent_seq = received_seq
+            if acked_seq > stream.acked_seq:
+                stream.acked_seq = acked_seq
+                self._trim_window()
+
+    def get_metrics(self):
+        with self._lock:
+            now = time.time()
+            if len(self.window) > 0:
+                window_first_seq = self.window[0][0]
+            else:
+                window_first_seq = self.next_seq
+            standbys = []
+            for stream in self.streams.values():
+                lag_records = self.next_seq - 1 - stream.acked_seq
+                if lag_records > 0:
+                    lag_seconds = now - self.window[stream.acked_seq + 1 - window_first_seq][1]
+                else:
+                    lag_seconds = 0.0
+                standbys.append({'url' : stream.url,
+                                 'codec' : stream.codec,
+                                 'first_seq' : stream.first_seq,
+                                 'sent_seq' : stream.sent_seq,
+                                 'acked_seq' : stream.acked_seq,
+                                 'lag_records' : lag_records,
+                                 'lag_seconds' : lag_seconds,
+                                 'frames' : stream.frames,
+                                 'bytes' : stream.bytes})
+            return {'last_seq' : self.next_seq - 1,
+                    'window' : len(self.window),
+                    'max_window' : self.max_window,
+                    'max_batch' : self.max_batch,
+                    'records_sent' : self.records_sent,
+                    'frames_sent' : self.frames_sent,
+                    'blocked_time' : self.blocked_time,
+                    'dropped_standbys' : self.dropped_streams,
+                    'standbys' : standbys}
         
     def subscribe(self):
         self.bus.subscribe('start', self.start, 75)
@@ -241,8 +560,9 @@ class BackupSender:
     
     def stop(self):
         if self.is_running:
-            self.is_running = False
-            self.queue.put(THREAD_TERMINATOR)
+            with self._lock:
+                self.is_running = False
+                self._cond.notify_all()
             self.thread.join()
             self.thread = None
             
@@ -250,30 +570,14 @@ class BackupSender:
         
         while True:
             
-            # While not connected, attempt to register as a backup master.
-            while self.is_running:
-
-                try:
-                    maybe_terminator = self.queue.get(block=True)
-                    if not self.is_running or maybe_terminator is THREAD_TERMINATOR:
+            with self._lock:
+                while True:
+                    if not self.is_running:
                         return
-                except Empty:
-                    pass
-                
-                log_entry = maybe_terminator
-                
-                try:
-                    if log_entry[0] == 'U':
-                        self.standby_urls.add(log_entry[1])
-                    elif log_entry[0] == 'P':
-                        self.do_publish_refs(log_entry[1], log_entry[2])
-                    elif log_entry[0] == 'W':
-                        self.do_add_worker(log_entry[1])
-                    elif log_entry[0] == 'J':
-                        self.do_add_job(log_entry[1], log_entry[2])
-                    elif log_entry[0] == 'D':
-                        self.do_add_data(log_entry[1], log_entry[2])
-                    else:
-                        raise
-                except:
-                    ciel.log('Error passing log to backup master.', 'BACKUP_SENDER', logging.WARN, True)
+                    frames = self._get_frames()
+                    if len(frames) > 0:
+                        break
+                    self._cond.wait(self.ack_interval)
+
+            for stream, records in frames:
+                self.send_frame(stream, records)
@@ -12,25 +12,30 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 from cherrypy.process import plugins
-from ciel.public.references import SWReferenceJSONEncoder
+from ciel.public.references import SWReferenceJSONEncoder,\
+    json_decode_object_hook
 from ciel.runtime.task import TASK_STATES, TASK_STATE_NAMES, \
     build_taskpool_task_from_descriptor, TASK_QUEUED, TASK_FAILED,\
-    TASK_COMMITTED, TASK_QUEUED_STREAMING
+    TASK_COMMITTED, TASK_QUEUED_STREAMING, TASK_ASSIGNED, get_task_history,\
+    event_time, FULL_TASK_HISTORY, NO_CHILDREN
 from threading import Lock, Condition
 import Queue
 import ciel
-import datetime
 import logging
 import os
 import simplejson
-import struct
 import time
 import uuid
 from ciel.runtime.task_graph import DynamicTaskGraph, TaskGraphUpdate
-from ciel.public.references import SWErrorReference
-from ciel.runtime.master.scheduling_policy import LocalitySchedulingPolicy,\
-    get_scheduling_policy
+from ciel.public.references import SWErrorReference, SW2_ConcreteReference,\
+    SW2_TombstoneReference, SW2_FutureReference
+from ciel.runtime.master.scheduling_policy import get_scheduling_policy
+from ciel.runtime.master.fair_share import FairShareAllocator
+from ciel.runtime.master.journal_writer import JournalWriter,\
+    RECORD_HEADER_STRUCT, get_journal_segment_filename, get_journal_segments,\
+    get_checkpoint_filename, get_retired_tasks_filename
 import collections
+import heapq
 
 JOB_CREATED = -1
 JOB_ACTIVE = 0
@@ -52,7 +57,9 @@ JOB_STATE_NAMES = {}
 for (name, number) in JOB_STATES.items():
     JOB_STATE_NAMES[number] = name
 
-RECORD_HEADER_STRUCT = struct.Struct('!cI')
+# Bandwidth (in bytes per second) assumed for a netloc before any fetches
+# from it have been observed.
+DEFAULT_FETCH_BANDWIDTH = 100000000.0
 
 class Job:
     
@@ -74,6 +81,7 @@ class Job:
         self.result_ref = None
 
         self.task_journal_fp = None
+        self.journal_segment = 0
 
         self.journal = journal
 
@@ -86,12 +94,23 @@ class Job:
 
         # Start journalling immediately to capture the root task.
         if self.journal and self.task_journal_fp is None and self.job_dir is not None:
-            self.task_journal_fp = open(os.path.join(self.job_dir, 'task_journal'), 'wb')
+            self.task_journal_fp = open(get_journal_segment_filename(self.job_dir, 0), 'wb')
 
 
         self._lock = Lock()
         self._condition = Condition(self._lock)
 
+        # How much of each task's event history to keep: 'full', 'ring:N'
+        # (the last N events) or 'counters-only' (none, but the counters
+        # below are always maintained).
+        try:
+            self.task_history = get_task_history(self.job_options['task_history'])
+        except KeyError:
+            self.task_history = FULL_TASK_HISTORY
+        except ValueError, e:
+            ciel.log('Ignoring task history option for job %s: %s' % (self.id, e), 'JOB', logging.WARNING)
+            self.task_history = FULL_TASK_HISTORY
+
         # Counters for each task state.
         self.task_state_counts = {}
         for state in TASK_STATES.values():
@@ -99,6 +118,10 @@ class Job:
 
         self.all_tasks = RunningAverage()
         self.all_tasks_by_type = {}
+        
+        # Total bytes fetched from, and time spent fetching from, each netloc.
+        self.fetch_bytes = {}
+        self.fetch_time = {}
 
         try:
             sched_opts = self.job_options["sched_opts"]
@@ -106,99 +129,676 @@ class Job:
             sched_opts = {}
 
         try:
-            self.scheduling_policy = get_scheduling_policy(self.job_options['scheduler'], **sched_opts)
+            scheduler = self.job_options['scheduler']
         except KeyError:
-            self.scheduling_policy = LocalitySchedulingPolicy()
+            scheduler = None
+        self.scheduling_policy = get_scheduling_policy(scheduler, **sched_opts)
             
         try:
             self.journal_sync_buffer = self.job_options['journal_sync_buffer']
         except KeyError:
             self.journal_sync_buffer = None
         self.journal_sync_counter = 0
+
+        # Every journal_checkpoint_interval records (or, for a large task
+        # graph, every record for each task in the graph), a checkpoint of
+        # the task graph is written, and the journal starts a new segment, so
+        # that recovery does not have to replay the whole journal.
+        try:
+            self.journal_checkpoint_interval = self.job_options['journal_checkpoint_interval']
+        except KeyError:
+            self.journal_checkpoint_interval = 100000
+        self.journal_records_since_checkpoint = 0
+        self.checkpoint_count = 0
         
         self.task_graph = JobTaskGraph(self, self.runnable_queue)
         
         self.workers = {}
         
+        # Indices used by the incremental scheduler: the (worker, class) pairs
+        # that have changed since the last pass, the workers with free slots
+        # in each class, and the classes with a non-empty global queue.
+        try:
+            self.incremental_schedule = self.job_options['incremental_schedule']
+        except KeyError:
+            self.incremental_schedule = True
+        self.pending_worker_classes = set()
+        self.free_slots = {}
+        self.nonempty_global_classes = set()
+
+        # Tasks assigned during a scheduling pass are sent to each worker in
+        # a single request, unless batching is disabled.
+        try:
+            self.batch_dispatch = self.job_options['batch_dispatch']
+        except KeyError:
+            self.batch_dispatch = True
+        self.dispatch_batches = {}
+        
+        # Tasks waiting for a local slot under delay scheduling, as a heap of
+        # (release time, sequence number, task). Released tasks move to the
+        # global queue, where any worker may steal them.
+        self.delayed_tasks = []
+        self.delayed_task_seq = 0
+        self.delay_timer_at = None
+        
+        self.locality_hits = 0
+        self.locality_misses = 0
+        
+        # Slots occupied and tasks waiting in each scheduling class, and the
+        # number of slots that the job pool allows this job to occupy.
+        try:
+            self.share_weight = float(self.job_options['share_weight'])
+        except KeyError:
+            self.share_weight = 1.0
+        self.slot_usage = {}
+        self.waiting_by_class = {}
+        self.slot_quota = None
+        self.quota_blocked = set()
+        
+        # Speculative execution: a task that has been assigned for longer
+        # than speculation_factor times the mean runtime of its type (and at
+        # least speculation_min_runtime seconds) is copied to an idle worker.
+        try:
+            self.speculation = self.job_options['speculation']
+        except KeyError:
+            self.speculation = False
+        try:
+            self.speculation_factor = float(self.job_options['speculation_factor'])
+        except KeyError:
+            self.speculation_factor = 2.0
+        try:
+            self.speculation_min_runtime = float(self.job_options['speculation_min_runtime'])
+        except KeyError:
+            self.speculation_min_runtime = 10.0
+        try:
+            self.speculation_min_samples = int(self.job_options['speculation_min_samples'])
+        except KeyError:
+            self.speculation_min_samples = 3
+        try:
+            self.speculation_interval = float(self.job_options['speculation_interval'])
+        except KeyError:
+            self.speculation_interval = 5.0
+        self.speculation_timer_armed = False
+        self.speculative_launches = 0
+        self.speculative_wins = 0
+        
+        # Worker-to-worker stealing: a worker with a free slot may take a
+        # task from another worker's queue in the same class when the time
+        # that the task would wait there exceeds the time to fetch the inputs
+        # that it would give up, multiplied by worker_steal_locality_weight.
+        try:
+            self.worker_steal = self.job_options['worker_steal']
+        except KeyError:
+            self.worker_steal = True
+        try:
+            self.worker_steal_locality_weight = float(self.job_options['worker_steal_locality_weight'])
+        except KeyError:
+            self.worker_steal_locality_weight = 1.0
+        try:
+            self.worker_steal_scan = int(self.job_options['worker_steal_scan'])
+        except KeyError:
+            self.worker_steal_scan = 8
+        self.queued_worker_classes = set()
+        self.worker_steals = collections.deque(maxlen=1000)
+        self.worker_steal_count = 0
+        self.worker_steal_bytes_lost = 0
+        
+        # Garbage collection of the task graph: once the graph holds at least
+        # task_graph_gc_threshold tasks, and has doubled in size since the
+        # last collection, committed tasks and references that the job no
+        # longer needs are retired. Retired tasks are written to a file in
+        # the job directory, if there is one, so that they can still be
+        # browsed.
+        try:
+            self.task_graph_gc = self.job_options['task_graph_gc']
+        except KeyError:
+            self.task_graph_gc = False
+        try:
+            self.task_graph_gc_threshold = int(self.job_options['task_graph_gc_threshold'])
+        except KeyError:
+            self.task_graph_gc_threshold = 10000
+        try:
+            self.task_graph_gc_spill = self.job_options['task_graph_gc_spill']
+        except KeyError:
+            self.task_graph_gc_spill = True
+        self.task_graph_gc_live_tasks = 0
+        self.retired_task_count = 0
+        self.retired_ref_count = 0
+        self.retired_task_fp = None
+        # Mapping from task ID to the offset of a retired task's record.
+        self.retired_task_offsets = {}
+
+        # Cross-job memoization: if the job pool has a memo table, tasks that
+        # have already committed in a previous job are not run again, unless
+        # the job opts out.
+        try:
+            memoize = self.job_options['memoize']
+        except KeyError:
+            memoize = True
+        if memoize:
+            self.memo_table = self.job_pool.memo_table
+        else:
+            self.memo_table = None
+        self.memoized_task_count = 0
         
     def restart_journalling(self):
         # Assume that the recovery process has truncated the file to the previous record boundary.
         if self.task_journal_fp is None and self.job_dir is not None:
-            self.task_journal_fp = open(os.path.join(self.job_dir, 'task_journal'), 'ab')
+            segments = get_journal_segments(self.job_dir)
+            if len(segments) > 0:
+                self.journal_segment = segments[-1][0]
+            self.task_journal_fp = open(get_journal_segment_filename(self.job_dir, self.journal_segment), 'ab')
         
     def schedule(self):
-        self.job_pool.deferred_worker.do_deferred(lambda: self._schedule())
+        self.job_pool.deferred_worker.do_deferred(lambda: self._schedule(), self.id)
         
     def _schedule(self):
+        self.slot_quota = self.job_pool.get_slot_quota(self)
+        if self.incremental_schedule:
+            self._schedule_incremental()
+        else:
+            self._schedule_sweep()
+
+    def _assign_runnable_tasks(self):
+        # Called under self._lock.
+        unassigned_tasks = []
+        while True:
+            try:
+                task = self.runnable_queue.get_nowait()
+                task.queued_at = time.time()
+                unassigned = True
+                self.assign_scheduling_class_to_task(task)
+                workers = self.select_workers_for_task(task)
+                for worker in workers:
+                    if worker is None:
+                        continue
+                    ciel.log('Adding task %s to queue for worker %s' % (task.task_id, worker.id), 'SCHED', logging.DEBUG)
+                    self.queue_task_on_worker(task, worker)
+                    unassigned = False
+                if task.get_constrained_location() is None:
+                    if task.locality_delay > 0 and not unassigned:
+                        self.push_task_on_delayed_queue(task)
+                    else:
+                        self.push_task_on_global_queue(task)
+                    unassigned = False
+                if unassigned:
+                    ciel.log('No workers available for task %s' % task.task_id, 'SCHED', logging.WARNING)
+                    unassigned_tasks.append(task)
+            except Queue.Empty:
+                break
+
+        # If we have unassigned tasks, put them back on the queue for the next schedule.
+        for task in unassigned_tasks:
+            self.runnable_queue.put(task)
+
+        self.release_delayed_tasks()
+
+    def push_task_on_delayed_queue(self, task):
+        # Called under self._lock.
+        heapq.heappush(self.delayed_tasks, (task.queued_at + task.locality_delay, self.delayed_task_seq, task))
+        self.delayed_task_seq += 1
+
+    def release_delayed_tasks(self):
+        # Called under self._lock.
+        now = time.time()
+        if self.delay_timer_at is not None and self.delay_timer_at <= now:
+            self.delay_timer_at = None
         
-        ciel.log('Beginning to schedule job %s' % self.id, 'JOB', logging.DEBUG)
+        while len(self.delayed_tasks) > 0 and self.delayed_tasks[0][0] <= now:
+            release_at, _, task = heapq.heappop(self.delayed_tasks)
+            # Ignore stale entries for tasks that have since run, or been requeued.
+            if task.state in (TASK_QUEUED, TASK_QUEUED_STREAMING) and release_at == task.queued_at + task.locality_delay:
+                ciel.log('Task %s waited %f seconds for a local slot' % (task.task_id, now - task.queued_at), 'SCHED', logging.DEBUG)
+                self.push_task_on_global_queue(task)
         
+        # Make sure that we reschedule when the next delayed task is released.
+        if len(self.delayed_tasks) > 0:
+            next_release = self.delayed_tasks[0][0]
+            if self.delay_timer_at is None or next_release < self.delay_timer_at:
+                self.delay_timer_at = next_release
+                self.job_pool.deferred_worker.do_deferred_after(next_release - now, self._schedule, self.id)
+
+    def _execute_task_on_worker(self, task, worker, wstate, stolen=False):
+        task.set_worker(worker)
+        wstate.assign_task(task)
+        eff_class = worker.get_effective_scheduling_class(task.scheduling_class)
+        self.slot_usage[eff_class] = self.slot_usage.get(eff_class, 0) + 1
+        if task.queued_at is not None:
+            task.sched_wait += time.time() - task.queued_at
+        if stolen:
+            task.locality_misses += 1
+            self.locality_misses += 1
+        else:
+            task.locality_hits += 1
+            self.locality_hits += 1
+        task.assigned_at = time.time()
+        if stolen:
+            ciel.log('Executing task %s on worker %s (STOLEN)' % (task.task_id, worker.id), 'SCHED', logging.DEBUG)
+        else:
+            ciel.log('Executing task %s on worker %s' % (task.task_id, worker.id), 'SCHED', logging.DEBUG)
+        self._dispatch_task(task, worker)
+
+    def _dispatch_task(self, task, worker):
+        # Called under self._lock.
+        if self.batch_dispatch:
+            try:
+                self.dispatch_batches[worker].append(task)
+            except KeyError:
+                self.dispatch_batches[worker] = [task]
+        else:
+            self.job_pool.worker_pool.execute_task_on_worker(worker, task)
+
+    def _launch_speculative_copy(self, task, worker):
+        # Called under self._lock.
+        self.workers[worker].assign_task(task)
+        eff_class = worker.get_effective_scheduling_class(task.scheduling_class)
+        self.slot_usage[eff_class] = self.slot_usage.get(eff_class, 0) + 1
+        task.add_speculative_worker(worker)
+        self.speculative_launches += 1
+        self.mark_worker_pending(worker, task.scheduling_class)
+        ciel.log('Executing speculative copy of task %s on worker %s' % (task.task_id, worker.id), 'SCHED', logging.INFO)
+        self._dispatch_task(task, worker)
+
+    def drop_task_copy(self, task, worker):
+        """Forgets the copy of the task running on the given worker. Returns
+        True if another copy of the task is still running."""
+        # Called under self._lock.
+        if worker in task.speculative_workers:
+            task.speculative_workers.remove(worker)
+            return True
+        elif task.worker is worker and len(task.speculative_workers) > 0:
+            task.worker = task.speculative_workers.pop()
+            return True
+        return False
+
+    def arm_speculation_timer(self):
+        # Called under self._lock.
+        if self.speculation and not self.speculation_timer_armed:
+            self.speculation_timer_armed = True
+            self.job_pool.deferred_worker.do_deferred_after(self.speculation_interval, self._check_for_stragglers, self.id)
+
+    def is_straggler(self, task, now):
+        if task.state != TASK_ASSIGNED or task.assigned_at is None or len(task.speculative_workers) > 0:
+            return False
+        try:
+            runtimes = self.all_tasks_by_type[task.get_type()]
+        except KeyError:
+            return False
+        if runtimes.count < self.speculation_min_samples:
+            return False
+        return now - task.assigned_at > max(self.speculation_min_runtime, self.speculation_factor * runtimes.get())
+
+    def select_backup_worker(self, task):
+        # Called under self._lock. Chooses the least-loaded worker with a free
+        # slot for the task, other than the one already running it.
+        best_worker = None
+        best_load = None
+        for worker, wstate in self.workers.items():
+            if worker is task.worker or worker.failed:
+                continue
+            eff_class = worker.get_effective_scheduling_class(task.scheduling_class)
+            if wstate.tasks_assigned_in_class(eff_class) >= worker.get_effective_scheduling_class_capacity(eff_class):
+                continue
+            if not self.has_slot_quota(eff_class):
+                continue
+            load = wstate.load(eff_class, True)
+            if best_worker is None or load < best_load:
+                best_worker = worker
+                best_load = load
+        return best_worker
+
+    def _check_for_stragglers(self):
         with self._lock:
+            self.speculation_timer_armed = False
+            if self.state != JOB_ACTIVE:
+                return
             
-            # 1. Assign runnable tasks to worker queues.
-            unassigned_tasks = []
-            while True:
-                try:
-                    task = self.runnable_queue.get_nowait()
-                    unassigned = True
-                    self.assign_scheduling_class_to_task(task)
-                    workers = self.select_workers_for_task(task)
-                    for worker in workers:
-                        if worker is None:
-                            continue
-                        ciel.log('Adding task %s to queue for worker %s' % (task.task_id, worker.id), 'SCHED', logging.DEBUG)
-                        self.workers[worker].queue_task(task)
-                        unassigned = False
-                    if task.get_constrained_location() is None:
-                        self.push_task_on_global_queue(task)
-                        unassigned = False
-                    if unassigned:
-                        ciel.log('No workers available for task %s' % task.task_id, 'SCHED', logging.WARNING)
-                        unassigned_tasks.append(task)
-                except Queue.Empty:
+            now = time.time()
+            stragglers = []
+            for worker, wstate in self.workers.items():
+                for assigned in wstate.assigned_tasks.values():
+                    for task in assigned:
+                        if task.worker is worker and self.is_straggler(task, now):
+                            stragglers.append(task)
+            
+            for task in stragglers:
+                backup_worker = self.select_backup_worker(task)
+                if backup_worker is None:
                     break
+                ciel.log('Task %s has been running for %f seconds' % (task.task_id, now - task.assigned_at), 'SCHED', logging.INFO)
+                self._launch_speculative_copy(task, backup_worker)
+            
+            self._dispatch_batches()
+            self.arm_speculation_timer()
+
+    def _dispatch_batches(self):
+        # Called under self._lock, at the end of a scheduling pass.
+        batches = self.dispatch_batches
+        self.dispatch_batches = {}
+        for worker, tasks in batches.items():
+            ciel.log('Dispatching %d tasks to worker %s' % (len(tasks), worker.id), 'SCHED', logging.DEBUG)
+            self.job_pool.worker_pool.execute_tasks_on_worker(worker, tasks)
+
+    def _fill_from_worker_queue(self, worker, wstate, scheduling_class, capacity):
+        """Assigns tasks from the worker's own queue until the class is full or
+        the queue is empty. Returns the number of tasks assigned and the
+        remaining number of free slots."""
+        num_assigned = wstate.tasks_assigned_in_class(scheduling_class)
+        total_assigned = 0
+        while num_assigned < capacity:
+            if not self.has_slot_quota(scheduling_class):
+                self.quota_blocked.add((worker, scheduling_class))
+                break
+            task = wstate.pop_task_from_queue(scheduling_class)
+            if task is None:
+                break
+            elif task.state not in (TASK_QUEUED, TASK_QUEUED_STREAMING):
+                continue
+            self._execute_task_on_worker(task, worker, wstate)
+            num_assigned += 1
+            total_assigned += 1
+        return total_assigned, capacity - num_assigned
 
-            # 1a. If we have unassigned tasks, put them back on the queue for the next schedule.
-            for task in unassigned_tasks:
-                self.runnable_queue.put(task)
+    def _schedule_sweep(self):
+        
+        ciel.log('Beginning to schedule job %s' % self.id, 'JOB', logging.DEBUG)
+        
+        with self._lock:
+            
+            # 1. Assign runnable tasks to worker queues.
+            self._assign_runnable_tasks()
             
             # 2. For each worker, check if we need to assign any tasks.
             total_assigned = 0
             undersubscribed_worker_classes = []
             for worker, wstate in self.workers.items():
                 for scheduling_class, capacity in worker.scheduling_classes.items():
-                    num_assigned = wstate.tasks_assigned_in_class(scheduling_class)
-                    while num_assigned < capacity:
-                        task = wstate.pop_task_from_queue(scheduling_class)
-                        if task is None:
-                            break
-                        elif task.state not in (TASK_QUEUED, TASK_QUEUED_STREAMING):
-                            continue
-                        task.set_worker(worker)
-                        wstate.assign_task(task)
-                        ciel.log('Executing task %s on worker %s' % (task.task_id, worker.id), 'SCHED', logging.DEBUG)
-                        self.job_pool.worker_pool.execute_task_on_worker(worker, task)
-                        num_assigned += 1
-                        total_assigned += 1
-                    if num_assigned < capacity:
-                        undersubscribed_worker_classes.append((worker, scheduling_class, capacity - num_assigned))
+                    num_assigned, deficit = self._fill_from_worker_queue(worker, wstate, scheduling_class, capacity)
+                    total_assigned += num_assigned
+                    if deficit > 0:
+                        undersubscribed_worker_classes.append((worker, scheduling_class, deficit))
 
             for worker, scheduling_class, deficit in undersubscribed_worker_classes:
                 num_global_assigned = 0
-                while num_global_assigned < deficit:
+                while num_global_assigned < deficit and self.has_slot_quota(scheduling_class):
                     task = self.pop_task_from_global_queue(scheduling_class)
                     if task is None:
                         break
                     elif task.state not in (TASK_QUEUED, TASK_QUEUED_STREAMING):
                         continue
-                    task.set_worker(worker)
-                    self.workers[worker].assign_task(task)
-                    ciel.log('Executing task %s on worker %s (STOLEN)' % (task.task_id, worker.id), 'SCHED', logging.DEBUG)
-                    self.job_pool.worker_pool.execute_task_on_worker(worker, task)
+                    self._execute_task_on_worker(task, worker, self.workers[worker], True)
                     num_global_assigned += 1
+                    total_assigned += 1
+
+            if self.worker_steal:
+                thieves_by_class = {}
+                for worker, scheduling_class, _ in undersubscribed_worker_classes:
+                    try:
+                        thieves_by_class[scheduling_class].append(worker)
+                    except KeyError:
+                        thieves_by_class[scheduling_class] = [worker]
+                for scheduling_class, thieves in thieves_by_class.items():
+                    total_assigned += self._steal_from_worker_queues(thieves, scheduling_class)
+
+            # The incremental indices are not maintained by this path, so
+            # rebuild them from scratch on the next incremental pass.
+            self.reset_schedule_indices()
+
+            self._dispatch_batches()
+        
+        ciel.log('Finished scheduling job %s. Tasks assigned = %d' % (self.id, total_assigned), 'JOB', logging.DEBUG)
+
+    def _schedule_incremental(self):
         
+        ciel.log('Beginning to schedule job %s' % self.id, 'JOB', logging.DEBUG)
+        
+        with self._lock:
+            
+            # 1. Assign runnable tasks to worker queues. This marks the
+            #    affected worker classes and global queues as pending.
+            self._assign_runnable_tasks()
+            
+            # 2. Revisit only the worker classes whose queue or assigned
+            #    set has changed since the last pass, and any that were
+            #    previously held back by the job's slot quota.
+            total_assigned = 0
+            pending = self.pending_worker_classes | self.quota_blocked
+            self.pending_worker_classes = set()
+            self.quota_blocked = set()
+            for worker, scheduling_class in pending:
+                try:
+                    wstate = self.workers[worker]
+                    capacity = worker.scheduling_classes[scheduling_class]
+                except KeyError:
+                    continue
+                num_assigned, deficit = self._fill_from_worker_queue(worker, wstate, scheduling_class, capacity)
+                total_assigned += num_assigned
+                if deficit > 0:
+                    self.add_free_slot(worker, scheduling_class)
+                else:
+                    self.remove_free_slot(worker, scheduling_class)
+            
+            # 3. Match non-empty global queues against the free slots in the
+            #    same class, and against any free slots in the '*' class.
+            for queue_class in list(self.nonempty_global_classes):
+                slot_classes = (queue_class, '*') if queue_class != '*' else ('*', )
+                for slot_class in slot_classes:
+                    try:
+                        free_workers = self.free_slots[slot_class]
+                    except KeyError:
+                        continue
+                    for worker in list(free_workers):
+                        total_assigned += self._steal_from_global_queue(worker, slot_class, queue_class)
+                        if queue_class not in self.nonempty_global_classes:
+                            break
+                    if queue_class not in self.nonempty_global_classes:
+                        break
+
+            # 4. Let workers that still have free slots steal from the longest
+            #    queues on other workers in the same class.
+            if self.worker_steal:
+                for slot_class, free_workers in self.free_slots.items():
+                    if len(free_workers) > 0:
+                        total_assigned += self._steal_from_worker_queues(list(free_workers), slot_class)
+
+            self._dispatch_batches()
+
         ciel.log('Finished scheduling job %s. Tasks assigned = %d' % (self.id, total_assigned), 'JOB', logging.DEBUG)
+
+    def _steal_from_global_queue(self, worker, slot_class, queue_class):
+        # Called under self._lock.
+        wstate = self.workers[worker]
+        deficit = worker.scheduling_classes[slot_class] - wstate.tasks_assigned_in_class(slot_class)
+        try:
+            class_queue = self.global_queues[queue_class]
+        except KeyError:
+            class_queue = collections.deque()
+        num_assigned = 0
+        while num_assigned < deficit and self.has_slot_quota(slot_class):
+            try:
+                task = class_queue.popleft()
+            except IndexError:
+                break
+            if task.state not in (TASK_QUEUED, TASK_QUEUED_STREAMING):
+                continue
+            self._execute_task_on_worker(task, worker, wstate, True)
+            num_assigned += 1
+        if len(class_queue) == 0:
+            self.nonempty_global_classes.discard(queue_class)
+        if num_assigned >= deficit:
+            self.remove_free_slot(worker, slot_class)
+        return num_assigned
+
+    def has_slot_quota(self, scheduling_class):
+        # Called under self._lock.
+        if self.slot_quota is None:
+            return True
+        try:
+            return self.slot_usage.get(scheduling_class, 0) < self.slot_quota[scheduling_class]
+        except KeyError:
+            return True
+
+    def get_share_weight(self):
+        return self.share_weight
+
+    def get_slot_demand(self, capacities):
+        """Returns the number of slots that this job could use in each of the
+        given scheduling classes. Tasks in a class that no worker provides
+        are counted against the '*' class."""
+        demand = dict(self.slot_usage)
+        for scheduling_class, waiting in self.waiting_by_class.items():
+            if waiting <= 0:
+                continue
+            if scheduling_class not in capacities:
+                scheduling_class = '*'
+            demand[scheduling_class] = demand.get(scheduling_class, 0) + waiting
+        return demand
+
+    def _steal_from_worker_queues(self, thieves, slot_class):
+        # Called under self._lock. Returns the number of tasks stolen.
+        victims = []
+        for victim, eff_class in list(self.queued_worker_classes):
+            if eff_class != slot_class:
+                continue
+            try:
+                victim_state = self.workers[victim]
+                victim_state.trim_queue(eff_class)
+                queue = victim_state.queues[eff_class]
+            except KeyError:
+                self.queued_worker_classes.discard((victim, eff_class))
+                continue
+            if len(queue) == 0:
+                self.queued_worker_classes.discard((victim, eff_class))
+            elif victim_state.tasks_assigned_in_class(eff_class) >= victim.get_effective_scheduling_class_capacity(eff_class):
+                victims.append((-len(queue), victim.id, victim))
+        heapq.heapify(victims)
         
+        num_stolen = 0
+        for thief in thieves:
+            wstate = self.workers[thief]
+            while len(victims) > 0 and self.has_slot_quota(slot_class) and wstate.tasks_assigned_in_class(slot_class) < thief.scheduling_classes[slot_class]:
+                _, _, victim = heapq.heappop(victims)
+                if victim is thief:
+                    continue
+                stolen = self._steal_from_worker_queue(thief, victim, slot_class)
+                if stolen is None:
+                    # Nothing on this victim is worth stealing.
+                    continue
+                num_stolen += 1
+                queue_length = len(self.workers[victim].queues[slot_class])
+                if queue_length > 0:
+                    heapq.heappush(victims, (-queue_length, victim.id, victim))
+            if wstate.tasks_assigned_in_class(slot_class) >= thief.scheduling_classes[slot_class]:
+                self.remove_free_slot(thief, slot_class)
+        return num_stolen
+
+    def _steal_from_worker_queue(self, thief, victim, slot_class):
+        # Called under self._lock. Considers the last few tasks on the
+        # victim's queue, which would wait longest there, and steals the one
+        # that gains the most. Returns the stolen task, or None.
+        victim_state = self.workers[victim]
+        victim_state.trim_queue(slot_class)
+        queue = victim_state.queues[slot_class]
+        capacity = float(victim.get_effective_scheduling_class_capacity(slot_class))
+        best_task = None
+        best_gain = 0.0
+        best_saving = 0
+        best_wait = 0.0
+        now = time.time()
+        position = len(queue)
+        for task in reversed(queue):
+            position -= 1
+            if len(queue) - position > self.worker_steal_scan:
+                break
+            if task.state not in (TASK_QUEUED, TASK_QUEUED_STREAMING) or task.get_constrained_location() is not None:
+                continue
+            if task.locality_delay > 0 and task.queued_at is not None and task.queued_at + task.locality_delay > now:
+                # Still waiting for a local slot (see release_delayed_tasks()).
+                continue
+            if thief.get_effective_scheduling_class(task.scheduling_class) != slot_class:
+                continue
+            runtime = self.estimate_task_runtime(task, victim)
+            if runtime is None:
+                runtime = 1.0
+            wait = (position + 1) / capacity * runtime
+            saving = self.get_locality_saving(task, victim, thief)
+            bandwidth = self.get_fetch_bandwidth(victim.netloc)
+            if bandwidth is None:
+                bandwidth = DEFAULT_FETCH_BANDWIDTH
+            gain = wait - self.worker_steal_locality_weight * saving / bandwidth
+            if gain > best_gain:
+                best_task, best_gain, best_saving, best_wait = task, gain, saving, wait
+        
+        if best_task is None:
+            return None
+        
+        victim_state.remove_task_from_queue(best_task)
+        best_task.record_event('STOLEN', additional=victim.netloc)
+        self.worker_steal_count += 1
+        self.worker_steal_bytes_lost += best_saving
+        self.worker_steals.append((time.time(), best_task.task_id, victim.netloc, thief.netloc, best_saving, best_wait))
+        ciel.log('Worker %s stole task %s from worker %s (saving lost = %d bytes, expected wait = %f s)' % (thief.id, best_task.task_id, victim.id, best_saving, best_wait), 'SCHED', logging.DEBUG)
+        self._execute_task_on_worker(best_task, thief, self.workers[thief], True)
+        return best_task
+
+    def get_locality_saving(self, task, from_worker, to_worker):
+        """Returns the number of input bytes that are held by from_worker but
+        not by to_worker."""
+        saving = 0
+        for input in task.inputs.values():
+            if isinstance(input, SW2_ConcreteReference) and input.size_hint is not None:
+                if input.has_location_hint(from_worker.netloc) and not input.has_location_hint(to_worker.netloc):
+                    saving += input.size_hint
+        return saving
+
+    def get_worker_steals(self):
+        with self._lock:
+            return [{'time' : t, 'task_id' : task_id, 'victim' : victim, 'thief' : thief, 'saving_lost' : saving, 'expected_wait' : wait}
+                    for (t, task_id, victim, thief, saving, wait) in self.worker_steals]
+
+    def reset_schedule_indices(self):
+        # Called under self._lock.
+        self.pending_worker_classes = set()
+        self.free_slots = {}
+        self.nonempty_global_classes = set([c for c, q in self.global_queues.items() if len(q) > 0])
+        for worker in self.workers:
+            self.mark_worker_pending(worker)
+
+    def mark_worker_pending(self, worker, scheduling_class=None):
+        # Called under self._lock.
+        if scheduling_class is None:
+            for scheduling_class in worker.scheduling_classes:
+                self.pending_worker_classes.add((worker, scheduling_class))
+        else:
+            self.pending_worker_classes.add((worker, worker.get_effective_scheduling_class(scheduling_class)))
+
+    def add_free_slot(self, worker, scheduling_class):
+        try:
+            self.free_slots[scheduling_class].add(worker)
+        except KeyError:
+            self.free_slots[scheduling_class] = set([worker])
+
+    def remove_free_slot(self, worker, scheduling_class):
+        try:
+            self.free_slots[scheduling_class].discard(worker)
+        except KeyError:
+            pass
+
+    def queue_task_on_worker(self, task, worker):
+        # Called under self._lock.
+        estimate = self.estimate_task_runtime(task, worker)
+        task.expected_runtime = estimate if estimate is not None else 0.0
+        self.workers[worker].queue_task(task)
+        self.mark_worker_pending(worker, task.scheduling_class)
+        self.queued_worker_classes.add((worker, worker.get_effective_scheduling_class(task.scheduling_class)))
+
+    def deassign_task_from_worker(self, task, worker):
+        # Called under self._lock.
+        if self.workers[worker].deassign_task(task):
+            eff_class = worker.get_effective_scheduling_class(task.scheduling_class)
+            self.slot_usage[eff_class] -= 1
+        self.mark_worker_pending(worker, task.scheduling_class)
+
     def pop_task_from_global_queue(self, scheduling_class):
         if scheduling_class == '*':
             for queue in self.global_queues.values():
@@ -222,6 +822,7 @@ class Job:
             class_queue = collections.deque()
             self.global_queues[task.scheduling_class] = class_queue
         class_queue.append(task)
+        self.nonempty_global_classes.add(task.scheduling_class)
         
     def select_workers_for_task(self, task):
         constrained_location = task.get_constrained_location()
@@ -251,19 +852,19 @@ class Job:
             task.scheduling_class = 'disk'
 
     def record_event(self, description):
-        self.history.append((datetime.datetime.now(), description))
+        self.history.append((event_time(), description))
                     
     def set_state(self, state):
         self.record_event(JOB_STATE_NAMES[state])
         self.state = state
-        evt_time = self.history[-1][0]
-        ciel.log('%s %s @ %f' % (self.id, JOB_STATE_NAMES[self.state], time.mktime(evt_time.timetuple()) + evt_time.microsecond / 1e6), 'JOB', logging.INFO)
+        ciel.log('%s %s @ %f' % (self.id, JOB_STATE_NAMES[self.state], self.history[-1][0]), 'JOB', logging.INFO)
 
     def failed(self):
         # Done under self._lock (via _report_tasks()).
         self.set_state(JOB_FAILED)
         self.stop_journalling()
         self._condition.notify_all()
+        self.job_pool.job_failed(self)
 
     def enqueued(self):
         self.job_pool.worker_pool.notify_job_about_current_workers(self)
@@ -283,6 +884,8 @@ class Job:
         for output in self.root_task.expected_outputs:
             self.task_graph.subscribe(output, mjo)
         self.task_graph.reduce_graph_for_references(self.root_task.expected_outputs)
+        with self._lock:
+            self.arm_speculation_timer()
         self.schedule()
 
     def cancelled(self):
@@ -292,40 +895,145 @@ class Job:
     def stop_journalling(self):
         # Done under self._lock (via _report_tasks()).        
         if self.task_journal_fp is not None:
-            self.task_journal_fp.close()
+            self.job_pool.journal_writer.close(self.task_journal_fp)
         self.task_journal_fp = None
+        if self.retired_task_fp is not None:
+            self.retired_task_fp.close()
+            self.retired_task_fp = None
                 
         if self.job_dir is not None:
             with open(os.path.join(self.job_dir, 'result'), 'w') as result_file:
                 simplejson.dump(self.result_ref, result_file, cls=SWReferenceJSONEncoder)
 
+    def sync_journal(self):
+        """Returns a JournalSyncPoint for the records written so far."""
+        return self.job_pool.journal_writer.sync(self.task_journal_fp)
+
     def flush_journal(self):
-        with self._lock:
-            if self.task_journal_fp is not None:
-                self.task_journal_fp.flush()
-                os.fsync(self.task_journal_fp.fileno())
+        self.sync_journal().wait()
 
     def maybe_sync(self, must_sync=False):
+        # The journal writer commits records in groups, so this only forces
+        # an earlier commit.
+        sync_point = None
         if must_sync or (self.journal_sync_buffer is not None and self.journal_sync_counter % self.journal_sync_buffer == 0):
-            os.fsync(self.task_journal_fp.fileno())
+            sync_point = self.sync_journal()
         self.journal_sync_counter += 1
+        return sync_point
+
+    def write_journal_record(self, record_type, record_string):
+        # Called under self._lock.
+        self.job_pool.journal_writer.write(self.task_journal_fp, RECORD_HEADER_STRUCT.pack(record_type, len(record_string)) + record_string)
+        self.journal_records_since_checkpoint += 1
+
+    def maybe_checkpoint(self):
+        # Called under self._lock.
+        if self.journal and self.task_journal_fp is not None and self.journal_checkpoint_interval is not None \
+                and self.journal_records_since_checkpoint >= max(self.journal_checkpoint_interval, len(self.task_graph.tasks)):
+            self.checkpoint()
+
+    def checkpoint(self):
+        # Called under self._lock.
+        # The checkpoint covers every record in the current segment, so the
+        # following records are written to a new segment. Earlier segments
+        # are kept, because they hold the root task and any retired tasks.
+        self.journal_segment += 1
+        self.job_pool.journal_writer.close(self.task_journal_fp)
+        self.task_journal_fp = open(get_journal_segment_filename(self.job_dir, self.journal_segment), 'wb')
+
+        # Tasks are listed after their parents, so that they can be spawned
+        # in order. Future references are recreated when their producing
+        # tasks are spawned.
+        tasks = []
+        seen_task_ids = set()
+        for task in self.task_graph.tasks.itervalues():
+            ancestors = []
+            while task is not None and task.task_id not in seen_task_ids and task.task_id in self.task_graph.tasks:
+                seen_task_ids.add(task.task_id)
+                ancestors.append(task)
+                task = task.parent
+            ancestors.reverse()
+            for task in ancestors:
+                tasks.append(task.as_descriptor())
+        refs = [ref_table_entry.ref for ref_table_entry in self.task_graph.references.itervalues() if not isinstance(ref_table_entry.ref, SW2_FutureReference)]
+
+        # The state is encoded by the journal writer thread. A reference may
+        # gain location hints in the meantime, which is harmless.
+        state = {'segment': self.journal_segment, 'tasks': tasks, 'refs': refs}
+        self.job_pool.journal_writer.write_checkpoint(get_checkpoint_filename(self.job_dir), state)
+        self.journal_records_since_checkpoint = 0
+        self.checkpoint_count += 1
+        ciel.log('Checkpointed %d tasks and %d references for job %s' % (len(tasks), len(refs), self.id), 'JOB', logging.INFO)
 
     def add_reference(self, id, ref, should_sync=False):
         # Called under self._lock (from _report_tasks()).
         if self.journal and self.task_journal_fp is not None:
             ref_details = simplejson.dumps({'id': id, 'ref': ref}, cls=SWReferenceJSONEncoder)
-            self.task_journal_fp.write(RECORD_HEADER_STRUCT.pack('R', len(ref_details)))
-            self.task_journal_fp.write(ref_details)
-            self.maybe_sync(should_sync)
+            self.write_journal_record('R', ref_details)
+            return self.maybe_sync(should_sync)
             
+    def maybe_collect_garbage(self):
+        # Called under self._lock.
+        if self.task_graph_gc and len(self.task_graph.tasks) >= max(self.task_graph_gc_threshold, 2 * self.task_graph_gc_live_tasks):
+            self.collect_garbage()
+
+    def collect_garbage(self):
+        # Called under self._lock.
+        if self.root_task is not None:
+            retired_tasks, retired_ref_ids = self.task_graph.collect_garbage(self.root_task.expected_outputs, [self.root_task])
+        else:
+            retired_tasks, retired_ref_ids = self.task_graph.collect_garbage([])
+        if self.task_graph_gc_spill:
+            self.spill_tasks(retired_tasks)
+        for task in retired_tasks:
+            # Break the cycles between parents and children, so that the
+            # retired tasks are freed immediately.
+            task.parent = None
+            task.children = NO_CHILDREN
+        self.retired_task_count += len(retired_tasks)
+        self.retired_ref_count += len(retired_ref_ids)
+        self.task_graph_gc_live_tasks = len(self.task_graph.tasks)
+        ciel.log('Retired %d tasks and %d references from job %s (%d tasks remain)' % (len(retired_tasks), len(retired_ref_ids), self.id, self.task_graph_gc_live_tasks), 'JOB', logging.INFO)
+
+    def spill_tasks(self, tasks):
+        # Called under self._lock.
+        # The retired tasks are only kept for browsing, and recovery retires
+        # them again, so they are not written through the journal and are
+        # never synced.
+        if self.task_journal_fp is None or len(tasks) == 0:
+            return
+        offsets = []
+        try:
+            if self.retired_task_fp is None:
+                self.retired_task_fp = open(get_retired_tasks_filename(self.job_dir), 'wb')
+            for task in tasks:
+                task_details = simplejson.dumps(task.as_descriptor(long=True), cls=SWReferenceJSONEncoder)
+                offsets.append((task.task_id, self.retired_task_fp.tell()))
+                self.retired_task_fp.write(RECORD_HEADER_STRUCT.pack('X', len(task_details)))
+                self.retired_task_fp.write(task_details)
+            self.retired_task_fp.flush()
+        except IOError:
+            ciel.log('Error writing retired tasks for job %s' % self.id, 'JOB', logging.WARNING, True)
+            return
+        # Only visible to readers once the records are in the file.
+        self.retired_task_offsets.update(offsets)
+
+    def get_retired_task_descriptor(self, task_id):
+        """Returns the descriptor of a task that was written to the job
+        directory when it was retired, or raises KeyError."""
+        offset = self.retired_task_offsets[task_id]
+        with open(get_retired_tasks_filename(self.job_dir), 'rb') as retired_tasks_file:
+            retired_tasks_file.seek(offset)
+            _, record_length = RECORD_HEADER_STRUCT.unpack(retired_tasks_file.read(RECORD_HEADER_STRUCT.size))
+            return simplejson.loads(retired_tasks_file.read(record_length), object_hook=json_decode_object_hook)
+
     def add_task(self, task, should_sync=False):
         # Called under self._lock (from _report_tasks()).
         self.task_state_counts[task.state] = self.task_state_counts[task.state] + 1
         if self.journal and self.task_journal_fp is not None:
             task_details = simplejson.dumps(task.as_descriptor(), cls=SWReferenceJSONEncoder)
-            self.task_journal_fp.write(RECORD_HEADER_STRUCT.pack('T', len(task_details)))
-            self.task_journal_fp.write(task_details)
-            self.maybe_sync(should_sync)
+            self.write_journal_record('T', task_details)
+            return self.maybe_sync(should_sync)
             
 
 #    def steal_task(self, worker, scheduling_class):
@@ -352,6 +1060,16 @@ class Job:
         # Done under self._lock (from _report_tasks()).
         self.task_state_counts[prev_state] = self.task_state_counts[prev_state] - 1
         self.task_state_counts[next_state] = self.task_state_counts[next_state] + 1
+        
+        # Maintain the number of waiting tasks in each class for fair sharing.
+        was_waiting = prev_state in (TASK_QUEUED, TASK_QUEUED_STREAMING)
+        is_waiting = next_state in (TASK_QUEUED, TASK_QUEUED_STREAMING)
+        if is_waiting and not was_waiting:
+            self.assign_scheduling_class_to_task(task)
+            self.waiting_by_class[task.scheduling_class] = self.waiting_by_class.get(task.scheduling_class, 0) + 1
+        elif was_waiting and not is_waiting:
+            self.waiting_by_class[task.scheduling_class] = self.waiting_by_class.get(task.scheduling_class, 0) - 1
+        
         self.job_pool.log(task, TASK_STATE_NAMES[next_state], additional)
 
     def as_descriptor(self):
@@ -362,31 +1080,81 @@ class Job:
                'root_task': self.root_task.task_id if self.root_task is not None else None,
                'expected_outputs': self.root_task.expected_outputs if self.root_task is not None else None,
                'result_ref': self.result_ref,
-               'job_options' : self.job_options}
+               'job_options' : self.job_options,
+               'locality_hits' : self.locality_hits,
+               'locality_misses' : self.locality_misses,
+               'speculative_launches' : self.speculative_launches,
+               'speculative_wins' : self.speculative_wins,
+               'worker_steals' : self.worker_steal_count,
+               'worker_steal_bytes_lost' : self.worker_steal_bytes_lost,
+               'share_weight' : self.share_weight,
+               'share' : self.job_pool.get_fair_share(self),
+               'slot_quota' : self.slot_quota,
+               'task_history' : str(self.task_history),
+               'retired_tasks' : self.retired_task_count,
+               'retired_references' : self.retired_ref_count,
+               'memoized_tasks' : self.memoized_task_count,
+               'checkpoints' : self.checkpoint_count}
         with self._lock:
             for (name, state_index) in TASK_STATES.items():
                 counts[name] = self.task_state_counts[state_index]
+            ret['slot_usage'] = dict(self.slot_usage)
         return ret
 
     def report_tasks(self, report, toplevel_task, worker):
-        self.job_pool.deferred_worker.do_deferred(lambda: self._report_tasks(report, toplevel_task, worker))
+        self.job_pool.deferred_worker.do_deferred(lambda: self._report_tasks(report, toplevel_task, worker), self.id)
 
     def _report_tasks(self, report, toplevel_task, worker):
         with self._lock:
     
             tx = TaskGraphUpdate()
             
-            root_task = self.task_graph.get_task(report[0][0])
+            try:
+                root_task = self.task_graph.get_task(report[0][0])
+            except KeyError:
+                # The task has committed and been retired, so this must be a
+                # late report from a speculative copy.
+                ciel.log('Ignoring report for retired task %s from worker %s' % (report[0][0], worker.id), 'SCHED', logging.INFO)
+                return
             
             ciel.log('Received report from task %s with %d entries' % (root_task.task_id, len(report)), 'SCHED', logging.DEBUG)
             
             try:
-                self.workers[worker].deassign_task(root_task)
+                self.deassign_task_from_worker(root_task, worker)
             except KeyError:
                 # This can happen if we recieve the report after the worker is deemed to have failed. In this case, we should
                 # accept the report and ignore the failed worker.
                 pass
 
+            if root_task.state == TASK_COMMITTED:
+                # Another copy of this task has already reported, so we must
+                # not spawn its children or publish its outputs again.
+                ciel.log('Ignoring duplicate report for task %s from worker %s' % (root_task.task_id, worker.id), 'SCHED', logging.INFO)
+                self.drop_task_copy(root_task, worker)
+                self.schedule()
+                return
+
+            if len([x for x in report if not x[1]]) > 0:
+                if self.drop_task_copy(root_task, worker):
+                    ciel.log('Ignoring failure of task %s on worker %s, because another copy is running' % (root_task.task_id, worker.id), 'SCHED', logging.WARNING)
+                    self.schedule()
+                    return
+            else:
+                # This copy won the race, so abort any others.
+                if worker in root_task.speculative_workers:
+                    self.speculative_wins += 1
+                other_workers = [x for x in root_task.speculative_workers if x is not worker]
+                if root_task.worker is not None and root_task.worker is not worker:
+                    other_workers.append(root_task.worker)
+                for other_worker in other_workers:
+                    self.job_pool.worker_pool.abort_task_on_worker(root_task, other_worker)
+                    try:
+                        self.deassign_task_from_worker(root_task, other_worker)
+                    except KeyError:
+                        pass
+                root_task.clear_speculative_workers()
+                root_task.worker = worker
+
             for (parent_id, success, payload) in report:
                 
                 ciel.log('Processing report record from task %s' % (parent_id), 'SCHED', logging.DEBUG)
@@ -402,12 +1170,23 @@ class Job:
                     for child in spawned:
                         child_task = build_taskpool_task_from_descriptor(child, parent_task)
                         ciel.log('Task %s spawned task %s' % (parent_id, child_task.task_id), 'SCHED', logging.DEBUG)
-                        tx.spawn(child_task)
+                        memoized_outputs = None
+                        if self.memo_table is not None:
+                            memoized_outputs = self.memo_table.lookup(child_task)
+                        if memoized_outputs is not None:
+                            ciel.log('Task %s was memoized' % (child_task.task_id, ), 'SCHED', logging.DEBUG)
+                            self.memoized_task_count += 1
+                            tx.spawn_committed(child_task, memoized_outputs)
+                        else:
+                            tx.spawn(child_task)
                         #parent_task.children.append(child_task)
                     
                     for ref in published:
                         ciel.log('Task %s published reference %s' % (parent_id, str(ref)), 'SCHED', logging.DEBUG)
                         tx.publish(ref, parent_task)
+
+                    if self.memo_table is not None:
+                        self.memo_table.record(parent_task, spawned, published)
                 
                 else:
                     ciel.log('Task %s failed' % (parent_id), 'SCHED', logging.WARN)
@@ -419,6 +1198,9 @@ class Job:
             tx.commit(self.task_graph)
             self.task_graph.reduce_graph_for_references(toplevel_task.expected_outputs)
             
+            self.maybe_collect_garbage()
+            self.maybe_checkpoint()
+            
         # XXX: Need to remove assigned task from worker(s).
         self.schedule()
 
@@ -436,11 +1218,62 @@ class Job:
                 
             self.workers[worker].record_task_stats(task)
 
+            try:
+                fetch_times = task_profiling['FETCH_TIME']
+            except KeyError:
+                fetch_times = {}
+            for netloc, fetched in task_profiling['FETCHED'].items():
+                try:
+                    fetch_time = fetch_times[netloc]
+                except KeyError:
+                    # Older workers do not time their fetches, so the task
+                    # execution time gives a lower bound on the bandwidth.
+                    fetch_time = task_execution_time
+                self.fetch_bytes[netloc] = self.fetch_bytes.get(netloc, 0) + fetched
+                self.fetch_time[netloc] = self.fetch_time.get(netloc, 0.0) + fetch_time
+
         except:
             ciel.log('Error recording task statistics for task: %s' % task.task_id, 'JOB', logging.WARNING)
 
     def guess_task_cost_on_worker(self, task, worker):
         return self.workers[worker].load(task.scheduling_class, True)
+
+    def get_fetch_bandwidth(self, netloc):
+        """Returns the observed bandwidth in bytes per second when fetching
+        from the given netloc, or None if we have no observations."""
+        try:
+            fetch_time = self.fetch_time[netloc]
+            if fetch_time > 0:
+                return self.fetch_bytes[netloc] / fetch_time
+        except KeyError:
+            pass
+        return None
+
+    def estimate_task_runtime(self, task, worker=None):
+        """Returns the expected execution time of the task, preferring
+        observations of the same task type on the given worker, or None if
+        nothing similar has run."""
+        task_type = task.get_type()
+        if worker is not None:
+            try:
+                return self.workers[worker].running_average_by_type[task_type].get()
+            except KeyError:
+                pass
+        try:
+            return self.all_tasks_by_type[task_type].get()
+        except KeyError:
+            pass
+        if self.all_tasks.count > 0:
+            return self.all_tasks.get()
+        return None
+
+    def estimate_queued_work(self, task, worker):
+        """Returns the expected time before a slot for this task becomes
+        free on the given worker."""
+        try:
+            return self.workers[worker].expected_work_per_slot(task.scheduling_class)
+        except KeyError:
+            return 0.0
                 
     def investigate_task_failure(self, task, payload):
         self.job_pool.task_failure_investigator.investigate_task_failure(task, payload)
@@ -454,6 +1287,7 @@ class Job:
                 ciel.log('Job %s notified that worker being added' % self.id, 'JOB', logging.INFO)
                 worker_state = JobWorkerState(worker)
                 self.workers[worker] = worker_state
+                self.mark_worker_pending(worker)
         self.schedule()
     
     def notify_worker_failed(self, worker):
@@ -461,9 +1295,16 @@ class Job:
             try:
                 worker_state = self.workers[worker]
                 del self.workers[worker]
+                for free_workers in self.free_slots.values():
+                    free_workers.discard(worker)
+                for eff_class, assigned in worker_state.assigned_tasks.items():
+                    self.slot_usage[eff_class] = self.slot_usage.get(eff_class, 0) - len(assigned)
                 ciel.log('Reassigning tasks from failed worker %s for job %s' % (worker.id, self.id), 'JOB', logging.WARNING)
                 for assigned in worker_state.assigned_tasks.values():
                     for failed_task in assigned:
+                        if self.drop_task_copy(failed_task, worker):
+                            # Another copy of this task is still running.
+                            continue
                         failed_task.unset_worker(worker)
                         self.investigate_task_failure(failed_task, ('WORKER_FAILED', None, {}))
                 for scheduling_class in worker_state.queues:
@@ -487,6 +1328,8 @@ class JobWorkerState:
         self.queues = {}
         self.running_average = RunningAverage()
         self.running_average_by_type = {}
+        # Sum of the expected runtimes of queued and assigned tasks, per class.
+        self.expected_work = {}
         
 #    def get_last_task_in_class(self, scheduling_class):
 #        ciel.log('In get_last_task_in_class(%s, %s)' % (self.worker.id, scheduling_class), 'JWS', logging.INFO)
@@ -509,6 +1352,7 @@ class JobWorkerState:
         eff_class = self.worker.get_effective_scheduling_class(scheduling_class)
         try:
             task = self.queues[eff_class].popleft()
+            self.update_expected_work(eff_class, -task.expected_runtime)
             return task
         except KeyError:
             return None
@@ -523,6 +1367,7 @@ class JobWorkerState:
             class_queue = collections.deque()
             self.queues[eff_class] = class_queue
             class_queue.append(task)
+        self.update_expected_work(eff_class, task.expected_runtime)
         
     def assign_task(self, task):
         eff_class = self.worker.get_effective_scheduling_class(task.scheduling_class)
@@ -532,14 +1377,39 @@ class JobWorkerState:
             class_set = set()
             self.assigned_tasks[eff_class] = class_set
             class_set.add(task)
+        self.update_expected_work(eff_class, task.expected_runtime)
         
     def deassign_task(self, task):
         try:
             eff_class = self.worker.get_effective_scheduling_class(task.scheduling_class)
             self.assigned_tasks[eff_class].remove(task)
+            self.update_expected_work(eff_class, -task.expected_runtime)
+            return True
         except KeyError:
             # XXX: This is happening twice, once on receiving the report and again on the failure.
-            pass
+            return False
+
+    def trim_queue(self, eff_class):
+        # Discards tasks at the back of the queue that have already run elsewhere.
+        queue = self.queues[eff_class]
+        while len(queue) > 0 and queue[-1].state not in (TASK_QUEUED, TASK_QUEUED_STREAMING):
+            task = queue.pop()
+            self.update_expected_work(eff_class, -task.expected_runtime)
+
+    def remove_task_from_queue(self, task):
+        eff_class = self.worker.get_effective_scheduling_class(task.scheduling_class)
+        self.queues[eff_class].remove(task)
+        self.update_expected_work(eff_class, -task.expected_runtime)
+
+    def update_expected_work(self, eff_class, delta):
+        self.expected_work[eff_class] = max(0.0, self.expected_work.get(eff_class, 0.0) + delta)
+
+    def expected_work_per_slot(self, scheduling_class):
+        eff_class = self.worker.get_effective_scheduling_class(scheduling_class)
+        try:
+            return self.expected_work[eff_class] / self.worker.get_effective_scheduling_class_capacity(eff_class)
+        except KeyError:
+            return 0.0
         
     def load(self, scheduling_class, normalized=False):
         eff_class = self.worker.get_effective_scheduling_class(scheduling_class)
@@ -624,14 +1494,32 @@ class JobTaskGraph(DynamicTaskGraph):
         DynamicTaskGraph.__init__(self)
         self.job = job
         self.scheduler_queue = scheduler_queue
+        self.locality_index = job.scheduling_policy.get_locality_index()
     
     def spawn(self, task, tx=None):
         self.job.add_task(task)
         DynamicTaskGraph.spawn(self, task, tx)
+
+    def spawn_committed(self, task, outputs):
+        self.job.add_task(task)
+        DynamicTaskGraph.spawn_committed(self, task, outputs)
         
     def publish(self, reference, producing_task=None):
         self.job.add_reference(reference.id, reference)
-        return DynamicTaskGraph.publish(self, reference, producing_task)
+        if self.job.memo_table is not None and isinstance(reference, SW2_TombstoneReference):
+            # The data may have been lost, so stop handing it out.
+            self.job.memo_table.invalidate_ref(reference.id)
+        ref_table_entry = DynamicTaskGraph.publish(self, reference, producing_task)
+        if self.locality_index is not None:
+            self.locality_index.update(ref_table_entry.ref)
+        return ref_table_entry
+    
+    def collect_garbage(self, root_ref_ids, root_tasks=[]):
+        retired_tasks, retired_ref_ids = DynamicTaskGraph.collect_garbage(self, root_ref_ids, root_tasks)
+        if self.locality_index is not None:
+            for ref_id in retired_ref_ids:
+                self.locality_index.remove(ref_id)
+        return retired_tasks, retired_ref_ids
     
     def task_runnable(self, task):
         if self.job.state == JOB_ACTIVE:
@@ -640,6 +1528,15 @@ class JobTaskGraph(DynamicTaskGraph):
         else:
             ciel.log('Task %s became runnable while job %s not active (%s): ignoring' % (task.task_id, self.job.id, JOB_STATE_NAMES[self.job.state]), 'JOBTASKGRAPH', logging.WARN)
 
+    def tasks_runnable(self, tasks):
+        if self.job.state == JOB_ACTIVE:
+            put = self.scheduler_queue.put
+            for task in tasks:
+                task.set_state(TASK_QUEUED)
+                put(task)
+        else:
+            ciel.log('%d tasks became runnable while job %s not active (%s): ignoring' % (len(tasks), self.job.id, JOB_STATE_NAMES[self.job.state]), 'JOBTASKGRAPH', logging.WARN)
+
     def task_failed(self, task, bindings, reason, details=None):
 
         ciel.log.error('Task failed because %s' % (reason, ), 'TASKPOOL', logging.WARNING)
@@ -695,11 +1592,16 @@ class JobTaskGraph(DynamicTaskGraph):
 
 class JobPool(plugins.SimplePlugin):
 
-    def __init__(self, bus, journal_root, scheduler, task_failure_investigator, deferred_worker, worker_pool, task_log_root=None):
+    def __init__(self, bus, journal_root, scheduler, task_failure_investigator, deferred_worker, worker_pool, task_log_root=None, fair_share_policy='drf', memo_table=None, journal_writer=None):
         plugins.SimplePlugin.__init__(self, bus)
         self.journal_root = journal_root
+        if journal_writer is None:
+            journal_writer = JournalWriter()
+        self.journal_writer = journal_writer
+        self.memo_table = memo_table
 
         self.task_log_root = task_log_root
+        self._log_lock = Lock()
         if self.task_log_root is not None:
             try:
                 self.task_log = open(os.path.join(self.task_log_root, "ciel-task-log.txt"), "w")
@@ -717,6 +1619,12 @@ class JobPool(plugins.SimplePlugin):
         self.task_failure_investigator = task_failure_investigator
         self.deferred_worker = deferred_worker
         self.worker_pool = worker_pool
+        
+        # Divides the cluster between the running jobs, unless disabled.
+        if fair_share_policy is None or fair_share_policy == 'none':
+            self.fair_share = None
+        else:
+            self.fair_share = FairShareAllocator(worker_pool, fair_share_policy)
     
         # Mapping from job ID to job object.
         self.jobs = {}
@@ -748,10 +1656,10 @@ class JobPool(plugins.SimplePlugin):
         
     def log(self, task, state, details=None):
         if self.task_log is not None:
-            log_at = datetime.datetime.now()
-            log_float = time.mktime(log_at.timetuple()) + log_at.microsecond / 1e6
-            print >>self.task_log, log_float, task.task_id if task is not None else None,  state, details
-            self.task_log.flush()
+            # Deferred work for different jobs may log concurrently.
+            with self._log_lock:
+                print >>self.task_log, event_time(), task.task_id if task is not None else None,  state, details
+                self.task_log.flush()
 
     def server_stopping(self):
         # When the server is shutting down, we need to notify all threads
@@ -763,6 +1671,9 @@ class JobPool(plugins.SimplePlugin):
         if self.task_log is not None:
             self.log(None, "STOPPING")
             self.task_log.close()
+        if self.memo_table is not None:
+            self.memo_table.close()
+        self.journal_writer.stop()
 
     def get_job_by_id(self, id):
         return self.jobs[id]
@@ -779,13 +1690,22 @@ class JobPool(plugins.SimplePlugin):
         # We will use this both for new jobs and on recovery.
         if job.root_task is not None:
             job.task_graph.spawn(job.root_task)
+
+        if sync_journal:
+            return job.sync_journal()
+        else:
+            return None
     
     def notify_worker_added(self, worker):
+        if self.fair_share is not None:
+            self.fair_share.invalidate()
         for job in self.jobs.values():
             if job.state == JOB_ACTIVE:
                 job.notify_worker_added(worker)
             
     def notify_worker_failed(self, worker):
+        if self.fair_share is not None:
+            self.fair_share.invalidate()
         for job in self.jobs.values():
             if job.state == JOB_ACTIVE:
                 job.notify_worker_failed(worker)
@@ -818,11 +1738,14 @@ class JobPool(plugins.SimplePlugin):
             job = Job(job_id, task, job_dir, JOB_CREATED, self, job_options)
             task.job = job
             
-            self.add_job(job)
+            sync_point = self.add_job(job, sync_journal=True)
             
             ciel.log('Added job: %s' % job.id, 'JOB_POOL', logging.INFO)
-    
-            return job
+
+        # The job must survive a master failure once it has been accepted.
+        sync_point.wait()
+        
+        return job
 
     def make_job_directory(self, job_id):
         if self.journal_root is not None:
@@ -850,11 +1773,44 @@ class JobPool(plugins.SimplePlugin):
         self.maybe_start_new_job()
             
     def job_completed(self, job):
+        if self.fair_share is not None:
+            self.fair_share.unregister_job(job)
+        self.deferred_worker.release_key(job.id)
         self.num_running_jobs -= 1
         self.maybe_start_new_job()
+        
+    def job_failed(self, job):
+        if self.fair_share is not None:
+            self.fair_share.unregister_job(job)
+        self.deferred_worker.release_key(job.id)
+
+    def get_slot_quota(self, job):
+        if self.fair_share is not None:
+            return self.fair_share.get_quota(job)
+        else:
+            return None
+        
+    def get_fair_share(self, job):
+        if self.fair_share is not None:
+            return self.fair_share.get_share(job)
+        else:
+            return None
+        
+    def get_fair_shares(self):
+        """Returns the share, quota and usage of each running job."""
+        shares = {}
+        for job in self.jobs.values():
+            if job.state == JOB_ACTIVE:
+                shares[job.id] = {'share_weight' : job.share_weight,
+                                  'share' : self.get_fair_share(job),
+                                  'slot_quota' : job.slot_quota,
+                                  'slot_usage' : dict(job.slot_usage)}
+        return shares
 
     def _start_job(self, job):
         ciel.log('Starting job ID: %s' % job.id, 'JOB_POOL', logging.INFO)
+        if self.fair_share is not None:
+            self.fair_share.register_job(job)
         # This will also start the job by subscribing to the root task output and reducing.
         job.activated()
 
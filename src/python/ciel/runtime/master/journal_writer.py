@@ -0,0 +1,480 @@
+# Copyright (c) 2011 Derek Murray <derek.murray@cl.cam.ac.uk>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+'''
+A single thread that writes the job journals on behalf of every job.
+
+Jobs enqueue serialized records, so that they do not hold their locks while
+the records are written. The writer thread writes every record in the queue
+before flushing, and commits the records for all journals with a single round
+of fsyncs, every sync_interval seconds or sync_bytes bytes. A caller
+that needs a record to be durable (e.g. the root task of a new job) requests a
+sync point, and waits on it until the next commit. If a record could not be
+written, the sync point raises the error, and the journal file is truncated
+to the end of the last commit, so that it always ends with a whole record.
+
+A journal is a sequence of records, each of which is a RECORD_HEADER_STRUCT
+(type and length) followed by the record. If compression is enabled, the
+records that are written to a file in each commit are compressed together,
+and written as a single COMPRESSED_RECORD_TYPE record. A job's journal is
+split into segments, and each time a job takes a checkpoint of its task
+graph, it starts a new segment. The checkpoint is written by the writer thread
+after the records that precede it, so recovery can load the latest checkpoint
+and replay only the segments that follow it.
+'''
+from __future__ import with_statement
+from ciel.public.wire_codec import encode_binary, decode_binary
+from ciel.runtime.plugins import THREAD_TERMINATOR
+from threading import Condition, Event, Lock
+import ciel
+import collections
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+RECORD_HEADER_STRUCT = struct.Struct('!cI')
+
+COMPRESSED_RECORD_TYPE = 'Z'
+CHECKPOINT_RECORD_TYPE = 'C'
+
+_WRITE = 0
+_SYNC = 1
+_CLOSE = 2
+_CHECKPOINT = 3
+
+def get_journal_segment_filename(job_dir, segment):
+    if segment == 0:
+        return os.path.join(job_dir, 'task_journal')
+    else:
+        return os.path.join(job_dir, 'task_journal.%d' % segment)
+
+def get_journal_segments(job_dir, first_segment=0):
+    """Returns a list of (segment, filename) for each segment of a journal,
+    starting from first_segment."""
+    segments = []
+    segment = first_segment
+    while True:
+        filename = get_journal_segment_filename(job_dir, segment)
+        if not os.path.exists(filename):
+            return segments
+        segments.append((segment, filename))
+        segment += 1
+
+def get_checkpoint_filename(job_dir):
+    return os.path.join(job_dir, 'checkpoint')
+
+def get_retired_tasks_filename(job_dir):
+    return os.path.join(job_dir, 'retired_tasks')
+
+def _split_records(data):
+    header_size = RECORD_HEADER_STRUCT.size
+    unpack_from = RECORD_HEADER_STRUCT.unpack_from
+    offset = 0
+    while offset < len(data):
+        record_type, record_length = unpack_from(data, offset)
+        offset += header_size
+        yield record_type, data[offset:offset + record_length]
+        offset += record_length
+
+def read_journal_records(journal_file, repair=False):
+    """Yields (record_type, record_string) for each record in a journal
+    file, expanding compressed records. Stops at the first incomplete or
+    corrupt record, which can only be at the end of the file if the master
+    failed while writing it. If repair is True, the file (which must be open
+    for update) is truncated to the end of the last complete record, so that
+    new records may be appended."""
+    header_size = RECORD_HEADER_STRUCT.size
+    while True:
+        offset = journal_file.tell()
+        record_header = journal_file.read(header_size)
+        if len(record_header) == 0:
+            return
+        if len(record_header) == header_size:
+            record_type, record_length = RECORD_HEADER_STRUCT.unpack(record_header)
+            record_string = journal_file.read(record_length)
+            if len(record_string) == record_length:
+                if record_type != COMPRESSED_RECORD_TYPE:
+                    yield record_type, record_string
+                    continue
+                try:
+                    data = zlib.decompress(record_string)
+                except zlib.error:
+                    pass
+                else:
+                    for record in _split_records(data):
+                        yield record
+                    continue
+        if repair:
+            ciel.log('Truncating journal %s to %d bytes, after an incomplete record' % (journal_file.name, offset), 'JOURNAL', logging.WARNING)
+            journal_file.truncate(offset)
+        return
+
+def write_checkpoint(filename, state):
+    # The checkpoint replaces the previous one atomically, so that a failure
+    # while writing it leaves the previous checkpoint intact.
+    payload = zlib.compress(encode_binary(state), 1)
+    new_filename = filename + '.new'
+    with open(new_filename, 'wb') as checkpoint_file:
+        checkpoint_file.write(RECORD_HEADER_STRUCT.pack(CHECKPOINT_RECORD_TYPE, len(payload)))
+        checkpoint_file.write(payload)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.rename(new_filename, filename)
+    return RECORD_HEADER_STRUCT.size + len(payload)
+
+def read_checkpoint(filename):
+    """Returns the state that was passed to write_checkpoint(). Raises an
+    exception if the checkpoint is missing or unreadable (e.g. because it
+    was written by a different version of Python)."""
+    with open(filename, 'rb') as checkpoint_file:
+        record_header = checkpoint_file.read(RECORD_HEADER_STRUCT.size)
+        if len(record_header) != RECORD_HEADER_STRUCT.size:
+            raise ValueError('Checkpoint %s is truncated' % filename)
+        record_type, record_length = RECORD_HEADER_STRUCT.unpack(record_header)
+        if record_type != CHECKPOINT_RECORD_TYPE:
+            raise ValueError('Checkpoint %s has invalid record type' % filename)
+        payload = checkpoint_file.read(record_length)
+        if len(payload) != record_length:
+            raise ValueError('Checkpoint %s is truncated' % filename)
+    return decode_binary(zlib.decompress(payload))
+
+class JournalSyncPoint:
+
+    def __init__(self, fp=None):
+        self.fp = fp
+        self.event = Event()
+        self.error = None
+
+    def done(self, error=None):
+        self.error = error
+        self.event.set()
+
+    def is_done(self):
+        return self.event.isSet()
+
+    def wait(self, timeout=None):
+        """Blocks until every record that was written to the journal before
+        this sync point was requested is on disk. Returns False on timeout,
+        and raises the error if any of the records could not be written."""
+        self.event.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.event.isSet()
+
+class JournalWriter:
+
+    def __init__(self, max_queued_records=10000, sync_interval=0.005, sync_bytes=1048576, compress_level=1):
+        self.max_queued_records = max_queued_records
+        self.sync_interval = sync_interval
+        self.sync_bytes = sync_bytes
+        self.compress_level = compress_level
+
+        # Appending to a deque does not take a lock, so enqueuing a record is
+        # cheap. The writer thread is only woken when it is idle, and callers
+        # only block on space_available when the queue is full.
+        self.pending = collections.deque()
+        self.pending_bytes = 0
+        self.idle = False
+        self.has_work = Event()
+        self.space_available = Condition(Lock())
+
+        self.thread = None
+        self._lock = Lock()
+
+        # Files that have been written since the last commit.
+        self.dirty_files = set()
+
+        # The offset of the end of the last commit, and of the last record
+        # written, in each open file.
+        self.committed_offsets = {}
+        self.written_offsets = {}
+
+        # Mapping from file to the error raised while writing the current
+        # group of records.
+        self.commit_errors = {}
+
+        # Mapping from file to the error that prevented it from being
+        # truncated after a failed write. No more records are written to
+        # these files.
+        self.broken_files = {}
+
+        self.records_written = 0
+        self.bytes_written = 0
+        self.uncompressed_bytes_written = 0
+        self.checkpoints_written = 0
+        self.checkpoint_bytes_written = 0
+        self.max_queue_depth = 0
+        self.commits = 0
+        self.fsyncs = 0
+        self.total_fsync_time = 0.0
+        self.max_fsync_time = 0.0
+        self.write_errors = 0
+
+        # Records per second, measured over windows of at least a second.
+        self.rate_window_start = time.time()
+        self.rate_window_records = 0
+        self.records_per_second = 0.0
+
+    def start(self):
+        with self._lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.thread_main, args=())
+                self.thread.daemon = True
+                self.thread.start()
+
+    def stop(self):
+        with self._lock:
+            thread = self.thread
+            self.thread = None
+        if thread is not None:
+            self._enqueue(THREAD_TERMINATOR)
+            thread.join()
+
+    def _wait_for_space(self):
+        with self.space_available:
+            while len(self.pending) >= self.max_queued_records:
+                self.space_available.wait()
+
+    def _put(self, item):
+        if self.thread is None:
+            self.start()
+        self._enqueue(item)
+
+    def _enqueue(self, item):
+        if len(self.pending) >= self.max_queued_records:
+            self._wait_for_space()
+        self.pending.append(item)
+        if self.idle:
+            self.has_work.set()
+
+    def write(self, fp, record):
+        """Appends a record to a journal file. Blocks if too many records are
+        waiting to be written."""
+        # N.B. This is _put(), inlined because it is called for every record.
+        if self.thread is None:
+            self.start()
+        if len(self.pending) >= self.max_queued_records:
+            self._wait_for_space()
+        self.pending.append((_WRITE, fp, record))
+        self.pending_bytes += len(record)
+        if self.idle:
+            self.has_work.set()
+
+    def sync(self, fp=None):
+        """Returns a JournalSyncPoint for all records written so far. If fp
+        is given, the sync point only fails if a record for fp could not be
+        written."""
+        sync_point = JournalSyncPoint(fp)
+        self._put((_SYNC, None, sync_point))
+        return sync_point
+
+    def close(self, fp):
+        """Closes a journal file once all records for it have been
+        committed."""
+        self._put((_CLOSE, fp, None))
+
+    def write_checkpoint(self, filename, state):
+        """Writes a checkpoint, once all records that were written before it
+        have been committed."""
+        self._put((_CHECKPOINT, None, (filename, state)))
+
+    def thread_main(self):
+        pending = self.pending
+        while True:
+            self.idle = True
+            if len(pending) == 0:
+                self.has_work.wait()
+            self.has_work.clear()
+            self.idle = False
+
+            # Unless sync_bytes are already waiting, let sync_interval pass
+            # before committing, so that more records (e.g. from other jobs)
+            # can join the group. A sync point may therefore wait for up to
+            # sync_interval.
+            # N.B. We sleep rather than wait on a condition, because a timed
+            #      wait polls for the GIL.
+            if self.pending_bytes < self.sync_bytes:
+                time.sleep(self.sync_interval)
+            self.pending_bytes = 0
+
+            # Each file is written with a single call.
+            records_for_file = {}
+            sync_points = []
+            to_close = []
+            checkpoints = []
+            should_stop = False
+            self.max_queue_depth = max(self.max_queue_depth, len(pending))
+            while True:
+                try:
+                    item = pending.popleft()
+                except IndexError:
+                    break
+                if item is THREAD_TERMINATOR:
+                    should_stop = True
+                    continue
+                kind, fp, arg = item
+                if kind == _WRITE:
+                    try:
+                        records_for_file[fp].append(arg)
+                    except KeyError:
+                        records_for_file[fp] = [arg]
+                elif kind == _SYNC:
+                    sync_points.append(arg)
+                elif kind == _CLOSE:
+                    to_close.append(fp)
+                elif kind == _CHECKPOINT:
+                    checkpoints.append(arg)
+            with self.space_available:
+                self.space_available.notify_all()
+
+            for fp, records in records_for_file.iteritems():
+                self.write_records(fp, records)
+            self.commit(sync_points)
+
+            for filename, state in checkpoints:
+                try:
+                    self.checkpoint_bytes_written += write_checkpoint(filename, state)
+                    self.checkpoints_written += 1
+                except:
+                    self.write_errors += 1
+                    ciel.log('Error writing checkpoint %s' % filename, 'JOURNAL', logging.ERROR, True)
+
+            for fp in to_close:
+                self.committed_offsets.pop(fp, None)
+                self.written_offsets.pop(fp, None)
+                self.broken_files.pop(fp, None)
+                try:
+                    fp.close()
+                except:
+                    ciel.log('Error closing journal file', 'JOURNAL', logging.WARNING, True)
+
+            if should_stop:
+                break
+
+    def write_records(self, fp, records):
+        data = ''.join(records)
+        uncompressed_bytes = len(data)
+        if self.compress_level > 0:
+            compressed = zlib.compress(data, self.compress_level)
+            # A single short record may not get any smaller.
+            if len(compressed) + RECORD_HEADER_STRUCT.size < uncompressed_bytes:
+                data = RECORD_HEADER_STRUCT.pack(COMPRESSED_RECORD_TYPE, len(compressed)) + compressed
+        try:
+            error = self.broken_files[fp]
+            self.write_errors += 1
+            self.commit_errors[fp] = error
+            return
+        except KeyError:
+            pass
+        # The file is written without Python's buffering, so that a failed
+        # write can be undone.
+        try:
+            fd = fp.fileno()
+            try:
+                offset = self.written_offsets[fp]
+            except KeyError:
+                offset = os.fstat(fd).st_size
+                self.committed_offsets[fp] = offset
+            view = buffer(data)
+            while len(view) > 0:
+                view = view[os.write(fd, view):]
+        except Exception as e:
+            self.fail(fp, e, 'Error writing to journal file')
+            return
+        self.written_offsets[fp] = offset + len(data)
+        self.dirty_files.add(fp)
+        self.records_written += len(records)
+        self.bytes_written += len(data)
+        self.uncompressed_bytes_written += uncompressed_bytes
+        self.rate_window_records += len(records)
+
+    def fail(self, fp, error, message):
+        self.write_errors += 1
+        ciel.log(message, 'JOURNAL', logging.ERROR, True)
+        self.commit_errors[fp] = error
+        self.dirty_files.discard(fp)
+
+        # Discard every record since the last commit, which may end with a
+        # partial record.
+        try:
+            offset = self.committed_offsets[fp]
+        except KeyError:
+            return
+        try:
+            fd = fp.fileno()
+            os.ftruncate(fd, offset)
+            os.lseek(fd, offset, os.SEEK_SET)
+            self.written_offsets[fp] = offset
+        except:
+            ciel.log('Error truncating journal file: no more records will be written to it', 'JOURNAL', logging.ERROR, True)
+            self.broken_files[fp] = error
+
+    def commit(self, sync_points):
+        for fp in list(self.dirty_files):
+            try:
+                start = time.time()
+                os.fsync(fp.fileno())
+                fsync_time = time.time() - start
+                self.fsyncs += 1
+                self.total_fsync_time += fsync_time
+                self.max_fsync_time = max(self.max_fsync_time, fsync_time)
+                self.committed_offsets[fp] = self.written_offsets[fp]
+            except Exception as e:
+                self.fail(fp, e, 'Error syncing journal file')
+        if len(self.dirty_files) > 0:
+            self.commits += 1
+        self.dirty_files = set()
+
+        now = time.time()
+        if now - self.rate_window_start >= 1.0:
+            self.records_per_second = self.rate_window_records / (now - self.rate_window_start)
+            self.rate_window_start = now
+            self.rate_window_records = 0
+
+        commit_errors = self.commit_errors
+        self.commit_errors = {}
+        for sync_point in sync_points:
+            if sync_point.fp is None:
+                error = None
+                for error in commit_errors.itervalues():
+                    break
+            else:
+                error = commit_errors.get(sync_point.fp)
+            sync_point.done(error)
+
+    def get_metrics(self):
+        elapsed = time.time() - self.rate_window_start
+        if elapsed >= 1.0:
+            # The writer has been idle since the last complete window.
+            records_per_second = self.rate_window_records / elapsed
+        else:
+            records_per_second = self.records_per_second
+        return {'records' : self.records_written,
+                'bytes' : self.bytes_written,
+                'uncompressed_bytes' : self.uncompressed_bytes_written,
+                'compress_level' : self.compress_level,
+                'checkpoints' : self.checkpoints_written,
+                'checkpoint_bytes' : self.checkpoint_bytes_written,
+                'records_per_second' : records_per_second,
+                'queue_depth' : len(self.pending),
+                'max_queue_depth' : self.max_queue_depth,
+                'commits' : self.commits,
+                'fsyncs' : self.fsyncs,
+                'mean_fsync_latency' : self.total_fsync_time / self.fsyncs if self.fsyncs > 0 else 0.0,
+                'max_fsync_latency' : self.max_fsync_time,
+                'errors' : self.write_errors,
+                'sync_interval' : self.sync_interval,
+                'sync_bytes' : self.sync_bytes}
@@ -365,7 +365,7 @@ class LazyTaskPool(plugins.SimplePlugin):
                 if conc_ref is not None and conc_ref.is_consumable():
                     task.inputs[local_id] = conc_ref
                     if isinstance(conc_ref, SW2_StreamReference):
-                        task.unfinished_input_streams.add(ref.id)
+                        task.add_unfinished_input_stream(ref.id)
                         self.subscribe_task_to_ref(task, conc_ref)
                 else:
                     # The reference is a future that has not yet been produced,
@@ -459,7 +459,7 @@ class LazyTaskPoolAdapter:
                 raise
             
             task = self.add_task(child, parent_task, parent_task.job, may_reduce)
-            parent_task.children.append(task)
+            parent_task.add_child(task)
             
             if task.continues_task is not None:
                 parent_task.continuation = spawned_task_id
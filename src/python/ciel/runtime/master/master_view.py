@@ -18,12 +18,14 @@ from ciel.public.references import json_decode_object_hook,\
 import sys
 import simplejson
 import cherrypy
-from ciel.runtime.worker.worker_view import DataRoot, StopwatchRoot
+from ciel.runtime.worker.worker_view import DataRoot, StopwatchRoot,\
+    get_request_codec
 from ciel.runtime.master.cluster_view import WebBrowserRoot
 import ciel
 import logging
 import socket
 from ciel.runtime.task_graph import TaskGraphUpdate
+from ciel.public.wire_codec import CODEC_JSON, decode_message
 
 class MasterRoot:
     
@@ -41,14 +43,60 @@ class ControlRoot:
         self.gethostname = HostnameRoot()
         self.shutdown = ShutdownRoot(worker_pool)
         self.browse = WebBrowserRoot(job_pool)
-        self.backup = BackupMasterRoot(backup_sender)
+        self.backup = BackupMasterRoot(backup_sender, monitor, worker_pool.codecs)
         self.ref = RefRoot(job_pool)
         self.stopwatch = StopwatchRoot()
+        self.deferred = DeferredWorkRoot(job_pool.deferred_worker)
+        self.memo = MemoRoot(job_pool.memo_table)
+        self.journal = JournalRoot(job_pool.journal_writer)
 
     @cherrypy.expose
     def index(self):
         return "Hello from the master!"    
 
+class DeferredWorkRoot:
+    
+    def __init__(self, deferred_worker):
+        self.deferred_worker = deferred_worker
+        
+    @cherrypy.expose
+    def index(self):
+        # Return the queue depth and latency of each deferred work shard.
+        return simplejson.dumps(self.deferred_worker.get_shard_metrics(), indent=4)
+
+class JournalRoot:
+    
+    def __init__(self, journal_writer):
+        self.journal_writer = journal_writer
+        
+    @cherrypy.expose
+    def index(self):
+        # Return the throughput and fsync latency of the journal writer.
+        return simplejson.dumps(self.journal_writer.get_metrics(), indent=4)
+
+class MemoRoot:
+    
+    def __init__(self, memo_table):
+        self.memo_table = memo_table
+        
+    @cherrypy.expose
+    def default(self, action=None, id=None):
+        if self.memo_table is None:
+            raise HTTPError(404)
+        if action is None:
+            return simplejson.dumps(self.memo_table.as_descriptor(), indent=4)
+        elif action == 'flush':
+            if id == 'really':
+                kept, removed = self.memo_table.flush_unpinned_entries(True)
+                return 'Kept %d tasks, removed %d tasks' % (kept, removed)
+            else:
+                kept, removed = self.memo_table.flush_unpinned_entries(False)
+                return 'Would keep %d tasks, remove %d tasks' % (kept, removed)
+        elif action == 'pin' and id is not None:
+            self.memo_table.pin_ref_id(id)
+        else:
+            raise HTTPError(404)
+
 class HostnameRoot:
 
     @cherrypy.expose
@@ -80,11 +128,14 @@ class WorkersRoot:
             worker_descriptor = simplejson.loads(request_body)
             if self.monitor is not None and not self.monitor.is_primary:
                 self.monitor.add_worker(worker_descriptor['netloc'])
-                self.backup_sender.add_worker(request_body)
+                self.backup_sender.add_worker(worker_descriptor)
             else:
                 worker_id = self.worker_pool.create_worker(worker_descriptor)
-                self.backup_sender.add_worker(request_body)
-                return simplejson.dumps(str(worker_id))
+                self.backup_sender.add_worker(worker_descriptor)
+                if 'codecs' in worker_descriptor:
+                    return simplejson.dumps({'worker_id': str(worker_id), 'codecs': self.worker_pool.codecs})
+                else:
+                    return simplejson.dumps(str(worker_id))
         elif cherrypy.request.method == 'GET':
             workers = [x.as_descriptor() for x in self.worker_pool.get_all_workers()]
             return simplejson.dumps(workers, indent=4)
@@ -160,7 +211,7 @@ class JobRoot:
             job = self.job_pool.create_job_for_task(task_descriptor, job_options)
             
             # 2bis. Send to backup master.
-            self.backup_sender.add_job(job.id, request_body)
+            self.backup_sender.add_job(job.id, task_descriptor, job_options)
             
             # 2a. Start job. Possibly do this as deferred work.
             self.job_pool.queue_job(job)
@@ -174,6 +225,11 @@ class JobRoot:
         else:
             raise HTTPError(405)
 
+    @cherrypy.expose
+    def shares(self):
+        # Return the fair share, slot quota and slot usage of each running job.
+        return simplejson.dumps(self.job_pool.get_fair_shares(), indent=4)
+
     @cherrypy.expose
     def default(self, id, attribute=None):
         if cherrypy.request.method == 'POST' and attribute is None:
@@ -187,10 +243,10 @@ class JobRoot:
                                                object_hook=json_decode_object_hook)
 
             # 2. Add to job pool (synchronously).
-            job = self.job_pool.create_job_for_task(task_descriptor, job_id=id)
+            job = self.job_pool.create_job_for_task(task_descriptor, {}, job_id=id)
 
             # 2bis. Send to backup master.
-            self.backup_sender.add_job(job.id, request_body)
+            self.backup_sender.add_job(job.id, task_descriptor, {})
             
             if self.monitor is not None and self.monitor.is_primary:
                 # 2a. Start job. Possibly do this as deferred work.
@@ -227,6 +283,9 @@ class JobRoot:
             self.job_pool.queue_job(job)
         elif attribute == 'poke':
             job.schedule()
+        elif attribute == 'steals':
+            # Return the most recent worker-to-worker steals.
+            return simplejson.dumps(job.get_worker_steals(), indent=4)
         else:
             # Invalid attribute.
             raise HTTPError(404)
@@ -253,6 +312,11 @@ class MasterTaskRoot:
         try:
             task = job.task_graph.get_task(task_id)
         except KeyError:
+            if cherrypy.request.method == 'GET' and action is None:
+                try:
+                    return simplejson.dumps(job.get_retired_task_descriptor(task_id), cls=SWReferenceJSONEncoder)
+                except KeyError:
+                    pass
             ciel.log('No such task: %s in job: %s' % (task_id, job_id), 'MASTER', logging.ERROR)
             raise HTTPError(404)
 
@@ -270,20 +334,20 @@ class MasterTaskRoot:
 
         if action == 'report':
             # Multi-spawn-and-commit
-            report_payload = simplejson.loads(cherrypy.request.body.read(), object_hook=json_decode_object_hook)
+            report_payload = decode_message(cherrypy.request.body.read(), get_request_codec(self.worker_pool.codecs))
             worker = self.worker_pool.get_worker_by_id(report_payload['worker'])
             report = report_payload['report']
             job.report_tasks(report, task, worker)
             return
 
         elif action == 'failed':
-            failure_payload = simplejson.loads(cherrypy.request.body.read(), object_hook=json_decode_object_hook)
+            failure_payload = decode_message(cherrypy.request.body.read(), get_request_codec(self.worker_pool.codecs))
             job.investigate_task_failure(task, failure_payload)
             return simplejson.dumps(True)
         
         elif action == 'publish':
             request_body = cherrypy.request.body.read()
-            refs = simplejson.loads(request_body, object_hook=json_decode_object_hook)
+            refs = decode_message(request_body, get_request_codec(self.worker_pool.codecs))
             
             tx = TaskGraphUpdate()
             for ref in refs:
@@ -291,13 +355,13 @@ class MasterTaskRoot:
             tx.commit(job.task_graph)
             job.schedule()
 
-            self.backup_sender.publish_refs(task_id, refs)
+            self.backup_sender.publish_refs(job.id, task_id, refs)
             return
             
         elif action == 'log':
             # Message body is a JSON list containing UNIX timestamp in seconds and a message string.
             request_body = cherrypy.request.body.read()
-            timestamp, message = simplejson.loads(request_body, object_hook=json_decode_object_hook)
+            timestamp, message = decode_message(request_body, get_request_codec(self.worker_pool.codecs))
             ciel.log("%s %f %s" % (task_id, timestamp, message), 'TASK_LOG', logging.INFO)
             
         elif action == 'abort':
@@ -315,16 +379,40 @@ class MasterTaskRoot:
             
 class BackupMasterRoot:
     
-    def __init__(self, backup_sender):
+    def __init__(self, backup_sender, monitor=None, codecs=[CODEC_JSON]):
         self.backup_sender = backup_sender
+        self.monitor = monitor
+        self.codecs = codecs
         
     @cherrypy.expose
     def index(self):
         if cherrypy.request.method == 'POST':
             # Register the  a new global ID, and add the POSTed URLs if any.
-            standby_url = simplejson.loads(cherrypy.request.body.read(), object_hook=json_decode_object_hook)
-            self.backup_sender.register_standby_url(standby_url)
+            standby = simplejson.loads(cherrypy.request.body.read(), object_hook=json_decode_object_hook)
+            if isinstance(standby, dict):
+                self.backup_sender.register_standby_url(standby['url'], standby['codecs'])
+            else:
+                # Older backups send only their URL, and only accept JSON.
+                self.backup_sender.register_standby_url(standby)
             return 'Registered a hot standby'
+        elif cherrypy.request.method == 'GET':
+            # Return the replication lag of each hot standby, and of this
+            # master if it is a hot standby.
+            metrics = {'sender' : self.backup_sender.get_metrics()}
+            if self.monitor is not None:
+                metrics['receiver'] = self.monitor.get_replication_metrics()
+            return simplejson.dumps(metrics, indent=4)
+        else:
+            raise HTTPError(405)
+
+    @cherrypy.expose
+    def replicate(self):
+        if cherrypy.request.method != 'POST':
+            raise HTTPError(405)
+        elif self.monitor is None or self.monitor.is_primary:
+            raise HTTPError(404)
+        frame = decode_message(cherrypy.request.body.read(), get_request_codec(self.codecs))
+        return simplejson.dumps(self.monitor.receive_frame(frame))
         
 class RefRoot:
     
@@ -0,0 +1,305 @@
+# Copyright (c) 2011 Derek Murray <derek.murray@cl.cam.ac.uk>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+'''
+Cross-job task memoization.
+
+The memo table maps a structural hash of a task (its handler, its
+task_private object and its dependencies) to the output references of a task
+with the same hash that has already committed. When a task that hits the table
+is spawned, its outputs are published immediately and it is never run.
+
+Only tasks whose behaviour the master can see are memoized: the task_private
+object must be inline (a data value), and the task must have produced all of
+its outputs as concrete references or data values, without spawning any
+children. A concrete output can only be reused by a task that expects an
+output with the same ID (e.g. the structurally-named outputs of java2 tasks);
+data values are copied under the new ID.
+
+Entries are evicted in least-recently-used order when the table is full, and
+by flush_unpinned_entries(). As in the block store, an entry is never evicted
+while one of its outputs is pinned. An entry is invalidated when a tombstone
+is published for one of its outputs.
+'''
+from __future__ import with_statement
+from ciel.public.references import SW2_ConcreteReference, SWDataValue,\
+    SWReferenceJSONEncoder, json_decode_object_hook
+from ciel.runtime.executors import hash_update_with_structure
+from ciel.runtime.master.journal_writer import RECORD_HEADER_STRUCT
+from threading import Lock
+import ciel
+import collections
+import hashlib
+import logging
+import os
+import simplejson
+
+def get_memo_key(task):
+    """Returns the structural hash of a task, or None if it cannot be
+    memoized."""
+    task_private = task.task_private
+    if task_private is not None and not isinstance(task_private, SWDataValue):
+        # The object is stored in a block, so the master cannot inspect it.
+        return None
+    sha = hashlib.sha1()
+    hash_update_with_structure(sha, task.handler)
+    hash_update_with_structure(sha, len(task.expected_outputs))
+    if task_private is not None:
+        hash_update_with_structure(sha, task_private.value)
+    # The task_private reference is named after the task, so it is hashed by
+    # value above. Other inline dependencies are also hashed by value, and all
+    # remaining dependencies by ID.
+    dependencies = []
+    for ref in task.dependencies.values():
+        if task_private is not None and ref.id == task_private.id:
+            continue
+        elif isinstance(ref, SWDataValue):
+            dependencies.append('val:%s' % ref.value)
+        else:
+            dependencies.append('ref:%s' % ref.id)
+    dependencies.sort()
+    hash_update_with_structure(sha, dependencies)
+    return sha.hexdigest()
+
+def is_memoizable_output(ref):
+    return isinstance(ref, SW2_ConcreteReference) or isinstance(ref, SWDataValue)
+
+class MemoTable:
+
+    def __init__(self, filename=None, max_entries=100000, block_store=None):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.block_store = block_store
+
+        # Mapping from memo key to a list of output references, in least-
+        # recently-used order.
+        self.entries = collections.OrderedDict()
+
+        # Mapping from output ID to the keys of the entries that hold it.
+        self.keys_for_ref = {}
+
+        self.pin_set = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+        self.invalidated = 0
+
+        self.memo_fp = None
+        self._lock = Lock()
+
+        if self.filename is not None:
+            self.load()
+
+    def load(self):
+        # Replay the table file, then rewrite it with only the live entries.
+        try:
+            memo_file = open(self.filename, 'rb')
+        except IOError:
+            memo_file = None
+        if memo_file is not None:
+            try:
+                while True:
+                    record_header = memo_file.read(RECORD_HEADER_STRUCT.size)
+                    if len(record_header) != RECORD_HEADER_STRUCT.size:
+                        break
+                    record_type, record_length = RECORD_HEADER_STRUCT.unpack(record_header)
+                    record_string = memo_file.read(record_length)
+                    if len(record_string) != record_length:
+                        ciel.log('Memo table entry truncated in %s' % self.filename, 'MEMO', logging.WARNING)
+                        break
+                    rec = simplejson.loads(record_string, object_hook=json_decode_object_hook)
+                    if record_type == 'M':
+                        self._add_entry(rec['key'], rec['outputs'])
+                    elif record_type == 'E':
+                        self._remove_entry(rec['key'])
+                    elif record_type == 'P':
+                        self.pin_set.add(rec['id'])
+                    else:
+                        ciel.log('Got invalid record type in memo table %s' % self.filename, 'MEMO', logging.WARNING)
+            finally:
+                memo_file.close()
+
+        new_filename = self.filename + '.new'
+        self.memo_fp = open(new_filename, 'wb')
+        for id in self.pin_set:
+            self._write_record('P', {'id': id})
+        for key, outputs in self.entries.items():
+            self._write_record('M', {'key': key, 'outputs': outputs})
+        self.memo_fp.flush()
+        os.fsync(self.memo_fp.fileno())
+        os.rename(new_filename, self.filename)
+        ciel.log('Loaded %d memoized tasks from %s' % (len(self.entries), self.filename), 'MEMO', logging.INFO)
+
+    def close(self):
+        with self._lock:
+            if self.memo_fp is not None:
+                self.memo_fp.close()
+            self.memo_fp = None
+
+    def _write_record(self, record_type, rec):
+        # Called under self._lock, or during load().
+        if self.memo_fp is not None:
+            rec_string = simplejson.dumps(rec, cls=SWReferenceJSONEncoder)
+            self.memo_fp.write(RECORD_HEADER_STRUCT.pack(record_type, len(rec_string)))
+            self.memo_fp.write(rec_string)
+            self.memo_fp.flush()
+
+    def _add_entry(self, key, outputs):
+        self._remove_entry(key)
+        self.entries[key] = outputs
+        for ref in outputs:
+            try:
+                self.keys_for_ref[ref.id].add(key)
+            except KeyError:
+                self.keys_for_ref[ref.id] = set([key])
+
+    def _remove_entry(self, key):
+        try:
+            outputs = self.entries.pop(key)
+        except KeyError:
+            return False
+        for ref in outputs:
+            keys = self.keys_for_ref[ref.id]
+            keys.discard(key)
+            if len(keys) == 0:
+                del self.keys_for_ref[ref.id]
+        return True
+
+    def is_ref_pinned(self, id):
+        return id in self.pin_set or (self.block_store is not None and id in self.block_store.pin_set)
+
+    def is_entry_pinned(self, outputs):
+        for ref in outputs:
+            if self.is_ref_pinned(ref.id):
+                return True
+        return False
+
+    def _evict(self, key):
+        # Called under self._lock.
+        if self._remove_entry(key):
+            self._write_record('E', {'key': key})
+
+    def _maybe_evict(self, max_scan=16):
+        # Called under self._lock. Pinned entries are moved to the most-
+        # recently-used end as they are skipped, and at most max_scan entries
+        # are looked at, so that each call does a bounded amount of work. If
+        # they are all pinned, the table stays over its limit until a later
+        # call.
+        scanned = 0
+        while len(self.entries) > self.max_entries and scanned < max_scan:
+            key = next(iter(self.entries))
+            outputs = self.entries[key]
+            scanned += 1
+            if self.is_entry_pinned(outputs):
+                del self.entries[key]
+                self.entries[key] = outputs
+            else:
+                self._evict(key)
+                self.evicted += 1
+
+    def lookup(self, task):
+        """Returns the references that a newly-spawned task would produce, or
+        None if the task must run."""
+        key = get_memo_key(task)
+        if key is None:
+            return None
+        with self._lock:
+            try:
+                outputs = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.entries[key] = outputs
+
+            ret = []
+            for output_id, ref in zip(task.expected_outputs, outputs):
+                if ref.id == output_id:
+                    ret.append(ref)
+                elif isinstance(ref, SWDataValue):
+                    ret.append(SWDataValue(output_id, ref.value))
+                else:
+                    # The data is stored under a different name.
+                    self.misses += 1
+                    return None
+            self.hits += 1
+            return ret
+
+    def record(self, task, spawned, published):
+        """Records the outputs of a task that has just committed, if it can be
+        memoized."""
+        if len(spawned) > 0 or len(published) != len(task.expected_outputs):
+            return
+        key = get_memo_key(task)
+        if key is None:
+            return
+        published_refs = dict([(ref.id, ref) for ref in published])
+        outputs = []
+        for output_id in task.expected_outputs:
+            try:
+                ref = published_refs[output_id]
+            except KeyError:
+                return
+            if not is_memoizable_output(ref):
+                return
+            outputs.append(ref)
+        with self._lock:
+            self._add_entry(key, outputs)
+            self._write_record('M', {'key': key, 'outputs': outputs})
+            self.stored += 1
+            self._maybe_evict()
+
+    def invalidate_ref(self, id):
+        """Removes the entries that produced the given reference, e.g. because
+        it has been lost."""
+        with self._lock:
+            try:
+                keys = list(self.keys_for_ref[id])
+            except KeyError:
+                return
+            for key in keys:
+                self._evict(key)
+                self.invalidated += 1
+        ciel.log('Invalidated %d memoized tasks that produced %s' % (len(keys), id), 'MEMO', logging.INFO)
+
+    def pin_ref_id(self, id):
+        with self._lock:
+            if id not in self.pin_set:
+                self.pin_set.add(id)
+                self._write_record('P', {'id': id})
+
+    def flush_unpinned_entries(self, really=True):
+        entries_kept = 0
+        entries_removed = 0
+        with self._lock:
+            for key, outputs in self.entries.items():
+                if self.is_entry_pinned(outputs):
+                    entries_kept += 1
+                else:
+                    if really:
+                        self._evict(key)
+                        self.evicted += 1
+                    entries_removed += 1
+        return (entries_kept, entries_removed)
+
+    def as_descriptor(self):
+        with self._lock:
+            return {'entries': len(self.entries),
+                    'max_entries': self.max_entries,
+                    'pinned_refs': len(self.pin_set),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'stored': self.stored,
+                    'evicted': self.evicted,
+                    'invalidated': self.invalidated}
@@ -12,16 +12,26 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
-from ciel.public.references import SW2_ConcreteReference, SW2_TombstoneReference
+from ciel.public.references import SW2_ConcreteReference, SW2_TombstoneReference,\
+    SW2_FutureReference
+from ciel.public.wire_codec import encode_binary, decode_binary, encode_message,\
+    get_content_type
 from cherrypy.process import plugins
-import urllib2
-from ciel.runtime.block_store import BLOCK_LIST_RECORD_STRUCT
+from ciel.runtime.block_store import build_block_digest_from_descriptor
+from ciel.runtime.pycurl_rpc import post_string
+from threading import Lock
 from ciel.public.references import json_decode_object_hook
+import itertools
 import logging
+import multiprocessing
 import os
 import simplejson
-from ciel.runtime.master.job_pool import RECORD_HEADER_STRUCT,\
-    Job, JOB_ACTIVE, JOB_RECOVERED
+import threading
+import traceback
+from ciel.runtime.master.job_pool import Job, JOB_ACTIVE, JOB_RECOVERED
+from ciel.runtime.master.journal_writer import get_journal_segment_filename,\
+    get_journal_segments, get_checkpoint_filename, read_journal_records,\
+    read_checkpoint
 from ciel.runtime.task import build_taskpool_task_from_descriptor
 import ciel
 import httplib2
@@ -33,7 +43,7 @@ class TaskFailureInvestigator:
         self.deferred_worker = deferred_worker
         
     def investigate_task_failure(self, task_id, failure_payload):
-        self.deferred_worker.do_deferred(lambda: self._investigate_task_failure(task_id, failure_payload))
+        self.deferred_worker.do_deferred(lambda: self._investigate_task_failure(task_id, failure_payload), task_id.job.id)
         
     def _investigate_task_failure(self, task, failure_payload):
         (reason, detail, bindings) = failure_payload
@@ -77,13 +87,109 @@ class TaskFailureInvestigator:
             # Finally, propagate the failure to the task pool, so that we can re-run the failed task.
             task.job.task_graph.task_failed(task, revised_bindings, reason, detail)
 
+# The maximum number of tasks or references in each batch that is applied to
+# the task graph of a recovered job.
+RECOVERY_BATCH_SIZE = 10000
+
+def read_job_journal(job_dir):
+    """
+    Reads the result, checkpoint and task journal of a job, and returns a
+    dictionary containing the root task descriptor, the result (or None if the
+    job had not completed) and, if the job had not completed, a list of
+    batches to apply to its task graph, in order. Each batch is a pair of
+    'T' and a list of task descriptors to spawn, or 'R' and a list of
+    references to publish. Any incomplete record at the end of a journal
+    segment is truncated.
+
+    This does not touch the job pool, so it may run in a recovery process.
+    """
+    result_path = os.path.join(job_dir, 'result')
+    if os.path.exists(result_path):
+        with open(result_path, 'r') as result_file:
+            result = simplejson.load(result_file, object_hook=json_decode_object_hook)
+    else:
+        result = None
+
+    with open(get_journal_segment_filename(job_dir, 0), 'rb') as journal_file:
+        record_type, root_task_descriptor_string = read_journal_records(journal_file).next()
+    assert record_type == 'T'
+    root_task_descriptor = simplejson.loads(root_task_descriptor_string, object_hook=json_decode_object_hook)
+    root_task_id = root_task_descriptor['task_id']
+
+    batches = []
+    def add_to_batch(batch_type, item):
+        if len(batches) == 0 or batches[-1][0] != batch_type or len(batches[-1][1]) >= RECOVERY_BATCH_SIZE:
+            batches.append((batch_type, []))
+        batches[-1][1].append(item)
+
+    if result is None:
+        first_segment = 0
+        checkpoint_path = get_checkpoint_filename(job_dir)
+        if os.path.exists(checkpoint_path):
+            try:
+                checkpoint = read_checkpoint(checkpoint_path)
+            except:
+                ciel.log.error('Could not read checkpoint in %s: replaying the whole journal' % job_dir, 'RECOVERY', logging.WARNING, True)
+                checkpoint = None
+            if checkpoint is not None:
+                for task_descriptor in checkpoint['tasks']:
+                    if task_descriptor['task_id'] != root_task_id:
+                        add_to_batch('T', task_descriptor)
+                for ref in checkpoint['refs']:
+                    add_to_batch('R', ref)
+                first_segment = checkpoint['segment']
+
+        for _, journal_path in get_journal_segments(job_dir, first_segment):
+            with open(journal_path, 'r+b') as journal_file:
+                for record_type, record_string in read_journal_records(journal_file, repair=True):
+                    if record_type == 'R':
+                        ref = simplejson.loads(record_string, object_hook=json_decode_object_hook)['ref']
+                        # Future references are recreated when their
+                        # producing tasks are spawned.
+                        if not isinstance(ref, SW2_FutureReference):
+                            add_to_batch('R', ref)
+                    elif record_type == 'T':
+                        task_descriptor = simplejson.loads(record_string, object_hook=json_decode_object_hook)
+                        if task_descriptor['task_id'] != root_task_id:
+                            add_to_batch('T', task_descriptor)
+                    else:
+                        ciel.log.error('Got invalid record type in %s' % journal_path, 'RECOVERY', logging.WARNING, False)
+
+    return {'root': root_task_descriptor, 'result': result, 'batches': batches}
+
+def try_read_job_journal((job_id, job_dir)):
+    try:
+        return job_id, read_job_journal(job_dir), None
+    except:
+        return job_id, None, traceback.format_exc()
+
+def read_job_journal_in_process(args):
+    # The recovered job is encoded with the binary wire codec, because it is
+    # much cheaper to send (and decode) than the equivalent pickle.
+    job_id, recovered_job, error = try_read_job_journal(args)
+    if recovered_job is not None:
+        recovered_job = encode_binary(recovered_job)
+    return job_id, recovered_job, error
+
 class RecoveryManager(plugins.SimplePlugin):
     
-    def __init__(self, bus, job_pool, block_store, deferred_worker):
+    def __init__(self, bus, job_pool, block_store, deferred_worker, num_processes=None):
         plugins.SimplePlugin.__init__(self, bus)
         self.job_pool = job_pool
         self.block_store = block_store
         self.deferred_worker = deferred_worker
+        if num_processes is None:
+            num_processes = multiprocessing.cpu_count()
+        self.num_processes = num_processes
+        self.recovery_thread = None
+
+        # The block digest of each worker that has registered, and the
+        # recovered jobs that have not completed, so that a worker's blocks
+        # can be found for jobs that are recovered after it registers, and
+        # vice versa.
+        self.block_digests = {}
+        self.recovered_jobs = []
+        self._lock = Lock()
         
     def subscribe(self):
         # In order to present a consistent view to clients, we must do these
@@ -115,126 +221,188 @@ class RecoveryManager(plugins.SimplePlugin):
         if root is None:
             return
         
-        for job_id in os.listdir(root):
+        # Jobs are recovered in the background, so that the master can
+        # schedule new jobs in the meantime, and each recovered job is added
+        # to the job pool as soon as its own journal has been read. The
+        # recovery processes are forked here, before the webserver starts.
+        job_ids = os.listdir(root)
+        pool = self.create_recovery_pool(len(job_ids))
+        self.recovery_thread = threading.Thread(target=self.recover_jobs, args=(root, job_ids, pool))
+        self.recovery_thread.daemon = True
+        self.recovery_thread.start()
 
-            try:
-                job_dir = os.path.join(root, job_id)
-                result_path = os.path.join(job_dir, 'result')
-                if os.path.exists(result_path):
-                    with open(result_path, 'r') as result_file:
-                        result = simplejson.load(result_file, object_hook=json_decode_object_hook)
-                else:
-                    result = None
-                    
-                journal_path = os.path.join(job_dir, 'task_journal')
-                journal_file = open(journal_path, 'rb')
-                record_type, root_task_descriptor_length = RECORD_HEADER_STRUCT.unpack(journal_file.read(RECORD_HEADER_STRUCT.size))
-                root_task_descriptor_string = journal_file.read(root_task_descriptor_length)
-                assert record_type == 'T'
-                assert len(root_task_descriptor_string) == root_task_descriptor_length
-                root_task_descriptor = simplejson.loads(root_task_descriptor_string, object_hook=json_decode_object_hook)
-                root_task = build_taskpool_task_from_descriptor(root_task_descriptor, None)
-                
-                # FIXME: Get the job pool to create this job, because it has access to the scheduler queue and task failure investigator.
-                # FIXME: Store job options somewhere for recovered job.
-                job = Job(job_id, root_task, job_dir, JOB_RECOVERED, self.job_pool, {}, journal=False)
-                
-                root_task.job = job
-                if result is not None:
-                    with job._lock:
-                        job.completed(result)
-                self.job_pool.add_job(job)
-                # Adding the job to the job pool should add the root task.
-                #self.task_pool.add_task(root_task)
-                
-                if result is None:
-                    self.load_other_tasks_defer(job, journal_file)
-                    ciel.log.error('Recovered job %s' % job_id, 'RECOVERY', logging.INFO, False)
-                    ciel.log.error('Recovered task %s for job %s' % (root_task.task_id, job_id), 'RECOVERY', logging.INFO, False)
-                else:
-                    journal_file.close()
-                    ciel.log.error('Found information about job %s' % job_id, 'RECOVERY', logging.INFO, False)
-                
-                
-            except:
-                # We have lost critical data for the job, so we must fail it.
-                ciel.log.error('Error recovering job %s' % job_id, 'RECOVERY', logging.ERROR, True)
-                self.job_pool.add_failed_job(job_id)
+    def create_recovery_pool(self, num_jobs):
+        num_processes = min(self.num_processes, num_jobs)
+        if num_processes > 1:
+            return multiprocessing.Pool(num_processes)
+        else:
+            return None
+
+    def recover_jobs(self, root, job_ids, pool=None):
+        """Reads the journals of the given jobs (in the recovery processes, if
+        there is a pool), and adds each job to the job pool as soon as its
+        journal has been read."""
+        args = [(job_id, os.path.join(root, job_id)) for job_id in job_ids]
+        if pool is not None:
+            recovered_jobs = pool.imap_unordered(read_job_journal_in_process, args)
+        else:
+            recovered_jobs = itertools.imap(try_read_job_journal, args)
+        try:
+            for job_id, recovered_job, error in recovered_jobs:
+                if recovered_job is None:
+                    # We have lost critical data for the job, so we must fail it.
+                    ciel.log.error('Error recovering job %s:\n%s' % (job_id, error), 'RECOVERY', logging.ERROR, False)
+                    self.job_pool.add_failed_job(job_id)
+                    continue
+                try:
+                    if pool is not None:
+                        recovered_job = decode_binary(recovered_job)
+                    self.recover_job(job_id, os.path.join(root, job_id), recovered_job)
+                except:
+                    ciel.log.error('Error recovering job %s' % job_id, 'RECOVERY', logging.ERROR, True)
+                    self.job_pool.add_failed_job(job_id)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        ciel.log.error('Recovered %d jobs' % len(job_ids), 'RECOVERY', logging.INFO, False)
 
-    def load_other_tasks_defer(self, job, journal_file):
-        self.deferred_worker.do_deferred(lambda: self.load_other_tasks_for_job(job, journal_file))
+    def recover_job(self, job_id, job_dir, recovered_job):
+        root_task = build_taskpool_task_from_descriptor(recovered_job['root'], None)
+        result = recovered_job['result']
+                
+        # FIXME: Get the job pool to create this job, because it has access to the scheduler queue and task failure investigator.
+        # FIXME: Store job options somewhere for recovered job.
+        job = Job(job_id, root_task, job_dir, JOB_RECOVERED, self.job_pool, {}, journal=False)
+        
+        root_task.job = job
+        if result is not None:
+            with job._lock:
+                job.completed(result)
+        self.job_pool.add_job(job)
+        # Adding the job to the job pool should add the root task.
+        #self.task_pool.add_task(root_task)
+        
+        if result is None:
+            self.load_other_tasks_for_job(job, recovered_job['batches'])
+            ciel.log.error('Recovered job %s with %d tasks' % (job_id, len(job.task_graph.tasks)), 'RECOVERY', logging.INFO, False)
+            with self._lock:
+                self.recovered_jobs.append(job)
+                block_digests = self.block_digests.values()
+            if len(block_digests) > 0:
+                self.fetch_blocks_for_jobs(block_digests, [job])
+        else:
+            ciel.log.error('Found information about job %s' % job_id, 'RECOVERY', logging.INFO, False)
 
-    def load_other_tasks_for_job(self, job, journal_file):
+    def load_other_tasks_for_job(self, job, batches):
         '''
-        Process a the task journal for a recovered job.
+        Apply the batches of tasks and references that were read from the
+        checkpoint and task journal of a recovered job.
         '''
         try:
-            while True:
-                record_header = journal_file.read(RECORD_HEADER_STRUCT.size)
-                if len(record_header) != RECORD_HEADER_STRUCT.size:
-                    ciel.log.error('Journal entry truncated for job %s' % job.id, 'RECOVERY', logging.WARNING, False)
-                    # XXX: Need to truncate the journal file.
-                    break
-                record_type, record_length = RECORD_HEADER_STRUCT.unpack(record_header)
-                record_string = journal_file.read(record_length)
-                if len(record_string) != record_length:
-                    ciel.log.error('Journal entry truncated for job %s' % job.id, 'RECOVERY', logging.WARNING, False)
-                    # XXX: Need to truncate the journal file.
-                    break
-                rec = simplejson.loads(record_string, object_hook=json_decode_object_hook)
-                if record_type == 'R':
-                    job.task_graph.publish(rec['ref'])
-                elif record_type == 'T':
-                    task_id = rec['task_id']
-                    parent_task = job.task_graph.get_task(rec['parent'])
-                    task = build_taskpool_task_from_descriptor(rec, parent_task)
-                    task.job = job
-                    task.parent.children.append(task)
-    
-                    ciel.log.error('Recovered task %s for job %s' % (task_id, job.id), 'RECOVERY', logging.INFO, False)
-                    job.task_graph.spawn(task)
-                else:
-                    ciel.log.error('Got invalid record type in job %s' % job.id, 'RECOVERY', logging.WARNING, False)
+            with job._lock:
+                for batch_type, batch in batches:
+                    if batch_type == 'T':
+                        for task_descriptor in batch:
+                            self.recover_task(job, task_descriptor)
+                    else:
+                        for ref in batch:
+                            job.task_graph.publish(ref)
                 
         except:
             ciel.log.error('Error recovering task_journal for job %s' % job.id, 'RECOVERY', logging.WARNING, True)
 
         finally:
-            journal_file.close()
             job.restart_journalling()
             if job.state == JOB_ACTIVE:
                 ciel.log.error('Restarting recovered job %s' % job.id, 'RECOVERY', logging.INFO)
             # We no longer immediately start a job when recovering it.
             #self.job_pool.restart_job(job)
 
-    def fetch_block_list_defer(self, worker):
-        ciel.log('Fetching block list is currently disabled', 'RECOVERY', logging.WARNING)
-        #self.deferred_worker.do_deferred(lambda: self.fetch_block_names_from_worker(worker))
-        
-    def fetch_block_names_from_worker(self, worker):
+    def recover_task(self, job, task_descriptor):
+        # Called under job._lock.
+        task_id = task_descriptor['task_id']
+        if task_id in job.task_graph.tasks:
+            return
+        try:
+            parent_task = job.task_graph.get_task(task_descriptor['parent'])
+        except KeyError:
+            # The parent was retired before the checkpoint was taken.
+            parent_task = None
+        task = build_taskpool_task_from_descriptor(task_descriptor, parent_task)
+        task.job = job
+        job.task_graph.spawn(task)
+
+    def fetch_block_list_defer(self, worker, block_digest):
+        try:
+            block_digest = build_block_digest_from_descriptor(block_digest)
+        except:
+            ciel.log.error('Ignoring invalid block digest from worker %s' % worker.netloc, 'RECOVERY', logging.WARNING, True)
+            return
+        with self._lock:
+            self.block_digests[worker.netloc] = (worker, block_digest)
+            self.recovered_jobs = [job for job in self.recovered_jobs if job.state == JOB_RECOVERED or job.state == JOB_ACTIVE]
+            jobs = list(self.recovered_jobs)
+        if len(jobs) > 0:
+            self.deferred_worker.do_deferred(lambda: self.fetch_blocks_for_jobs([(worker, block_digest)], jobs))
+
+    def fetch_blocks_for_jobs(self, block_digests, jobs):
         '''
-        Loop through the block list file from the given worker, and publish the
-        references found there.
+        Finds the blocks that the given recovered jobs are waiting for on each
+        worker whose digest might contain them, and publishes the references
+        that the workers confirm.
         '''
-        
-        block_file = urllib2.urlopen('http://%s/control/data/' % worker.netloc)
-
-        while True:
-            record = block_file.read(BLOCK_LIST_RECORD_STRUCT.size)
-            if not record:
-                break
-            block_name, block_size = BLOCK_LIST_RECORD_STRUCT.unpack(record)
-            conc_ref = SW2_ConcreteReference(block_name, block_size)
-            conc_ref.add_location_hint(worker.netloc)
+        # Only the references that recovered jobs are waiting for are
+        # requested, and only from workers whose digests contain them.
+        jobs_for_id = {}
+        for job in jobs:
+            if job.state != JOB_RECOVERED and job.state != JOB_ACTIVE:
+                continue
+            with job._lock:
+                wanted_ids = [id for id, ref_table_entry in job.task_graph.references.iteritems() if isinstance(ref_table_entry.ref, SW2_FutureReference)]
+            for id in wanted_ids:
+                try:
+                    jobs_for_id[id].append(job)
+                except KeyError:
+                    jobs_for_id[id] = [job]
+        if len(jobs_for_id) == 0:
+            return
+
+        for worker, block_digest in block_digests:
+            if worker.failed:
+                continue
+            candidate_ids = [id for id in jobs_for_id if id in block_digest]
+            if len(candidate_ids) == 0:
+                continue
+            try:
+                block_sizes = self.fetch_block_sizes_from_worker(worker, candidate_ids)
+            except:
+                ciel.log.error('Could not fetch block inventory from worker %s' % worker.netloc, 'RECOVERY', logging.WARNING, True)
+                continue
             
-            #ciel.log.error('Recovering block %s (size=%d)' % (block_name, block_size), 'RECOVERY', logging.INFO)
-            # FIXME: What should we do with recovered blocks?
-            self.task_pool.publish_single_ref(block_name, conc_ref, None, False)
+            refs_for_job = {}
+            for id, size in block_sizes:
+                ref = SW2_ConcreteReference(id, size, [worker.netloc])
+                for job in jobs_for_id[id]:
+                    try:
+                        refs_for_job[job].append(ref)
+                    except KeyError:
+                        refs_for_job[job] = [ref]
+            for job, refs in refs_for_job.iteritems():
+                self.publish_recovered_refs(job, refs)
+            ciel.log.error('Found %d of %d candidate blocks for recovered jobs on worker %s' % (len(block_sizes), len(candidate_ids), worker.netloc), 'RECOVERY', logging.INFO, False)
 
-        
-        block_file.close()
-        
         # Publishing recovered blocks may cause tasks to become QUEUED, so we
         # must run the scheduler.
         self.bus.publish('schedule')
-        
+
+    def fetch_block_sizes_from_worker(self, worker, ids):
+        return simplejson.loads(post_string('http://%s/control/inventory/' % worker.netloc, encode_message(ids, worker.codec), get_content_type(worker.codec)))
+
+    def publish_recovered_refs(self, job, refs):
+        # The references are published in batches, so that the job lock is
+        # not held for long.
+        for i in range(0, len(refs), RECOVERY_BATCH_SIZE):
+            with job._lock:
+                for ref in refs[i:i + RECOVERY_BATCH_SIZE]:
+                    job.task_graph.publish(ref)
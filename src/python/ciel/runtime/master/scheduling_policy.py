@@ -12,19 +12,138 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 from ciel.public.references import SW2_SweetheartReference, SW2_ConcreteReference,\
-    SW2_StreamReference
+    SW2_StreamReference, netloc_table
 import random
 
 
+class LocalityIndex:
+    """
+    Caches the locality saving that each reference offers, keyed by
+    reference ID, and kept up-to-date as references are published.
+
+    Each reference is reduced to a placement, which is a tuple of (netloc,
+    multiplier) pairs, and a weight. Placements are interned, so that the
+    savings for a set of inputs can be computed by summing the weights for
+    each distinct placement, and only then expanding those sums by netloc.
+    References that share location hints therefore share a placement, and
+    the placement is found from the reference's location mask without
+    decoding its location hints.
+    """
+    
+    def __init__(self, sweetheart_factor, stream_source_bytes_equivalent):
+        self.sweetheart_factor = sweetheart_factor
+        self.stream_source_bytes_equivalent = stream_source_bytes_equivalent
+        # Mapping from reference ID to (placement ID, weight).
+        self.entries = {}
+        self.placement_ids = {}
+        self.placements = []
+        # Mapping from (kind, location mask, sweetheart netloc) to placement ID.
+        self.mask_placement_ids = {}
+        
+    def __len__(self):
+        return len(self.entries)
+        
+    def intern_placement(self, multipliers):
+        placement = tuple(sorted(multipliers.items()))
+        try:
+            return self.placement_ids[placement]
+        except KeyError:
+            placement_id = len(self.placements)
+            self.placement_ids[placement] = placement_id
+            self.placements.append(placement)
+            return placement_id
+        
+    def make_multipliers(self, ref):
+        if isinstance(ref, SW2_SweetheartReference):
+            # Sweetheart references get a boosted benefit for the sweetheart, and unboosted benefit for all other netlocs.
+            multipliers = dict([(netloc, 1) for netloc in ref.location_hints])
+            multipliers[ref.sweetheart_netloc] = multipliers.get(ref.sweetheart_netloc, 0) + self.sweetheart_factor
+            return multipliers
+        else:
+            return dict([(netloc, 1) for netloc in ref.location_hints])
+        
+    def make_entry(self, ref):
+        if isinstance(ref, SW2_SweetheartReference) and ref.size_hint is not None:
+            key = ('<3', ref.location_mask, ref.sweetheart_netloc)
+            weight = ref.size_hint
+        elif isinstance(ref, SW2_ConcreteReference) and ref.size_hint is not None:
+            # Concrete references get an unboosted benefit for all netlocs.
+            key = ('c2', ref.location_mask, None)
+            weight = ref.size_hint
+        elif isinstance(ref, SW2_StreamReference):
+            # Stream references get a heuristically-chosen benefit for stream sources.
+            key = ('s2', ref.location_mask, None)
+            weight = self.stream_source_bytes_equivalent
+        else:
+            # Other references offer no saving anywhere.
+            return (self.intern_placement({}), 0)
+        try:
+            placement_id = self.mask_placement_ids[key]
+        except KeyError:
+            placement_id = self.intern_placement(self.make_multipliers(ref))
+            self.mask_placement_ids[key] = placement_id
+        return (placement_id, weight)
+    
+    def update(self, ref):
+        """Called when a reference is published, after its location hints
+        have been merged."""
+        self.entries[ref.id] = self.make_entry(ref)
+        
+    def remove(self, id):
+        """Called when a reference is retired from the task graph."""
+        try:
+            del self.entries[id]
+        except KeyError:
+            pass
+        
+    def lookup(self, id, ref):
+        try:
+            return self.entries[id]
+        except KeyError:
+            entry = self.make_entry(ref)
+            if id == ref.id:
+                self.entries[id] = entry
+            return entry
+            
+    def get_savings(self, inputs):
+        """Returns a dictionary mapping each netloc to the saving that it
+        offers for the given inputs, which map reference IDs to references."""
+        cached = map(self.entries.get, inputs)
+        if None in cached:
+            # Some inputs have not been published through the task graph.
+            cached = [self.lookup(id, ref) for id, ref in inputs.iteritems()]
+        
+        weight_by_placement = {}
+        get_weight = weight_by_placement.get
+        for placement_id, weight in cached:
+            weight_by_placement[placement_id] = get_weight(placement_id, 0) + weight
+            
+        netlocs = {}
+        placements = self.placements
+        for placement_id, weight in weight_by_placement.iteritems():
+            for netloc, multiplier in placements[placement_id]:
+                netlocs[netloc] = netlocs.get(netloc, 0) + multiplier * weight
+        return netlocs
+
 class SchedulingPolicy:
     
     def __init__(self):
         pass
     
+    def get_locality_index(self):
+        """Returns an index that the job should keep up-to-date as references
+        are published, or None if this policy does not use one."""
+        return None
+    
     def select_workers_for_task(self, task, worker_pool):
         """Returns a list of workers on which to run the given task."""
         raise Exception("Subclass must implement this")
     
+    def get_locality_delay(self, saving):
+        """Returns the number of seconds that a task should wait for a slot on
+        one of its selected workers before it may be stolen by another."""
+        return 0.0
+    
 class RandomSchedulingPolicy(SchedulingPolicy):
     
     def __init__(self):
@@ -58,14 +177,41 @@ class TwoRandomChoiceSchedulingPolicy(SchedulingPolicy):
 
 class LocalitySchedulingPolicy(SchedulingPolicy):
     
-    def __init__(self, sweetheart_factor=1000, equally_local_margin=0.9, stream_source_bytes_equivalent=10000000, min_saving_threshold=1048576):
+    def __init__(self, sweetheart_factor=1000, equally_local_margin=0.9, stream_source_bytes_equivalent=10000000, min_saving_threshold=1048576, delay_scheduling=False, locality_wait=1.0, locality_wait_per_gb=5.0, max_locality_wait=30.0, use_locality_index=True):
         self.sweetheart_factor = sweetheart_factor
         self.equally_local_margin = equally_local_margin
         self.stream_source_bytes_equivalent = stream_source_bytes_equivalent 
         self.min_saving_threshold = min_saving_threshold
+        
+        if use_locality_index:
+            self.locality_index = LocalityIndex(sweetheart_factor, stream_source_bytes_equivalent)
+        else:
+            self.locality_index = None
+        
+        # Delay scheduling [Zaharia et al. EuroSys 2010]: a task with a
+        # locality preference may only be stolen from the global queue after
+        # waiting for a local slot. The wait grows with the bytes it would save.
+        self.delay_scheduling = delay_scheduling
+        self.locality_wait = locality_wait
+        self.locality_wait_per_gb = locality_wait_per_gb
+        self.max_locality_wait = max_locality_wait
     
-    def select_workers_for_task(self, task, worker_pool):
+    def get_locality_delay(self, saving):
+        if not self.delay_scheduling or saving <= 0:
+            return 0.0
+        return min(self.max_locality_wait, self.locality_wait + self.locality_wait_per_gb * saving / 1073741824.0)
+    
+    def get_locality_index(self):
+        return self.locality_index
+    
+    def get_netloc_savings(self, task):
+        if self.locality_index is not None:
+            return self.locality_index.get_savings(task.inputs)
+        
         netlocs = {}
+        # Inputs are summed by location mask, so that each distinct set of
+        # location hints is only expanded once.
+        weight_by_mask = {}
         for input in task.inputs.values():
             
             if isinstance(input, SW2_SweetheartReference) and input.size_hint is not None:
@@ -75,31 +221,37 @@ class LocalitySchedulingPolicy(SchedulingPolicy):
                 except KeyError:
                     current_saving_for_netloc = 0
                 netlocs[input.sweetheart_netloc] = current_saving_for_netloc + self.sweetheart_factor * input.size_hint
-                
-                for netloc in input.location_hints:
-                    try:
-                        current_saving_for_netloc = netlocs[netloc]
-                    except KeyError:
-                        current_saving_for_netloc = 0
-                    netlocs[netloc] = current_saving_for_netloc + input.size_hint
+                weight = input.size_hint
                     
             elif isinstance(input, SW2_ConcreteReference) and input.size_hint is not None:
                 # Concrete references get an unboosted benefit for all netlocs.
-                for netloc in input.location_hints:
-                    try:
-                        current_saving_for_netloc = netlocs[netloc]
-                    except KeyError:
-                        current_saving_for_netloc = 0
-                    netlocs[netloc] = current_saving_for_netloc + input.size_hint
+                weight = input.size_hint
                     
             elif isinstance(input, SW2_StreamReference):
                 # Stream references get a heuristically-chosen benefit for stream sources.
-                for netloc in input.location_hints:
-                    try:
-                        current_saving_for_netloc = netlocs[netloc]
-                    except KeyError:
-                        current_saving_for_netloc = 0
-                    netlocs[netloc] = current_saving_for_netloc + self.stream_source_bytes_equivalent
+                weight = self.stream_source_bytes_equivalent
+                
+            else:
+                continue
+            
+            try:
+                weight_by_mask[input.location_mask] += weight
+            except KeyError:
+                weight_by_mask[input.location_mask] = weight
+                
+        for mask, weight in weight_by_mask.iteritems():
+            for netloc in netloc_table.netlocs_for_mask(mask):
+                try:
+                    current_saving_for_netloc = netlocs[netloc]
+                except KeyError:
+                    current_saving_for_netloc = 0
+                netlocs[netloc] = current_saving_for_netloc + weight
+        
+        return netlocs
+    
+    def select_workers_for_task(self, task, worker_pool):
+        task.locality_delay = 0.0
+        netlocs = self.get_netloc_savings(task)
                     
         ranked_netlocs = [(saving, netloc) for (netloc, saving) in netlocs.items()]
         filtered_ranked_netlocs = filter(lambda (saving, netloc) : worker_pool.get_worker_at_netloc(netloc) is not None and saving > self.min_saving_threshold, ranked_netlocs)
@@ -109,19 +261,87 @@ class LocalitySchedulingPolicy(SchedulingPolicy):
             # If we have no preference for any worker, use the power of two random choices. [Azar et al. STOC 1994]
             worker1 = worker_pool.get_random_worker_with_capacity_weight(task.scheduling_class)
             return [worker1]
-        elif len(filtered_ranked_netlocs) == 1:
+        
+        task.locality_delay = self.get_locality_delay(filtered_ranked_netlocs[0][0])
+        
+        if len(filtered_ranked_netlocs) == 1:
             return [worker_pool.get_worker_at_netloc(filtered_ranked_netlocs[0][1])]
         
         else:
             threshold = filtered_ranked_netlocs[0][0] * self.equally_local_margin
             return [worker_pool.get_worker_at_netloc(netloc) for saved, netloc in filtered_ranked_netlocs if saved > threshold]
                 
+class CostModelSchedulingPolicy(SchedulingPolicy):
+    """
+    Chooses the worker on which the task is expected to complete soonest.
+    The estimate for each candidate worker is the sum of the work already
+    queued on it, the time to fetch the inputs that it does not hold, and the
+    expected runtime of the task, all based on statistics kept by the job.
+    """
+    
+    def __init__(self, default_task_cost=1.0, default_bandwidth=100000000.0, stream_source_bytes_equivalent=10000000, num_random_candidates=2):
+        self.default_task_cost = default_task_cost
+        self.default_bandwidth = default_bandwidth
+        self.stream_source_bytes_equivalent = stream_source_bytes_equivalent
+        self.num_random_candidates = num_random_candidates
+        
+    def get_candidate_workers(self, task, worker_pool):
+        # Workers that hold some input, and a few chosen at random so that
+        # tasks may move away from busy data holders.
+        candidates = set()
+        for input in task.inputs.values():
+            netlocs = getattr(input, 'location_hints', ())
+            if isinstance(input, SW2_SweetheartReference):
+                netlocs = list(netlocs) + [input.sweetheart_netloc]
+            for netloc in netlocs:
+                worker = worker_pool.get_worker_at_netloc(netloc)
+                if worker is not None:
+                    candidates.add(worker)
+        candidates.update(worker_pool.get_random_workers_with_capacity_weight(task.scheduling_class, self.num_random_candidates))
+        return candidates
+    
+    def get_transfer_time(self, task, worker):
+        job = task.job
+        transfer_time = 0.0
+        for input in task.inputs.values():
+            if isinstance(input, SW2_ConcreteReference) and input.size_hint is not None:
+                size = input.size_hint
+            elif isinstance(input, SW2_StreamReference):
+                size = self.stream_source_bytes_equivalent
+            else:
+                continue
+            if input.has_location_hint(worker.netloc):
+                continue
+            bandwidths = [job.get_fetch_bandwidth(netloc) for netloc in input.location_hints]
+            bandwidths = [x for x in bandwidths if x is not None]
+            bandwidth = max(bandwidths) if len(bandwidths) > 0 else self.default_bandwidth
+            transfer_time += size / bandwidth
+        return transfer_time
+    
+    def get_completion_time(self, task, worker):
+        job = task.job
+        runtime = job.estimate_task_runtime(task, worker)
+        if runtime is None:
+            runtime = self.default_task_cost
+        return job.estimate_queued_work(task, worker) + self.get_transfer_time(task, worker) + runtime
+    
+    def select_workers_for_task(self, task, worker_pool):
+        best_worker = None
+        best_time = None
+        for worker in self.get_candidate_workers(task, worker_pool):
+            completion_time = self.get_completion_time(task, worker)
+            if best_time is None or completion_time < best_time:
+                best_worker = worker
+                best_time = completion_time
+        return [best_worker]
+
 SCHEDULING_POLICIES = {'random' : RandomSchedulingPolicy,
                        'tworandom' : TwoRandomChoiceSchedulingPolicy,
-                       'locality' : LocalitySchedulingPolicy}
+                       'locality' : LocalitySchedulingPolicy,
+                       'cost' : CostModelSchedulingPolicy}
 
 def get_scheduling_policy(policy_name, *args, **kwargs):
     if policy_name is None:
-        return LocalitySchedulingPolicy()
+        return LocalitySchedulingPolicy(*args, **kwargs)
     else:
         return SCHEDULING_POLICIES[policy_name](*args, **kwargs)
\ No newline at end of file
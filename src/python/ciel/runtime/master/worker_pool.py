@@ -13,7 +13,10 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 from __future__ import with_statement
 from Queue import Queue
-from ciel.public.references import SWReferenceJSONEncoder
+from ciel.public.references import netloc_table
+from ciel.public.wire_codec import SUPPORTED_CODECS, CODEC_JSON,\
+    negotiate_codec, encode_message, write_framed_message, get_content_type
+from cStringIO import StringIO
 from ciel.runtime.pycurl_rpc import post_string_noreturn, get_string
 import ciel
 import datetime
@@ -24,6 +27,82 @@ import threading
 import uuid
 from urlparse import urlparse
 
+class WorkerCapacityIndex:
+    """
+    Binary indexed tree over the capacities of the workers in a scheduling
+    class, which supports capacity-weighted sampling, insertion and removal
+    in O(log n) time. Positions freed by failed workers are reused.
+    """
+    
+    def __init__(self):
+        self.tree = [0]
+        self.entries = []
+        self.positions = {}
+        self.free_positions = []
+        self.total = 0
+        
+    def __len__(self):
+        return len(self.positions)
+        
+    def _prefix_sum(self, i):
+        result = 0
+        while i > 0:
+            result += self.tree[i]
+            i -= i & -i
+        return result
+    
+    def _update(self, i, delta):
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+            
+    def _append_position(self):
+        # The new node covers (n - lowbit(n), n], whose last element is zero.
+        n = len(self.tree)
+        self.tree.append(self._prefix_sum(n - 1) - self._prefix_sum(n - (n & -n)))
+        self.entries.append(None)
+        return n - 1
+        
+    def add(self, worker, capacity):
+        try:
+            position = self.free_positions.pop()
+        except IndexError:
+            position = self._append_position()
+        self.entries[position] = (worker, capacity)
+        self.positions[worker] = position
+        self._update(position + 1, capacity)
+        self.total += capacity
+        
+    def remove(self, worker):
+        position = self.positions.pop(worker)
+        _, capacity = self.entries[position]
+        self.entries[position] = None
+        self.free_positions.append(position)
+        self._update(position + 1, -capacity)
+        self.total -= capacity
+        
+    def find(self, selected_slot):
+        """Returns the worker that owns the given slot, where 0 <= selected_slot < self.total."""
+        position = 0
+        mask = 1
+        while mask * 2 < len(self.tree):
+            mask *= 2
+        while mask > 0:
+            next = position + mask
+            if next < len(self.tree) and self.tree[next] <= selected_slot:
+                position = next
+                selected_slot -= self.tree[next]
+            mask //= 2
+        try:
+            return self.entries[position][0]
+        except (IndexError, TypeError):
+            return None
+        
+    def sample(self):
+        if self.total <= 0:
+            return None
+        return self.find(random.randrange(self.total))
+
 class FeatureQueues:
     def __init__(self):
         self.queues = {}
@@ -52,6 +131,16 @@ class Worker:
         self.netloc = worker_descriptor['netloc']
         self.features = worker_descriptor['features']
         self.scheduling_classes = worker_descriptor['scheduling_classes']
+        try:
+            self.codec = negotiate_codec(worker_pool.codecs, worker_descriptor['codecs'])
+        except KeyError:
+            # Older workers only accept JSON.
+            self.codec = CODEC_JSON
+        try:
+            self.task_batches = worker_descriptor['task_batches']
+        except KeyError:
+            # Older workers only accept one task per request.
+            self.task_batches = False
         self.last_ping = datetime.datetime.now()
         self.failed = False
         self.worker_pool = worker_pool
@@ -79,17 +168,22 @@ class Worker:
                 'netloc': self.netloc,
                 'features': self.features,
                 'last_ping': self.last_ping.ctime(),
+                'codec': self.codec,
                 'failed':  self.failed}
         
 class WorkerPool:
     
-    def __init__(self, bus, deferred_worker, job_pool):
+    def __init__(self, bus, deferred_worker, job_pool, codecs=SUPPORTED_CODECS):
         self.bus = bus
         self.deferred_worker = deferred_worker
         self.job_pool = job_pool
         self.idle_worker_queue = Queue()
         self.workers = {}
         self.netlocs = {}
+        # Interns worker netlocs for the location hints in references.
+        self.netloc_table = netloc_table
+        # The wire codecs that the master accepts, in order of preference.
+        self.codecs = codecs
         self.idle_set = set()
         self._lock = threading.RLock()
         self.feature_queues = FeatureQueues()
@@ -98,8 +192,7 @@ class WorkerPool:
         self.max_concurrent_waiters = 5
         self.current_waiters = 0
         self.is_stopping = False
-        self.scheduling_class_capacities = {'*' : []}
-        self.scheduling_class_total_capacities = {'*' : 0}
+        self.scheduling_class_capacities = {'*' : WorkerCapacityIndex()}
 
     def subscribe(self):
         self.bus.subscribe('start', self.start, 75)
@@ -135,6 +228,7 @@ class WorkerPool:
             except KeyError:
                 pass
             self.netlocs[worker.netloc] = worker
+            self.netloc_table.get_id(worker.netloc)
             self.idle_set.add(id)
             self.event_count += 1
             self.event_condvar.notify_all()
@@ -142,15 +236,20 @@ class WorkerPool:
             for scheduling_class, capacity in worker.scheduling_classes.items():
                 try:
                     capacities = self.scheduling_class_capacities[scheduling_class]
-                    current_total = self.scheduling_class_total_capacities[scheduling_class]
-                except:
-                    capacities = []
+                except KeyError:
+                    capacities = WorkerCapacityIndex()
                     self.scheduling_class_capacities[scheduling_class] = capacities
-                    current_total = 0
-                capacities.append((worker, capacity))
-                self.scheduling_class_total_capacities[scheduling_class] = current_total + capacity
+                capacities.add(worker, capacity)
 
             self.job_pool.notify_worker_added(worker)
+
+            try:
+                block_digest = worker_descriptor['block_digest']
+            except KeyError:
+                block_digest = None
+            if block_digest is not None:
+                # The worker may hold blocks that recovered jobs need.
+                self.bus.publish('fetch_block_list', worker, block_digest)
             return id
 
     def notify_job_about_current_workers(self, job):
@@ -159,16 +258,6 @@ class WorkerPool:
             for worker in self.workers.values():
                 job.notify_worker_added(worker)
 
-# XXX: This is currently disabled because we don't have a big central list of references.
-#        try:
-#            has_blocks = worker_descriptor['has_blocks']
-#        except:
-#            has_blocks = False
-#            
-#        if has_blocks:
-#            ciel.log.error('%s has blocks, so will fetch' % str(worker), 'WORKER_POOL', logging.INFO)
-#            self.bus.publish('fetch_block_list', worker)
-            
         self.bus.publish('schedule')
         return id
     
@@ -191,8 +280,26 @@ class WorkerPool:
         try:
             ciel.stopwatch.stop("master_task")
             
-            message = simplejson.dumps(task.as_descriptor(), cls=SWReferenceJSONEncoder)
-            post_string_noreturn("http://%s/control/task/" % (worker.netloc), message, result_callback=self.worker_post_result_callback)
+            message = encode_message(task.as_descriptor(), worker.codec)
+            post_string_noreturn("http://%s/control/task/" % (worker.netloc), message, result_callback=self.worker_post_result_callback, content_type=get_content_type(worker.codec))
+        except:
+            self.worker_failed(worker)
+
+    def execute_tasks_on_worker(self, worker, tasks):
+        if not worker.task_batches:
+            for task in tasks:
+                self.execute_task_on_worker(worker, task)
+            return
+        elif len(tasks) == 1:
+            return self.execute_task_on_worker(worker, tasks[0])
+        try:
+            ciel.stopwatch.stop("master_task")
+
+            # The batch is a sequence of length-prefixed task descriptors.
+            message = StringIO()
+            for task in tasks:
+                write_framed_message(task.as_descriptor(), message, worker.codec)
+            post_string_noreturn("http://%s/control/task/batch" % (worker.netloc), message.getvalue(), result_callback=self.worker_post_result_callback, content_type=get_content_type(worker.codec))
         except:
             self.worker_failed(worker)
 
@@ -210,12 +317,11 @@ class WorkerPool:
             del self.netlocs[worker.netloc]
             del self.workers[worker.id]
 
-            for scheduling_class, capacity in worker.scheduling_classes.items():
-                self.scheduling_class_capacities[scheduling_class].remove((worker, capacity))
-                self.scheduling_class_total_capacities[scheduling_class] -= capacity
-                if self.scheduling_class_total_capacities[scheduling_class] == 0:
+            for scheduling_class in worker.scheduling_classes.keys():
+                capacities = self.scheduling_class_capacities[scheduling_class]
+                capacities.remove(worker)
+                if len(capacities) == 0 and scheduling_class != '*':
                     del self.scheduling_class_capacities[scheduling_class]
-                    del self.scheduling_class_total_capacities[scheduling_class]
 
         if self.job_pool is not None:
             self.job_pool.notify_worker_failed(worker)
@@ -244,31 +350,33 @@ class WorkerPool:
         with self._lock:
             return random.choice(self.workers.values())
         
-    def get_random_worker_with_capacity_weight(self, scheduling_class):
-        
+    def get_capacity_index(self, scheduling_class):
+        # Called under self._lock.
+        try:
+            return self.scheduling_class_capacities[scheduling_class]
+        except KeyError:
+            return self.scheduling_class_capacities['*']
+
+    def get_scheduling_class_capacities(self):
+        """Returns the total number of slots in each scheduling class."""
         with self._lock:
-            try:
-                candidates = self.scheduling_class_capacities[scheduling_class]
-                total_capacity = self.scheduling_class_total_capacities[scheduling_class]
-            except KeyError:
-                scheduling_class = '*'
-                candidates = self.scheduling_class_capacities['*']
-                total_capacity = self.scheduling_class_total_capacities['*']
-        
-            if total_capacity == 0:
-                return None
+            return dict([(c, capacities.total) for c, capacities in self.scheduling_class_capacities.items()])
 
-            selected_slot = random.randrange(total_capacity)
-            curr_slot = 0
-            i = 0
-            
-            for worker, capacity in candidates:
-                curr_slot += capacity
-                if curr_slot > selected_slot:
-                    return worker
+    def get_random_worker_with_capacity_weight(self, scheduling_class):
+        with self._lock:
+            return self.get_capacity_index(scheduling_class).sample()
             
-            ciel.log('Ran out of workers in capacity-weighted selection class=%s selected=%d total=%d' % (scheduling_class, selected_slot, total_capacity), 'WORKER_POOL', logging.ERROR)
+    def get_random_workers_with_capacity_weight(self, scheduling_class, k):
+        """Draws k workers (with replacement) under a single acquisition of the lock."""
+        with self._lock:
+            capacities = self.get_capacity_index(scheduling_class)
+            if capacities.total <= 0:
+                return []
+            return [capacities.sample() for _ in range(k)]
             
+    def get_netloc_id(self, netloc):
+        return self.netloc_table.get_id(netloc)
+
     def get_worker_at_netloc(self, netloc):
         try:
             return self.netlocs[netloc]
@@ -24,7 +24,7 @@ from datetime import datetime, timedelta
 import ciel.runtime.tcp_server
 import ciel.runtime.file_watcher as fwt
 from ciel.runtime.block_store import get_own_netloc, producer_filename,\
-    filename_for_ref
+    filename_for_ref, create_producer_file
 from ciel.public.references import SWDataValue, encode_datavalue, SW2_ConcreteReference, \
     SW2_StreamReference, SW2_CompletedReference, SW2_SocketStreamReference,\
     decode_datavalue_string
@@ -256,8 +256,7 @@ def make_local_output(id, subscribe_callback=None, may_pipe=False, can_use_fd=Fa
         subscribe_callback = fwt.create_watch
     ciel.log.error('Creating file for output %s' % id, 'BLOCKSTORE', logging.DEBUG)
     new_ctx = FileOutputContext(id, subscribe_callback, may_pipe=may_pipe, can_use_fd=can_use_fd)
-    dot_filename = producer_filename(id)
-    open(dot_filename, 'wb').close()
+    create_producer_file(id)
     streaming_producers[id] = new_ctx
     return new_ctx
 
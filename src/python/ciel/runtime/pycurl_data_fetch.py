@@ -46,10 +46,11 @@ class pycURLFetchContext(pycURLContext):
 
     def success(self):
         bytes_downloaded = self.curl_ctx.getinfo(pycurl.SIZE_DOWNLOAD)
+        fetch_time = self.curl_ctx.getinfo(pycurl.TOTAL_TIME)
         self.progress_callback(bytes_downloaded)
         pycURLContext.success(self)
         if self.fetch_client.task_record is not None:
-            self.fetch_client.task_record.add_completed_fetch(self.description, bytes_downloaded)
+            self.fetch_client.task_record.add_completed_fetch(self.description, bytes_downloaded, fetch_time)
 
     def progress(self, toDownload, downloaded, toUpload, uploaded):
         self.progress_callback(downloaded)
@@ -19,7 +19,7 @@ import pycurl
 
 class pycURLBufferContext(ciel.runtime.pycurl_thread.pycURLContext):
 
-    def __init__(self, method, in_str, out_fp, url, result_callback):
+    def __init__(self, method, in_str, out_fp, url, result_callback, content_type="application/octet-stream"):
         
         ciel.runtime.pycurl_thread.pycURLContext.__init__(self, url, result_callback)
 
@@ -30,7 +30,7 @@ class pycURLBufferContext(ciel.runtime.pycurl_thread.pycURLContext):
             self.curl_ctx.setopt(pycurl.POST, True)
             self.curl_ctx.setopt(pycurl.POSTFIELDS, in_str)
             self.curl_ctx.setopt(pycurl.POSTFIELDSIZE, len(in_str))
-            self.curl_ctx.setopt(pycurl.HTTPHEADER, ["Content-Type: application/octet-stream", "Expect:"])
+            self.curl_ctx.setopt(pycurl.HTTPHEADER, ["Content-Type: %s" % content_type, "Expect:"])
 
     def write(self, data):
         self.write_fp.write(data)
@@ -38,13 +38,13 @@ class pycURLBufferContext(ciel.runtime.pycurl_thread.pycURLContext):
 
 class BufferTransferContext:
         
-    def __init__(self, method, url, postdata, result_callback=None):
+    def __init__(self, method, url, postdata, result_callback=None, content_type="application/octet-stream"):
         
         self.response_buffer = StringIO()
         self.completed_event = threading.Event()
         self.result_callback = result_callback
         self.url = url
-        self.curl_ctx = pycURLBufferContext(method, postdata, self.response_buffer, url, self.result)
+        self.curl_ctx = pycURLBufferContext(method, postdata, self.response_buffer, url, self.result, content_type)
 
     def start(self):
 
@@ -68,21 +68,21 @@ class BufferTransferContext:
             self.result_callback(success, self.url)
 
 # Called from cURL thread
-def _post_string_noreturn(url, postdata, result_callback=None):
-    ctx = BufferTransferContext("POST", url, postdata, result_callback)
+def _post_string_noreturn(url, postdata, result_callback=None, content_type="application/octet-stream"):
+    ctx = BufferTransferContext("POST", url, postdata, result_callback, content_type)
     ctx.start()
 
-def post_string_noreturn(url, postdata, result_callback=None):
-    ciel.runtime.pycurl_thread.do_from_curl_thread(lambda: _post_string_noreturn(url, postdata, result_callback))
+def post_string_noreturn(url, postdata, result_callback=None, content_type="application/octet-stream"):
+    ciel.runtime.pycurl_thread.do_from_curl_thread(lambda: _post_string_noreturn(url, postdata, result_callback, content_type))
 
 # Called from cURL thread
-def _post_string(url, postdata):
-    ctx = BufferTransferContext("POST", url, postdata)
+def _post_string(url, postdata, content_type="application/octet-stream"):
+    ctx = BufferTransferContext("POST", url, postdata, content_type=content_type)
     ctx.start()
     return ctx
 
-def post_string(url, postdata):
-    ctx = ciel.runtime.pycurl_thread.do_from_curl_thread_sync(lambda: _post_string(url, postdata))
+def post_string(url, postdata, content_type="application/octet-stream"):
+    ctx = ciel.runtime.pycurl_thread.do_from_curl_thread_sync(lambda: _post_string(url, postdata, content_type))
     return ctx.get_result()
 
 # Called from the cURL thread
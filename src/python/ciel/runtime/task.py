@@ -11,7 +11,10 @@
 # WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+from __future__ import with_statement
 from ciel.public.references import SW2_StreamReference, SW2_FixedReference
+from array import array
+from threading import Lock
 import datetime
 import time
 
@@ -41,14 +44,158 @@ TASK_STATE_NAMES = {}
 for (name, number) in TASK_STATES.items():
     TASK_STATE_NAMES[number] = name
 
-class TaskPoolTask:
+# Task history entries are stored as integer codes into this table, which
+# holds each distinct (description, additional) pair once. The descriptions
+# are state names and failure reasons, and the additional values are worker
+# netlocs, so the table stays small.
+_EVENTS = []
+_EVENT_CODES = {}
+_event_lock = Lock()
+
+def get_event_code(description, additional=None):
+    key = (description, additional)
+    try:
+        return _EVENT_CODES[key]
+    except KeyError:
+        with _event_lock:
+            try:
+                return _EVENT_CODES[key]
+            except KeyError:
+                code = len(_EVENTS)
+                _EVENTS.append(key)
+                _EVENT_CODES[key] = code
+                return code
+
+def get_event(code):
+    description, additional = _EVENTS[code]
+    if additional is not None:
+        return (description, additional)
+    else:
+        return description
+
+# Shared placeholders for the per-task containers that most tasks never
+# fill. They are replaced by a private container on the first insertion.
+NO_CHILDREN = ()
+NO_STREAMS = frozenset()
+NO_WORKERS = frozenset()
+
+_now = time.time
+
+_last_event_time = 0.0
+
+def event_time():
+    """Returns the current time for recording an event. This is the wall
+    clock time, so that events can be shown as dates, except that it never
+    goes backwards if the wall clock is stepped back."""
+    global _last_event_time
+    t = _now()
+    if t < _last_event_time:
+        return _last_event_time
+    _last_event_time = t
+    return t
+
+def _timestamp(t):
+    return time.mktime(t.timetuple()) + t.microsecond / 1e6
+
+class FullTaskHistory(object):
+    """Keeps every event, as alternating event codes and timestamps."""
+
+    def __str__(self):
+        return 'full'
+
+    def allocate(self):
+        return array('d')
+
+    def record(self, events, description, additional, t):
+        events.append(get_event_code(description, additional))
+        events.append(t if t is not None else event_time())
+
+    def get_events(self, events):
+        return [(events[i + 1], int(events[i])) for i in range(0, len(events), 2)]
+
+class RingTaskHistory(object):
+    """Keeps the last capacity events in a preallocated array. The first
+    element counts the events recorded so far, and is followed by capacity
+    (event code, timestamp) pairs."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.template = array('d', [0.0]) * (1 + 2 * capacity)
+
+    def __str__(self):
+        return 'ring:%d' % self.capacity
+
+    def allocate(self):
+        return self.template[:]
+
+    def record(self, events, description, additional, t):
+        count = int(events[0])
+        i = 1 + 2 * (count % self.capacity)
+        events[i] = get_event_code(description, additional)
+        events[i + 1] = t if t is not None else event_time()
+        events[0] = count + 1
+
+    def get_events(self, events):
+        count = int(events[0])
+        if count <= self.capacity:
+            slots = range(count)
+        else:
+            slots = [(count + j) % self.capacity for j in range(self.capacity)]
+        return [(events[2 + 2 * j], int(events[1 + 2 * j])) for j in slots]
+
+class CountersOnlyTaskHistory(object):
+    """Keeps no events: only the job's task state counts are maintained."""
+
+    def __str__(self):
+        return 'counters-only'
+
+    def allocate(self):
+        return None
+
+    def record(self, events, description, additional, t):
+        pass
+
+    def get_events(self, events):
+        return []
+
+FULL_TASK_HISTORY = FullTaskHistory()
+COUNTERS_ONLY_TASK_HISTORY = CountersOnlyTaskHistory()
+
+def get_task_history(mode):
+    """Returns the task history for the given mode, which is one of 'full',
+    'ring:N' or 'counters-only'."""
+    if mode is None or mode == 'full':
+        return FULL_TASK_HISTORY
+    elif mode == 'counters-only':
+        return COUNTERS_ONLY_TASK_HISTORY
+    elif mode.startswith('ring:'):
+        capacity = int(mode[len('ring:'):])
+        if capacity <= 0:
+            raise ValueError('Ring capacity must be positive: %s' % mode)
+        return RingTaskHistory(capacity)
+    raise ValueError('Unknown task history mode: %s' % mode)
+
+class TaskPoolTask(object):
+    
+    # A large job can have millions of tasks, so they do without a
+    # per-instance __dict__.
+    __slots__ = ('task_id', 'parent', 'children', 'handler', 'inputs',
+                 'dependencies', 'expected_outputs', 'task_private',
+                 'unfinished_input_streams', 'constrained_location_checked',
+                 'constrained_location', 'blocking_count', '_blocking_dict',
+                 '_history', '_events', 'job', 'taskset', 'worker_private',
+                 'type', 'worker', 'state', 'scheduling_class',
+                 'saved_continuation_uri', 'event_index', 'current_attempt',
+                 'profiling', 'locality_delay', 'queued_at', 'sched_wait',
+                 'locality_hits', 'locality_misses', 'expected_runtime',
+                 'assigned_at', 'speculative_workers', 'continuation')
     
     def __init__(self, task_id, parent_task, handler, inputs, dependencies, expected_outputs, task_private=None, state=TASK_CREATED, job=None, taskset=None, worker_private=None, workers=[], scheduling_class=None, type=None):
         self.task_id = task_id
         
         # Task creation graph.
         self.parent = parent_task
-        self.children = []
+        self.children = NO_CHILDREN
         
         self.handler = handler
         
@@ -59,16 +206,26 @@ class TaskPoolTask:
 
         self.task_private = task_private
 
-        self.unfinished_input_streams = set()
+        self.unfinished_input_streams = NO_STREAMS
 
         self.constrained_location_checked = False
         self.constrained_location = None
 
-        self._blocking_dict = {}
+        # The number of references that the task is blocked on, and a
+        # mapping from each of them to the local ID (or IDs) that it is
+        # bound to, which is allocated when the task first blocks.
+        self.blocking_count = 0
+        self._blocking_dict = None
             
-        self.history = []
-        
         self.job = job
+        
+        # History, packed as event codes and timestamps in an array whose
+        # layout depends on the job's task history mode.
+        try:
+            self._history = job.task_history
+        except AttributeError:
+            self._history = FULL_TASK_HISTORY
+        self._events = self._history.allocate()
 
         self.taskset = taskset
         
@@ -89,7 +246,26 @@ class TaskPoolTask:
         self.event_index = 0
         self.current_attempt = 0
         
-        self.profiling = {}
+        self.profiling = None
+        
+        # Scheduling statistics: the locality wait budget chosen by the
+        # scheduling policy, when the task was last queued, the total time
+        # spent queued, and how often it ran on a selected worker (a hit) or
+        # was stolen by another worker (a miss).
+        self.locality_delay = 0.0
+        self.queued_at = None
+        self.sched_wait = 0.0
+        self.locality_hits = 0
+        self.locality_misses = 0
+        
+        # Estimated runtime, recorded when the task is queued on a worker so
+        # that the same amount is removed from the worker's expected work.
+        self.expected_runtime = 0.0
+        
+        # When the task was last assigned to a worker, and the workers other
+        # than self.worker that are running speculative copies of it.
+        self.assigned_at = None
+        self.speculative_workers = NO_WORKERS
 
     def __str__(self):
         return 'TaskPoolTask(%s)' % self.task_id
@@ -102,32 +278,67 @@ class TaskPoolTask:
         self.state = state
         
     def record_event(self, description, time=None, additional=None):
-        if time is None:
-            time = datetime.datetime.now()
-        if additional is not None:
-            self.history.append((time, (description, additional)))
+        if time is not None and isinstance(time, datetime.datetime):
+            time = _timestamp(time)
+        self._history.record(self._events, description, additional, time)
+        
+    def get_history(self):
+        """Returns a list of (timestamp, description) pairs, where the
+        description is a (description, additional) pair for events that
+        recorded additional information. Depending on the task history mode,
+        this may hold only the most recent events, or none at all."""
+        return [(t, get_event(code)) for (t, code) in self._history.get_events(self._events)]
+    
+    @property
+    def history(self):
+        return [(datetime.datetime.fromtimestamp(t), event) for (t, event) in self.get_history()]
+        
+    def add_child(self, task):
+        if self.children is NO_CHILDREN:
+            self.children = [task]
+        else:
+            self.children.append(task)
+        
+    def add_unfinished_input_stream(self, global_id):
+        if self.unfinished_input_streams is NO_STREAMS:
+            self.unfinished_input_streams = set([global_id])
+        else:
+            self.unfinished_input_streams.add(global_id)
+            
+    def add_speculative_worker(self, worker):
+        if self.speculative_workers is NO_WORKERS:
+            self.speculative_workers = set([worker])
         else:
-            self.history.append((time, description))
+            self.speculative_workers.add(worker)
+            
+    def clear_speculative_workers(self):
+        self.speculative_workers = NO_WORKERS
         
     def is_blocked(self):
         return self.state == TASK_BLOCKING
     
+    def is_ready(self):
+        """Returns True if the task is not waiting for any references."""
+        return self.blocking_count == 0
+    
     def is_queued_streaming(self):
         return self.state == TASK_QUEUED_STREAMING
         
     def blocked_on(self):
-        if self.state == TASK_BLOCKING:
+        if self.state == TASK_BLOCKING and self._blocking_dict is not None:
             return self._blocking_dict.keys()
         else:
             return []
 
     def set_profiling(self, profiling):
         if profiling is not None:
+            if self.profiling is None:
+                self.profiling = {}
             self.profiling.update(profiling)
             try:    
-                self.record_event('WORKER_CREATED', datetime.datetime.fromtimestamp(profiling['CREATED']))
-                self.record_event('WORKER_STARTED', datetime.datetime.fromtimestamp(profiling['STARTED']))
-                self.record_event('WORKER_FINISHED', datetime.datetime.fromtimestamp(profiling['FINISHED']))
+                self.record_event('WORKER_CREATED', profiling['CREATED'])
+                self.record_event('WORKER_STARTED', profiling['STARTED'])
+                self.record_event('WORKER_FINISHED', profiling['FINISHED'])
             except KeyError:
                 pass
     
@@ -140,6 +351,8 @@ class TaskPoolTask:
             return self.type
     
     def get_profiling(self):
+        if self.profiling is None:
+            return {}
         return self.profiling
 
     def set_worker(self, worker):
@@ -155,56 +368,66 @@ class TaskPoolTask:
         return self.worker
 
     def block_on(self, global_id, local_id):
-        self.set_state(TASK_BLOCKING)
+        if self.state != TASK_BLOCKING:
+            self.set_state(TASK_BLOCKING)
+        if self._blocking_dict is None:
+            self._blocking_dict = {}
+            self.blocking_count = 0
+        # Usually a reference is bound to a single local ID, so we only
+        # allocate a list when it is bound to several.
         try:
-            self._blocking_dict[global_id].add(local_id)
+            local_ids = self._blocking_dict[global_id]
         except KeyError:
-            self._blocking_dict[global_id] = set([local_id])
+            self._blocking_dict[global_id] = local_id
+            self.blocking_count += 1
+            return
+        if isinstance(local_ids, list):
+            if local_id not in local_ids:
+                local_ids.append(local_id)
+        elif local_ids != local_id:
+            self._blocking_dict[global_id] = [local_ids, local_id]
             
-    def notify_reference_changed(self, global_id, ref, task_pool):
+    def notify_reference_ready(self, global_id, ref):
+        """Called when a reference that this task consumes has become
+        consumable. Returns a pair of booleans: whether the task should stay
+        subscribed to the reference, and whether it has become runnable."""
         if global_id in self.unfinished_input_streams:
             self.unfinished_input_streams.remove(global_id)
-            task_pool.unsubscribe_task_from_ref(self, ref)
-            self.inputs[ref.id] = ref
-            if len(self.unfinished_input_streams) == 0:
-                if self.state == TASK_QUEUED_STREAMING:
-                    self.set_state(TASK_QUEUED)
-        else:
-            if self.state == TASK_BLOCKING:
-                local_ids = self._blocking_dict.pop(global_id)
+            if len(self.unfinished_input_streams) == 0 and self.state == TASK_QUEUED_STREAMING:
+                self.set_state(TASK_QUEUED)
+                return False, True
+            return False, False
+        elif self.state == TASK_BLOCKING:
+            local_ids = self._blocking_dict.pop(global_id)
+            if isinstance(local_ids, list):
                 for local_id in local_ids:
                     self.inputs[local_id] = ref
-                if isinstance(ref, SW2_StreamReference):
-                    # Stay subscribed; this ref is still interesting
-                    self.unfinished_input_streams.add(global_id)
-                else:
-                    # Don't need to hear about this again
-                    task_pool.unsubscribe_task_from_ref(self, ref)
-                if len(self._blocking_dict) == 0:
-                    self.set_state(TASK_RUNNABLE)
+            else:
+                self.inputs[local_ids] = ref
+            # Stay subscribed to a stream, because it is still interesting.
+            stay_subscribed = isinstance(ref, SW2_StreamReference)
+            if stay_subscribed:
+                self.add_unfinished_input_stream(global_id)
+            self.blocking_count -= 1
+            if self.blocking_count == 0:
+                self._blocking_dict = None
+                self.set_state(TASK_RUNNABLE)
+                return stay_subscribed, True
+            return stay_subscribed, False
+        return True, False
+            
+    def notify_reference_changed(self, global_id, ref, task_pool):
+        was_streaming = global_id in self.unfinished_input_streams
+        stay_subscribed, _ = self.notify_reference_ready(global_id, ref)
+        if was_streaming:
+            self.inputs[ref.id] = ref
+        if not stay_subscribed:
+            task_pool.unsubscribe_task_from_ref(self, ref)
 
     def notify_ref_table_updated(self, ref_table_entry):
-        global_id = ref_table_entry.ref.id
-        ref = ref_table_entry.ref
-        if global_id in self.unfinished_input_streams:
-            self.unfinished_input_streams.remove(global_id)
+        stay_subscribed, _ = self.notify_reference_ready(ref_table_entry.ref.id, ref_table_entry.ref)
+        if not stay_subscribed:
             ref_table_entry.remove_consumer(self)
-            if len(self.unfinished_input_streams) == 0:
-                if self.state == TASK_QUEUED_STREAMING:
-                    self.set_state(TASK_QUEUED)
-        else:
-            if self.state == TASK_BLOCKING:
-                local_ids = self._blocking_dict.pop(global_id)
-                for local_id in local_ids:
-                    self.inputs[local_id] = ref
-                if isinstance(ref, SW2_StreamReference):
-                    # Stay subscribed; this ref is still interesting
-                    self.unfinished_input_streams.add(global_id)
-                else:
-                    # Don't need to hear about this again
-                    ref_table_entry.remove_consumer(self)
-                if len(self._blocking_dict) == 0:
-                    self.set_state(TASK_RUNNABLE)
         
     def convert_dependencies_to_futures(self):
         new_deps = {}
@@ -235,11 +458,14 @@ class TaskPoolTask:
         descriptor['parent'] = self.parent.task_id if self.parent is not None else None
         
         if long:
-            descriptor['history'] = map(lambda (t, name): (time.mktime(t.timetuple()) + t.microsecond / 1e6, name), self.history)
+            descriptor['history'] = self.get_history()
             descriptor['state'] = TASK_STATE_NAMES[self.state]
             descriptor['children'] = [x.task_id for x in self.children]
-            descriptor['profiling'] = self.profiling
+            descriptor['profiling'] = self.get_profiling()
             descriptor['worker'] = self.worker.netloc if self.worker is not None else None
+            descriptor['locality_hits'] = self.locality_hits
+            descriptor['locality_misses'] = self.locality_misses
+            descriptor['sched_wait'] = self.sched_wait
         
         if self.task_private is not None:
             descriptor['task_private'] = self.task_private
@@ -250,11 +476,27 @@ class TaskPoolTask:
         
         return descriptor
 
+class RetiredTask(object):
+    """Stands in for a task that has been retired from the task graph, so
+    that its live children can still refer to their parent."""
+    
+    __slots__ = ('task_id', 'job', 'scheduling_class', 'state')
+    
+    def __init__(self, task):
+        self.task_id = task.task_id
+        self.job = task.job
+        self.scheduling_class = task.scheduling_class
+        self.state = task.state
+        
+    def __str__(self):
+        return 'RetiredTask(%s)' % self.task_id
+
 class DummyJob:
     """Used to ensure that tasks on the worker can refer to their job (for inheriting job ID, e.g.)."""
     
     def __init__(self, id):
         self.id = id
+        self.task_history = FULL_TASK_HISTORY
         
     def record_state_change(self, task, from_state, to_state, additional=None):
         pass
@@ -159,19 +159,26 @@ class TaskExecutionRecord:
                    'FINISHED' : self.as_timestamp(self.finish_time)}
         
         fetches = {}
-        for url, size in self.fetches:
+        fetch_times = {}
+        for url, size, fetch_time in self.fetches:
             netloc = urlparse.urlparse(url).netloc
             try:
                 fetches[netloc] += size
             except KeyError:
                 fetches[netloc] = size
+            if fetch_time is not None:
+                try:
+                    fetch_times[netloc] += fetch_time
+                except KeyError:
+                    fetch_times[netloc] = fetch_time
 
         profile['FETCHED'] = fetches
+        profile['FETCH_TIME'] = fetch_times
         
         return profile
         
-    def add_completed_fetch(self, url, size):
-        self.fetches.append((url, size))
+    def add_completed_fetch(self, url, size, fetch_time=None):
+        self.fetches.append((url, size, fetch_time))
         
     def run(self):
         ciel.engine.publish("worker_event", "Start execution " + repr(self.task_descriptor['task_id']) + " with handler " + self.task_descriptor['handler'])
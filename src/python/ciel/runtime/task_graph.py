@@ -14,12 +14,14 @@
 from ciel.public.references import SW2_FutureReference, combine_references,\
     SW2_StreamReference
 from ciel.runtime.task import TASK_CREATED, TASK_BLOCKING, TASK_COMMITTED,\
-    TASK_RUNNABLE
+    TASK_RUNNABLE, RetiredTask, NO_CHILDREN, TaskPoolTask
 import collections
 
-class ReferenceTableEntry:
+class ReferenceTableEntry(object):
     """Represents information stored about a reference in the task graph."""
     
+    __slots__ = ('ref', 'producing_task', 'consumers')
+    
     def __init__(self, ref, producing_task=None): 
         self.ref = ref
         self.producing_task = producing_task
@@ -52,16 +54,23 @@ class TaskGraphUpdate:
     
     def __init__(self):
         self.spawns = []
+        self.committed_spawns = []
         self.publishes = []
         self.reduce_list = []
 
     def spawn(self, task):
         self.spawns.append(task)
+
+    def spawn_committed(self, task, outputs):
+        self.committed_spawns.append((task, outputs))
         
     def publish(self, reference, producing_task=None):
         self.publishes.append((reference, producing_task))
 
     def commit(self, graph):
+        for (task, outputs) in self.committed_spawns:
+            graph.spawn_committed(task, outputs)
+
         for (reference, producing_task) in self.publishes:
             graph.publish(reference, producing_task)
             
@@ -89,7 +98,7 @@ class DynamicTaskGraph:
             return
         self.tasks[task.task_id] = task
         if task.parent is not None:
-            task.parent.children.append(task)
+            task.parent.add_child(task)
         
         # Now update the reference table to account for the new task.
         # We will need to reduce this task if any of its outputs have consumers. 
@@ -104,6 +113,18 @@ class DynamicTaskGraph:
             else:
                 self.reduce_graph_for_tasks([task])
     
+    def spawn_committed(self, task, outputs):
+        """Add a task whose outputs are already available (e.g. from the memo
+        table) to the graph, and publish those outputs without running it."""
+        if task.task_id in self.tasks:
+            return
+        self.tasks[task.task_id] = task
+        if task.parent is not None:
+            task.parent.add_child(task)
+        task.set_state(TASK_COMMITTED)
+        for reference in outputs:
+            self.publish(reference, task)
+
     def publish(self, reference, producing_task=None):
         """Updates the information held about a reference. Returns the updated
         reference table entry for the reference."""
@@ -114,10 +135,8 @@ class DynamicTaskGraph:
                 ref_table_entry.update_producing_task(producing_task)
             ref_table_entry.combine_references(reference)
             
-            if ref_table_entry.has_consumers():
-                consumers_copy = ref_table_entry.consumers.copy()
-                for task in consumers_copy:
-                    self.notify_task_of_reference(task, ref_table_entry)
+            if ref_table_entry.has_consumers() and ref_table_entry.ref.is_consumable():
+                self.notify_consumers(ref_table_entry)
                 
         except KeyError:
             ref_table_entry = ReferenceTableEntry(reference, producing_task)
@@ -142,6 +161,40 @@ class DynamicTaskGraph:
             
     
     
+    def notify_consumers(self, ref_table_entry):
+        """
+        Notifies every consumer of a reference that has become consumable,
+        and passes the tasks that become runnable to tasks_runnable() in a
+        single batch.
+        """
+        consumers = ref_table_entry.consumers
+        ref_table_entry.consumers = None
+        ref = ref_table_entry.ref
+        
+        # Rather than removing each task that no longer needs the reference
+        # from the consumer set, we collect the consumers that remain.
+        remaining = []
+        runnable = []
+        for consumer in consumers:
+            if isinstance(consumer, TaskPoolTask):
+                stay_subscribed, became_runnable = consumer.notify_reference_ready(ref.id, ref)
+                if stay_subscribed:
+                    remaining.append(consumer)
+                if became_runnable:
+                    runnable.append(consumer)
+            else:
+                # A synthetic consumer, such as the job output.
+                remaining.append(consumer)
+                consumer.notify_ref_table_updated(ref_table_entry)
+        
+        if len(remaining) > 0:
+            if ref_table_entry.consumers is None:
+                ref_table_entry.consumers = set(remaining)
+            else:
+                ref_table_entry.consumers.update(remaining)
+        if len(runnable) > 0:
+            self.tasks_runnable(runnable)
+    
     def notify_task_of_reference(self, task, ref_table_entry):
         if ref_table_entry.ref.is_consumable():
             was_queued_streaming = task.is_queued_streaming()
@@ -171,6 +224,7 @@ class DynamicTaskGraph:
     def reduce_graph_for_tasks(self, root_tasks):
         
         newly_active_task_queue = collections.deque()
+        runnable = []
             
         for task in root_tasks:
             newly_active_task_queue.append(task)
@@ -198,7 +252,7 @@ class DynamicTaskGraph:
                     conc_ref = ref_table_entry.ref
                     task.inputs[local_id] = conc_ref
                     if isinstance(conc_ref, SW2_StreamReference):
-                        task.unfinished_input_streams.add(ref.id)
+                        task.add_unfinished_input_stream(ref.id)
                         ref_table_entry.add_consumer(task)
 
                 else:
@@ -222,7 +276,10 @@ class DynamicTaskGraph:
             # it will run when its inputs are published.
             if not task_will_block:
                 task.set_state(TASK_RUNNABLE)
-                self.task_runnable(task)
+                runnable.append(task)
+                
+        if len(runnable) > 0:
+            self.tasks_runnable(runnable)
     
     def task_runnable(self, task):
         """
@@ -231,6 +288,100 @@ class DynamicTaskGraph:
         """
         raise NotImplementedError()
     
+    def tasks_runnable(self, tasks):
+        """
+        Called with a batch of tasks that have become runnable. Subclasses
+        may override this to handle the batch at once.
+        """
+        for task in tasks:
+            self.task_runnable(task)
+    
+    def collect_garbage(self, root_ref_ids, root_tasks=[]):
+        """
+        Retires the committed tasks and the reference table entries that
+        cannot be reached from the given references, the given tasks, any
+        reference that has consumers, or any task that has not committed.
+        Returns a list of the retired tasks and a list of the retired
+        reference IDs.
+        
+        A task reaches the references that it depends on or is expected to
+        produce, and a reference reaches the task that produces it. However,
+        we do not trace past a concrete reference that was reached from a
+        committed task: this keeps the producers of the inputs to live
+        tasks, so that a lost input can be regenerated, but forgets the rest
+        of the lineage.
+        """
+        live_tasks = set()
+        live_ref_ids = set(root_ref_ids)
+        to_visit = []
+        
+        for task in self.tasks.itervalues():
+            if task.state != TASK_COMMITTED:
+                live_tasks.add(task)
+                to_visit.append((task, True))
+        for task in root_tasks:
+            if task not in live_tasks:
+                live_tasks.add(task)
+                to_visit.append((task, True))
+        for ref_id, ref_table_entry in self.references.iteritems():
+            if ref_table_entry.has_consumers():
+                live_ref_ids.add(ref_id)
+        for ref_id in live_ref_ids:
+            try:
+                producing_task = self.references[ref_id].producing_task
+            except KeyError:
+                continue
+            if producing_task is not None and producing_task not in live_tasks:
+                live_tasks.add(producing_task)
+                to_visit.append((producing_task, True))
+        
+        while len(to_visit) > 0:
+            task, follow_concrete = to_visit.pop()
+            live_ref_ids.update(task.expected_outputs)
+            live_ref_ids.update(task.inputs.iterkeys())
+            for ref in task.dependencies.itervalues():
+                live_ref_ids.add(ref.id)
+                try:
+                    ref_table_entry = self.references[ref.id]
+                except KeyError:
+                    continue
+                producing_task = ref_table_entry.producing_task
+                if producing_task is None or producing_task in live_tasks:
+                    continue
+                is_future = not ref_table_entry.ref.is_consumable()
+                if follow_concrete or is_future:
+                    live_tasks.add(producing_task)
+                    to_visit.append((producing_task, is_future))
+        
+        retired_tasks = [task for task in self.tasks.itervalues() if task not in live_tasks]
+        for task in retired_tasks:
+            del self.tasks[task.task_id]
+        retired_ref_ids = [ref_id for ref_id in self.references if ref_id not in live_ref_ids]
+        for ref_id in retired_ref_ids:
+            del self.references[ref_id]
+        if len(retired_tasks) == 0:
+            return retired_tasks, retired_ref_ids
+            
+        # Drop the remaining links to the retired tasks, so that they can be
+        # freed.
+        for ref_table_entry in self.references.itervalues():
+            if ref_table_entry.producing_task is not None and ref_table_entry.producing_task not in live_tasks:
+                ref_table_entry.producing_task = None
+        retired_parents = {}
+        for task in live_tasks:
+            parent = task.parent
+            if parent is not None and parent not in live_tasks and not isinstance(parent, RetiredTask):
+                try:
+                    task.parent = retired_parents[parent]
+                except KeyError:
+                    task.parent = retired_parents[parent] = RetiredTask(parent)
+            if len(task.children) > 0:
+                children = [child for child in task.children if child in live_tasks]
+                if len(children) < len(task.children):
+                    task.children = children if len(children) > 0 else NO_CHILDREN
+        
+        return retired_tasks, retired_ref_ids
+    
     def get_task(self, task_id):
         return self.tasks[task_id]
     
@@ -0,0 +1,729 @@
+# Copyright (c) 2011 Derek Murray <derek.murray@cl.cam.ac.uk>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+'''
+Microbenchmarks for the master. These drive the real job and worker pool
+objects in-process, with the worker transport replaced by a stub, so they
+can be run without a cluster:
+
+    python -m ciel.runtime.util.benchmark -b schedule -w 200 -t 20000
+    python -m ciel.runtime.util.benchmark -b locality -w 200 -n 50 -i 10000
+    python -m ciel.runtime.util.benchmark -b memory -t 1000000
+    python -m ciel.runtime.util.benchmark -b gc -I 10000
+    python -m ciel.runtime.util.benchmark -b graph -W 50000
+    python -m ciel.runtime.util.benchmark -b codec -t 20000
+    python -m ciel.runtime.util.benchmark -b deferred -J 8 -T 4 -t 20000
+    python -m ciel.runtime.util.benchmark -b journal -w 4 -I 20000
+    python -m ciel.runtime.util.benchmark -b recovery -w 4 -I 20000 -J 8 -T 4
+    python -m ciel.runtime.util.benchmark -b replication -t 20000
+'''
+from __future__ import with_statement
+from optparse import OptionParser
+from ciel.public.references import SW2_ConcreteReference, SW2_FutureReference,\
+    SW2_FixedReference
+from ciel.public.wire_codec import CODEC_JSON, CODEC_BINARY, SUPPORTED_CODECS,\
+    encode_message, decode_message
+from ciel.runtime.master.deferred_work import DeferredWorkPlugin
+from ciel.runtime.master.hot_standby import BackupSender, MasterRecoveryMonitor
+from ciel.runtime.master.journal_writer import JournalWriter, JournalSyncPoint,\
+    RECORD_HEADER_STRUCT, get_journal_segments, get_checkpoint_filename,\
+    write_checkpoint
+from ciel.runtime.master.job_pool import Job, JOB_ACTIVE, JOB_COMPLETED,\
+    JOB_STATE_NAMES
+from ciel.runtime.master.recovery import RecoveryManager
+from ciel.runtime.master.worker_pool import WorkerPool
+from ciel.runtime.task import TaskPoolTask, TASK_QUEUED, TASK_ASSIGNED,\
+    TASK_COMMITTED
+import ciel
+import collections
+import gc
+import logging
+import Queue
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+class BenchmarkDeferredWorker:
+    """Swallows deferred work: benchmarks drive the scheduler explicitly."""
+
+    def do_deferred(self, callable, key=None):
+        pass
+
+    def do_deferred_after(self, secs, callable, key=None):
+        pass
+
+    def release_key(self, key):
+        pass
+
+class BenchmarkWorkerPool(WorkerPool):
+    """Records dispatched tasks instead of posting them to a worker."""
+
+    def __init__(self, job_pool):
+        WorkerPool.__init__(self, ciel.engine, BenchmarkDeferredWorker(), job_pool)
+        self.dispatched = collections.deque()
+
+    def execute_task_on_worker(self, worker, task):
+        self.dispatched.append((worker, task))
+
+    def execute_tasks_on_worker(self, worker, tasks):
+        for task in tasks:
+            self.dispatched.append((worker, task))
+
+    def abort_task_on_worker(self, task, worker):
+        pass
+
+class BenchmarkJobPool:
+
+    def __init__(self):
+        self.jobs = {}
+        self.deferred_worker = BenchmarkDeferredWorker()
+        self.task_failure_investigator = None
+        self.memo_table = None
+        self.journal_root = None
+        self.journal_writer = JournalWriter()
+        self.worker_pool = BenchmarkWorkerPool(self)
+
+    def add_job(self, job, sync_journal=False):
+        self.jobs[job.id] = job
+        if job.root_task is not None:
+            job.task_graph.spawn(job.root_task)
+
+    def add_failed_job(self, job_id):
+        pass
+
+    def get_job_by_id(self, id):
+        return self.jobs[id]
+
+    def log(self, task, state, details=None):
+        pass
+
+    def notify_worker_added(self, worker):
+        for job in self.jobs.values():
+            job.notify_worker_added(worker)
+
+    def notify_worker_failed(self, worker):
+        for job in self.jobs.values():
+            job.notify_worker_failed(worker)
+
+    def job_completed(self, job):
+        pass
+
+    def job_failed(self, job):
+        pass
+
+    def get_slot_quota(self, job):
+        return None
+
+    def get_fair_share(self, job):
+        return None
+
+def create_benchmark_job(job_pool, job_id, job_options={}):
+    job = Job(job_id, None, None, JOB_ACTIVE, job_pool, job_options, journal=False)
+    job_pool.jobs[job_id] = job
+    for worker in job_pool.worker_pool.get_all_workers():
+        job.notify_worker_added(worker)
+    return job
+
+def create_benchmark_workers(job_pool, num_workers, slots):
+    for i in range(num_workers):
+        job_pool.worker_pool.create_worker({'netloc': 'worker%d:8001' % i,
+                                            'features': [],
+                                            'scheduling_classes': {'*': slots}})
+
+def make_runnable_task(job, task_id, handler='swi', inputs={}):
+    task = TaskPoolTask(task_id, None, handler, dict(inputs), {}, ['%s:out' % task_id], job=job)
+    task.set_state(TASK_QUEUED)
+    job.runnable_queue.put(task)
+    return task
+
+def run_schedule_benchmark(job_options, options):
+    job_pool = BenchmarkJobPool()
+    create_benchmark_workers(job_pool, options.workers, options.slots)
+    job = create_benchmark_job(job_pool, 'bench', job_options)
+    dispatched = job_pool.worker_pool.dispatched
+
+    for i in range(options.tasks):
+        make_runnable_task(job, 'task%d' % i)
+
+    # Initially fill every slot, then complete one task at a time and
+    # reschedule, which is the common case under steady load.
+    decisions = 0
+    passes = 0
+    elapsed = 0.0
+    start = time.time()
+    job._schedule()
+    elapsed += time.time() - start
+    passes += 1
+    decisions += len(dispatched)
+
+    while len(dispatched) > 0:
+        worker, task = dispatched.popleft()
+        with job._lock:
+            task.set_state(TASK_COMMITTED)
+            job.deassign_task_from_worker(task, worker)
+        before = len(dispatched)
+        start = time.time()
+        job._schedule()
+        elapsed += time.time() - start
+        passes += 1
+        decisions += len(dispatched) - before
+
+    return decisions, passes, elapsed
+
+def schedule_benchmark(options):
+    print 'Scheduling %d tasks on %d workers with %d slots each' % (options.tasks, options.workers, options.slots)
+    for name, job_options in [('sweep', {'incremental_schedule': False}),
+                              ('incremental', {'incremental_schedule': True})]:
+        decisions, passes, elapsed = run_schedule_benchmark(job_options, options)
+        print '%-12s %8d decisions %8d passes %8.3f s %10.1f decisions/s' % (name, decisions, passes, elapsed, decisions / elapsed)
+
+def run_locality_benchmark(job_options, options):
+    job_pool = BenchmarkJobPool()
+    create_benchmark_workers(job_pool, options.workers, options.slots)
+    job = create_benchmark_job(job_pool, 'bench', job_options)
+    netlocs = [worker.netloc for worker in job_pool.worker_pool.get_all_workers()]
+    rand = random.Random(0)
+
+    # Each reducer reads one partition from every mapper, as in MapReduce.
+    tasks = []
+    for i in range(options.reducers):
+        inputs = {}
+        for j in range(options.inputs):
+            ref = SW2_ConcreteReference('map%d:%d' % (j, i), rand.randint(1, 16 * 1048576), [netlocs[j % len(netlocs)]])
+            job.task_graph.publish(ref)
+            inputs[ref.id] = ref
+        task = make_runnable_task(job, 'reduce%d' % i, inputs=inputs)
+        task.scheduling_class = 'cpu'
+        tasks.append(task)
+
+    policy = job.scheduling_policy
+    worker_pool = job_pool.worker_pool
+    start = time.time()
+    for task in tasks:
+        policy.select_workers_for_task(task, worker_pool)
+    return len(tasks), time.time() - start
+
+def locality_benchmark(options):
+    print 'Scoring %d reducers with %d inputs each on %d workers' % (options.reducers, options.inputs, options.workers)
+    for name, job_options in [('scan', {'scheduler': 'locality', 'sched_opts': {'use_locality_index': False}}),
+                              ('index', {'scheduler': 'locality', 'sched_opts': {'use_locality_index': True}})]:
+        scored, elapsed = run_locality_benchmark(job_options, options)
+        print '%-12s %8d tasks %8.3f s %10.1f tasks/s' % (name, scored, elapsed, scored / elapsed)
+
+def get_resident_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # Peak RSS is a reasonable stand-in, since the benchmark only grows.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def memory_benchmark(options):
+    print 'Building a job with %d tasks, keeping %s task history' % (options.tasks, options.history)
+    job_pool = BenchmarkJobPool()
+    create_benchmark_workers(job_pool, options.workers, options.slots)
+    job = create_benchmark_job(job_pool, 'bench', {'task_history': options.history})
+    netlocs = [worker.netloc for worker in job_pool.worker_pool.get_all_workers()]
+    root = TaskPoolTask('root', None, 'swi', {}, {}, [], job=job)
+    job.task_graph.spawn(root)
+
+    # Each task consumes one concrete input and produces one output, and
+    # goes through the usual states, so that its history is realistic.
+    gc.collect()
+    before = get_resident_bytes()
+    inputs = []
+    for i in range(options.tasks):
+        ref = SW2_ConcreteReference('input%d' % i, 1048576, [netlocs[i % len(netlocs)]])
+        job.task_graph.publish(ref)
+        inputs.append(ref)
+    gc.collect()
+    after_refs = get_resident_bytes()
+
+    for i, ref in enumerate(inputs):
+        task = TaskPoolTask('task%d' % i, root, 'swi', {}, {ref.id: ref}, ['task%d:out' % i], job=job)
+        job.task_graph.spawn(task)
+        task.set_state(TASK_QUEUED)
+        task.set_state(TASK_ASSIGNED, additional=netlocs[i % len(netlocs)])
+        task.set_state(TASK_COMMITTED)
+    del inputs
+    gc.collect()
+    after_tasks = get_resident_bytes()
+
+    ref_bytes = (after_refs - before) / float(options.tasks)
+    task_bytes = (after_tasks - after_refs) / float(options.tasks)
+    print '%-12s %10.1f bytes each (%d bytes shallow)' % ('reference', ref_bytes, sys.getsizeof(job.task_graph.references['input0']))
+    print '%-12s %10.1f bytes each (%d bytes shallow), including its output reference' % ('task', task_bytes, sys.getsizeof(job.task_graph.tasks['task0']))
+
+def iterative_job_report(task, worker, iterations):
+    """Returns the report for a task in a synthetic iterative job, in which
+    each continuation spawns a step that transforms the previous step's
+    output, and a continuation that depends on the new output and inherits
+    the job output."""
+    now = time.time()
+    profiling = {'CREATED': now, 'STARTED': now, 'FINISHED': now, 'FETCHED': {}}
+    if task.task_id.startswith('step'):
+        published = [SW2_ConcreteReference(task.expected_outputs[0], 1048576, [worker.netloc])]
+        return [(task.task_id, True, ([], published, profiling))]
+    
+    i = int(task.task_id[len('cont'):]) if task.task_id.startswith('cont') else 0
+    if i == iterations:
+        published = [SW2_ConcreteReference(task.expected_outputs[0], 1048576, [worker.netloc])]
+        return [(task.task_id, True, ([], published, profiling))]
+    
+    step = {'task_id': 'step%d' % i,
+            'handler': 'swi',
+            'dependencies': [SW2_FutureReference('data%d' % (i - 1))] if i > 0 else [],
+            'expected_outputs': ['data%d' % i]}
+    continuation = {'task_id': 'cont%d' % (i + 1),
+                    'handler': 'swi',
+                    'dependencies': [SW2_FutureReference('data%d' % i)],
+                    'expected_outputs': task.expected_outputs}
+    return [(task.task_id, True, ([step, continuation], [], profiling))]
+
+def run_iterative_job(job_options, options, job_dir=None, journal_writer=None):
+    job_pool = BenchmarkJobPool()
+    if journal_writer is not None:
+        job_pool.journal_writer = journal_writer
+    create_benchmark_workers(job_pool, options.workers, options.slots)
+    job = Job('iterate', None, job_dir, JOB_ACTIVE, job_pool, job_options, journal=job_dir is not None)
+    job_pool.jobs[job.id] = job
+    for worker in job_pool.worker_pool.get_all_workers():
+        job.notify_worker_added(worker)
+    job.root_task = TaskPoolTask('root', None, 'swi', {}, {}, ['iterate:output'], job=job)
+    job.task_graph.spawn(job.root_task)
+    job.activated()
+    dispatched = job_pool.worker_pool.dispatched
+
+    samples = []
+    sample_every = max(1, options.iterations / 10)
+    steps = 0
+    gc.collect()
+    job._schedule()
+    while len(dispatched) > 0:
+        worker, task = dispatched.popleft()
+        job._report_tasks(iterative_job_report(task, worker, options.iterations), task, worker)
+        job._schedule()
+        if task.task_id.startswith('step'):
+            steps += 1
+            if steps % sample_every == 0:
+                samples.append((steps, len(job.task_graph.tasks), len(job.task_graph.references), get_resident_bytes()))
+    return job, samples
+
+def gc_benchmark(options):
+    print 'Running a job with %d iterations' % options.iterations
+    # Each iteration adds two tasks to the graph, so collect at least a few
+    # times during short runs.
+    gc_threshold = max(2, min(1000, options.iterations / 2))
+    job_dir = tempfile.mkdtemp(prefix='ciel-benchmark-')
+    try:
+        for name, job_options, spill_dir in [('none', {}, None),
+                                             ('gc', {'task_graph_gc': True, 'task_graph_gc_threshold': gc_threshold}, None),
+                                             ('gc+spill', {'task_graph_gc': True, 'task_graph_gc_threshold': gc_threshold}, job_dir)]:
+            # Each configuration runs in a fresh process, because memory that
+            # one run frees is not returned to the operating system.
+            sys.stdout.flush()
+            pid = os.fork()
+            if pid != 0:
+                _, status = os.waitpid(pid, 0)
+                if status != 0:
+                    print '%-12s failed' % name
+                continue
+            # The child must never return into the parent's cleanup.
+            status = 1
+            try:
+                job, samples = run_iterative_job(job_options, options, spill_dir)
+                print '%-12s %s after %d iterations, %d tasks retired' % (name, JOB_STATE_NAMES[job.state], options.iterations, job.retired_task_count)
+                for steps, num_tasks, num_refs, resident_bytes in samples:
+                    print '%12s %8d iterations %8d tasks %8d references %10.1f MB resident' % ('', steps, num_tasks, num_refs, resident_bytes / 1048576.0)
+                if spill_dir is not None and job.retired_task_count > 0:
+                    try:
+                        descriptor = job.get_retired_task_descriptor('step0')
+                        print '%12s retired task %s is still browsable (%s)' % ('', descriptor['task_id'], descriptor['state'])
+                    except KeyError:
+                        print '%12s task step0 was not retired' % ''
+                status = 0
+            except:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                os._exit(status)
+    finally:
+        shutil.rmtree(job_dir)
+
+def run_graph_benchmark(shape, width):
+    job_pool = BenchmarkJobPool()
+    job = create_benchmark_job(job_pool, 'bench')
+    graph = job.task_graph
+
+    if shape == 'fan-out':
+        # One reference is consumed by every task.
+        producers = [TaskPoolTask('source', None, 'swi', {}, {}, ['source'], job=job)]
+        consumers = [TaskPoolTask('consumer%d' % i, None, 'swi', {}, {'source': SW2_FutureReference('source')}, ['out%d' % i], job=job) for i in range(width)]
+    else:
+        # One task consumes the output of every other task.
+        producers = [TaskPoolTask('part%d' % i, None, 'swi', {}, {}, ['part%d' % i], job=job) for i in range(width)]
+        dependencies = dict([('part%d' % i, SW2_FutureReference('part%d' % i)) for i in range(width)])
+        consumers = [TaskPoolTask('consumer', None, 'swi', {}, dependencies, ['out'], job=job)]
+
+    start = time.time()
+    for task in producers + consumers:
+        graph.spawn(task)
+    graph.reduce_graph_for_tasks(consumers)
+    reduce_time = time.time() - start
+
+    start = time.time()
+    for task in producers:
+        graph.publish(SW2_ConcreteReference(task.expected_outputs[0], 1048576, ['worker0:8001']), task)
+    publish_time = time.time() - start
+
+    runnable = len([task for task in consumers if task.state == TASK_QUEUED])
+    return reduce_time, publish_time, runnable
+
+def graph_benchmark(options):
+    for shape in ['fan-out', 'fan-in']:
+        reduce_time, publish_time, runnable = run_graph_benchmark(shape, options.width)
+        print '%-12s %8d wide %8.3f s to reduce %8.3f s to publish %8d consumers runnable' % (shape, options.width, reduce_time, publish_time, runnable)
+
+def make_task_report(i, num_spawned, netlocs):
+    """Returns the payload that a worker would send to report task i, which
+    spawns num_spawned tasks and publishes one output for each of them."""
+    now = time.time()
+    spawned = []
+    published = []
+    for j in range(num_spawned):
+        task_id = 'task%d:%d' % (i, j)
+        dependencies = [SW2_ConcreteReference('input%d:%d:%d' % (i, j, k), 1048576, [netlocs[(i + k) % len(netlocs)]]) for k in range(4)]
+        dependencies.append(SW2_FutureReference('task%d:%d:out' % (i, j - 1)))
+        spawned.append({'task_id': task_id,
+                        'handler': 'swi',
+                        'dependencies': dependencies,
+                        'task_private': SW2_FixedReference('%s:private' % task_id, netlocs[i % len(netlocs)]),
+                        'expected_outputs': ['%s:out' % task_id],
+                        'scheduling_class': 'cpu'})
+        published.append(SW2_ConcreteReference('task%d:out%d' % (i, j), 1024 * j, [netlocs[i % len(netlocs)]]))
+    profiling = {'CREATED': now, 'STARTED': now, 'FINISHED': now, 'FETCHED': {'input%d' % i: 1048576}}
+    return {'worker': 'worker%d' % (i % len(netlocs)), 'report': [('task%d' % i, True, (spawned, published, profiling))]}
+
+def codec_benchmark(options):
+    netlocs = ['worker%d:8001' % i for i in range(options.workers)]
+    reports = [make_task_report(i, 10, netlocs) for i in range(options.tasks / 10)]
+    print 'Encoding and decoding %d task reports, each spawning 10 tasks' % len(reports)
+    for codec in [CODEC_JSON, CODEC_BINARY]:
+        gc.collect()
+        start = time.time()
+        messages = [encode_message(report, codec) for report in reports]
+        encode_time = time.time() - start
+        start = time.time()
+        for message in messages:
+            decode_message(message, codec)
+        decode_time = time.time() - start
+        size = sum([len(message) for message in messages])
+        print '%-12s %8.3f s to encode %8.3f s to decode %10.1f reports/s %8.1f bytes/report' % (codec, encode_time, decode_time, len(reports) / (encode_time + decode_time), size / float(len(reports)))
+
+class DispatchQueue(Queue.Queue):
+    """Lets the benchmark driver block until a task is dispatched by a
+    deferred work thread."""
+
+    def append(self, item):
+        self.put(item)
+
+def create_iterative_job(job_pool, job_id, job_options={}):
+    job = Job(job_id, None, None, JOB_ACTIVE, job_pool, job_options, journal=False)
+    job_pool.jobs[job.id] = job
+    for worker in job_pool.worker_pool.get_all_workers():
+        job.notify_worker_added(worker)
+    job.root_task = TaskPoolTask('root', None, 'swi', {}, {}, ['%s:output' % job_id], job=job)
+    job.task_graph.spawn(job.root_task)
+    job.activated()
+    return job
+
+def run_deferred_benchmark(num_shards, options, iterations=100):
+    job_pool = BenchmarkJobPool()
+    create_benchmark_workers(job_pool, options.workers, options.slots)
+    deferred_worker = DeferredWorkPlugin(ciel.engine, 'benchmark_deferred_work', num_shards)
+    job_pool.deferred_worker = deferred_worker
+    dispatched = DispatchQueue()
+    job_pool.worker_pool.dispatched = dispatched
+
+    # One job reports a root task that spawns many tasks, while the other
+    # jobs run short iterative computations, one task at a time.
+    big_job = create_iterative_job(job_pool, 'big')
+    big_job._schedule()
+    big_worker, big_root = dispatched.get_nowait()
+    spawned = [{'task_id': 'task%d' % i, 'handler': 'swi', 'dependencies': [], 'expected_outputs': ['out%d' % i]} for i in range(options.tasks)]
+    now = time.time()
+    profiling = {'CREATED': now, 'STARTED': now, 'FINISHED': now, 'FETCHED': {}}
+    big_report = [(big_root.task_id, True, (spawned, [], profiling))]
+    small_jobs = [create_iterative_job(job_pool, 'small%d' % i) for i in range(options.jobs - 1)]
+    
+    deferred_worker.start()
+    try:
+        start = time.time()
+        big_job.report_tasks(big_report, big_root, big_worker)
+        for job in small_jobs:
+            job.schedule()
+        
+        finished = {}
+        while len(finished) < len(small_jobs):
+            try:
+                worker, task = dispatched.get(timeout=0.01)
+                if task.job is not big_job:
+                    task.job.report_tasks(iterative_job_report(task, worker, iterations), task, worker)
+            except Queue.Empty:
+                pass
+            for job in small_jobs:
+                if job.state == JOB_COMPLETED and job.id not in finished:
+                    finished[job.id] = time.time() - start
+    finally:
+        deferred_worker.stop()
+    return sorted(finished.values()), deferred_worker.get_shard_metrics()
+
+def deferred_benchmark(options):
+    print 'Running %d jobs, one of which spawns %d tasks in a single report' % (options.jobs, options.tasks)
+    for num_shards in sorted(set([1, options.threads])):
+        finish_times, metrics = run_deferred_benchmark(num_shards, options)
+        print '%2d shard(s)   small jobs finished after %.3f s (median) %.3f s (last)' % (num_shards, finish_times[len(finish_times) / 2], finish_times[-1])
+        for shard in metrics:
+            print '%12s shard %d: %6d items, max depth %5d, wait %.4f s mean %.3f s max, run %.4f s mean %.3f s max' % ('', shard['shard'], shard['completed'], shard['max_depth'], shard['mean_wait'], shard['max_wait'], shard['mean_run'], shard['max_run'])
+
+class InlineJournalWriter:
+    """Writes each journal record in the caller, as jobs did before the
+    journal writer thread."""
+
+    def __init__(self):
+        self.files = set()
+        self.records = 0
+        self.fsyncs = 0
+        self.total_fsync_time = 0.0
+
+    def write(self, fp, record):
+        fp.write(record)
+        self.files.add(fp)
+        self.records += 1
+
+    def sync(self, fp=None):
+        for fp in self.files:
+            fp.flush()
+            start = time.time()
+            os.fsync(fp.fileno())
+            self.total_fsync_time += time.time() - start
+            self.fsyncs += 1
+        sync_point = JournalSyncPoint()
+        sync_point.done()
+        return sync_point
+
+    def close(self, fp):
+        self.files.discard(fp)
+        fp.close()
+
+    def write_checkpoint(self, filename, state):
+        write_checkpoint(filename, state)
+
+    def stop(self):
+        pass
+
+    def get_metrics(self):
+        return {'records' : self.records,
+                'fsyncs' : self.fsyncs,
+                'mean_fsync_latency' : self.total_fsync_time / self.fsyncs if self.fsyncs > 0 else 0.0}
+
+def journal_benchmark(options):
+    print 'Running a journalled job with %d iterations' % options.iterations
+    # Garbage collection keeps the task graph small, so that the time per
+    # iteration is steady. Retired tasks are also written to the journal.
+    gc_options = {'task_graph_gc': True, 'task_graph_gc_threshold': 1000}
+    for name, journal_writer, job_options in [('inline', InlineJournalWriter(), gc_options),
+                                              ('inline+sync', InlineJournalWriter(), dict(gc_options, journal_sync_buffer=100)),
+                                              ('group', JournalWriter(), gc_options),
+                                              ('group:25ms', JournalWriter(sync_interval=0.025), gc_options)]:
+        job_dir = tempfile.mkdtemp(prefix='ciel-benchmark-')
+        try:
+            start = time.time()
+            job, _ = run_iterative_job(job_options, options, job_dir, journal_writer)
+            run_time = time.time() - start
+            job.flush_journal()
+            durable_time = time.time() - start
+            journal_writer.stop()
+            metrics = journal_writer.get_metrics()
+            print '%-12s %8.3f s to run %8.3f s until durable %10.1f records/s %6d fsyncs %.6f s mean fsync' % (name, run_time, durable_time, metrics['records'] / durable_time, metrics['fsyncs'], metrics['mean_fsync_latency'])
+        finally:
+            shutil.rmtree(job_dir)
+
+class BenchmarkRecoveryManager(RecoveryManager):
+    """Records the time at which each job is recovered."""
+
+    def __init__(self, job_pool, num_processes):
+        RecoveryManager.__init__(self, ciel.engine, job_pool, None, BenchmarkDeferredWorker(), num_processes)
+        self.recovery_times = []
+
+    def recover_job(self, job_id, job_dir, recovered_job):
+        RecoveryManager.recover_job(self, job_id, job_dir, recovered_job)
+        self.recovery_times.append(time.time())
+
+def recovery_benchmark(options):
+    print 'Recovering a journalled job with %d iterations' % options.iterations
+    gc_options = {'task_graph_gc': True, 'task_graph_gc_threshold': 1000}
+    for name, compress_level, checkpoint_interval in [('full', 0, None),
+                                                      ('full+zlib', 1, None),
+                                                      ('checkpoint', 0, 10000),
+                                                      ('checkpoint+zlib', 1, 10000)]:
+        journal_root = tempfile.mkdtemp(prefix='ciel-benchmark-')
+        try:
+            job_dir = os.path.join(journal_root, 'iterate')
+            os.mkdir(job_dir)
+            journal_writer = JournalWriter(compress_level=compress_level)
+            job, _ = run_iterative_job(dict(gc_options, journal_checkpoint_interval=checkpoint_interval), options, job_dir, journal_writer)
+            job.flush_journal()
+            journal_writer.stop()
+
+            # Recover the job as if the master had failed before it completed,
+            # while writing a record.
+            os.remove(os.path.join(job_dir, 'result'))
+            segments = get_journal_segments(job_dir)
+            journal_bytes = sum([os.path.getsize(filename) for _, filename in segments])
+            last_segment_bytes = os.path.getsize(segments[-1][1])
+            with open(segments[-1][1], 'ab') as journal_file:
+                journal_file.write(RECORD_HEADER_STRUCT.pack('T', 1000) + 'truncated')
+            if os.path.exists(get_checkpoint_filename(job_dir)):
+                checkpoint_bytes = os.path.getsize(get_checkpoint_filename(job_dir))
+            else:
+                checkpoint_bytes = 0
+
+            job_pool = BenchmarkJobPool()
+            recovery_manager = BenchmarkRecoveryManager(job_pool, 1)
+            gc.collect()
+            start = time.time()
+            recovery_manager.recover_jobs(journal_root, ['iterate'])
+            recovery_time = time.time() - start
+            recovered_job = job_pool.jobs['iterate']
+            recovered_job.task_journal_fp.close()
+            repaired = os.path.getsize(segments[-1][1]) == last_segment_bytes
+
+            print '%-16s %8.3f s to recover %8d tasks %8d references from %3d segment(s): %8.1f KB journal %8.1f KB checkpoint, tail %s' % (name, recovery_time, len(recovered_job.task_graph.tasks), len(recovered_job.task_graph.references), len(segments), journal_bytes / 1024.0, checkpoint_bytes / 1024.0, 'repaired' if repaired else 'NOT REPAIRED')
+        finally:
+            shutil.rmtree(journal_root)
+
+    print 'Recovering %d copies of the job' % options.jobs
+    journal_root = tempfile.mkdtemp(prefix='ciel-benchmark-')
+    try:
+        job_dir = os.path.join(journal_root, 'job0')
+        os.mkdir(job_dir)
+        journal_writer = JournalWriter()
+        job, _ = run_iterative_job(dict(gc_options, journal_checkpoint_interval=None), options, job_dir, journal_writer)
+        job.flush_journal()
+        journal_writer.stop()
+        os.remove(os.path.join(job_dir, 'result'))
+        for i in range(1, options.jobs):
+            shutil.copytree(job_dir, os.path.join(journal_root, 'job%d' % i))
+
+        for num_processes in [1, options.threads]:
+            job_pool = BenchmarkJobPool()
+            recovery_manager = BenchmarkRecoveryManager(job_pool, num_processes)
+            gc.collect()
+            start = time.time()
+            job_ids = os.listdir(journal_root)
+            recovery_manager.recover_jobs(journal_root, job_ids, recovery_manager.create_recovery_pool(len(job_ids)))
+            recovery_time = time.time() - start
+            for job in job_pool.jobs.values():
+                job.task_journal_fp.close()
+            print '%2d process(es) %8.3f s until the first job is recovered %8.3f s until all %d jobs are recovered' % (num_processes, recovery_manager.recovery_times[0] - start, recovery_time, len(job_pool.jobs))
+    finally:
+        shutil.rmtree(journal_root)
+
+class LoopbackBackupSender(BackupSender):
+    """Delivers each frame to a backup master in the same process, after a
+    simulated round trip."""
+
+    def __init__(self, monitor, round_trip_time, max_batch):
+        BackupSender.__init__(self, ciel.engine, max_window=10000, max_batch=max_batch)
+        self.monitor = monitor
+        self.round_trip_time = round_trip_time
+
+    def post_frame(self, stream, message):
+        time.sleep(self.round_trip_time)
+        return self.monitor.receive_frame(decode_message(message, stream.codec))
+
+def replication_benchmark(options):
+    round_trip_time = 0.001
+    print 'Replicating %d published references with a %.1f ms round trip' % (options.tasks, round_trip_time * 1000)
+    for name, max_batch in [('per-record', 1),
+                            ('batch:100', 100),
+                            ('batch:1000', 1000)]:
+        job_pool = BenchmarkJobPool()
+        job = create_benchmark_job(job_pool, 'replicate')
+        monitor = MasterRecoveryMonitor(ciel.engine, 'http://backup/', 'http://primary/', job_pool, codecs=SUPPORTED_CODECS)
+        # Only apply the log: there is no primary to ping.
+        monitor.start_applying()
+        sender = LoopbackBackupSender(monitor, round_trip_time, max_batch)
+        sender.start()
+        sender.register_standby_url('http://backup/', monitor.codecs)
+        try:
+            start = time.time()
+            for i in range(options.tasks):
+                ref = SW2_ConcreteReference('ref%d' % i, 1024, ['worker%d:8001' % (i % 10)])
+                sender.publish_refs(job.id, 'task%d' % i, [ref])
+            publish_time = time.time() - start
+            metrics = sender.get_metrics()
+            lag_records = metrics['standbys'][0]['lag_records']
+            lag_seconds = metrics['standbys'][0]['lag_seconds']
+            while sender.get_metrics()['standbys'][0]['lag_records'] > 0:
+                time.sleep(0.001)
+            replicated_time = time.time() - start
+            assert len(job.task_graph.references) == options.tasks
+            metrics = sender.get_metrics()
+            print '%-12s %8.3f s to publish %8.3f s until replicated %10.1f records/s %6d frames %8.3f s blocked, lag after publishing %6d records %7.3f s' % (name, publish_time, replicated_time, options.tasks / replicated_time, metrics['frames_sent'], metrics['blocked_time'], lag_records, lag_seconds)
+        finally:
+            sender.stop()
+            monitor.stop_applying()
+
+BENCHMARKS = {'schedule': schedule_benchmark,
+              'locality': locality_benchmark,
+              'memory': memory_benchmark,
+              'gc': gc_benchmark,
+              'graph': graph_benchmark,
+              'codec': codec_benchmark,
+              'deferred': deferred_benchmark,
+              'journal': journal_benchmark,
+              'recovery': recovery_benchmark,
+              'replication': replication_benchmark}
+
+def main(args=sys.argv):
+    parser = OptionParser(usage='Usage: benchmark.py [options]')
+    parser.add_option("-b", "--benchmark", action="store", dest="benchmark", help="Benchmark to run (one of: %s)" % ', '.join(sorted(BENCHMARKS.keys())), metavar="NAME", default='schedule')
+    parser.add_option("-w", "--workers", action="store", dest="workers", help="Number of workers", metavar="N", type="int", default=200)
+    parser.add_option("-s", "--slots", action="store", dest="slots", help="Slots per worker", metavar="N", type="int", default=4)
+    parser.add_option("-t", "--tasks", action="store", dest="tasks", help="Number of tasks", metavar="N", type="int", default=20000)
+    parser.add_option("-n", "--reducers", action="store", dest="reducers", help="Number of reduce tasks", metavar="N", type="int", default=50)
+    parser.add_option("-i", "--inputs", action="store", dest="inputs", help="Number of inputs per reduce task", metavar="N", type="int", default=10000)
+    parser.add_option("-I", "--iterations", action="store", dest="iterations", help="Number of iterations for the gc benchmark", metavar="N", type="int", default=10000)
+    parser.add_option("-W", "--width", action="store", dest="width", help="Width of the fan-in and fan-out graphs", metavar="N", type="int", default=50000)
+    parser.add_option("-J", "--jobs", action="store", dest="jobs", help="Number of concurrent jobs for the deferred benchmark", metavar="N", type="int", default=8)
+    parser.add_option("-T", "--threads", action="store", dest="threads", help="Number of deferred work shards to compare against one", metavar="N", type="int", default=4)
+    parser.add_option("-H", "--history", action="store", dest="history", help="Task history mode for the memory benchmark (full, ring:N or counters-only)", metavar="MODE", default='full')
+    (options, _) = parser.parse_args(args=args)
+
+    ciel.set_log_level(logging.WARNING)
+
+    try:
+        benchmark = BENCHMARKS[options.benchmark]
+    except KeyError:
+        parser.error('Unknown benchmark: %s' % options.benchmark)
+    benchmark(options)
+
+if __name__ == '__main__':
+    main()
@@ -295,7 +295,7 @@ def do_uploads(master, args, size=None, count=1, replication=1, delimiter=None,
                             continue
                         elif response.status == 200:
                             print >>sys.stderr, 'Succeded! %s:%d on %s' % (ref.id, index, target)
-                            output_ref_dict[ref.id].location_hints.add(target)
+                            output_ref_dict[ref.id].add_location_hint(target)
                             del pending_uploads[ref, index]
                         else:
                             print >>sys.stderr, 'Failed... %s' % target
@@ -0,0 +1,385 @@
+# Copyright (c) 2011 Derek Murray <derek.murray@cl.cam.ac.uk>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+'''
+Offline simulator for the master. This drives the real JobPool, Job,
+JobTaskGraph and WorkerPool objects against simulated workers, using a
+virtual clock, so that scheduling changes can be evaluated without a
+cluster:
+
+    python -m ciel.runtime.util.simulator -g mapreduce -n 100 -w 20 -p locality
+
+Each simulated task fetches its non-local inputs at the worker's bandwidth,
+runs for its configured duration, and publishes its outputs on the worker
+that ran it. Streaming consumers cannot finish before their producers.
+Deferred work and timers on the master run as events on the same clock, and
+the process CPU time spent in them is charged to the master.
+'''
+from __future__ import with_statement
+from optparse import OptionParser
+from ciel.public.references import SW2_ConcreteReference, SW2_FutureReference,\
+    SW2_StreamReference
+from ciel.runtime.master.job_pool import Job, JobPool, JOB_CREATED,\
+    JOB_COMPLETED, JOB_FAILED
+from ciel.runtime.master.worker_pool import WorkerPool
+from ciel.runtime.task import TaskPoolTask
+from ciel.runtime.task_graph import TaskGraphUpdate
+import ciel
+import ciel.runtime.master.fair_share
+import ciel.runtime.master.job_pool
+import heapq
+import logging
+import random
+import simplejson
+import sys
+import time
+
+class VirtualClock:
+    """Stands in for the time module in the master while a simulation runs."""
+
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+class SimulatedDeferredWorker:
+    """Runs deferred work as events on the simulator's clock."""
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+
+    def do_deferred(self, callable, key=None):
+        self.simulator.schedule_master_event(0.0, callable)
+
+    def do_deferred_after(self, secs, callable, key=None):
+        self.simulator.schedule_master_event(secs, callable)
+
+    def release_key(self, key):
+        pass
+
+class SimulatedWorkerPool(WorkerPool):
+    """Hands dispatched tasks to the simulator instead of posting them to a worker."""
+
+    def __init__(self, simulator, deferred_worker):
+        WorkerPool.__init__(self, ciel.engine, deferred_worker, None)
+        self.simulator = simulator
+
+    def execute_task_on_worker(self, worker, task):
+        self.simulator.start_task(worker, task)
+
+    def execute_tasks_on_worker(self, worker, tasks):
+        for task in tasks:
+            self.simulator.start_task(worker, task)
+
+    def abort_task_on_worker(self, task, worker):
+        self.simulator.abort_task(worker, task)
+
+class SimulatedTask:
+    """The synthetic cost of a task: how long it runs, how large each of its
+    outputs is, and whether its outputs are streamed while it runs."""
+
+    def __init__(self, duration, output_size, streaming=False):
+        self.duration = duration
+        self.output_size = output_size
+        self.streaming = streaming
+
+class Simulator:
+
+    def __init__(self, num_workers=10, slots=4, bandwidth=100000000.0, slow_workers=0, slowdown=4.0, seed=0):
+        self.clock = VirtualClock()
+        self.random = random.Random(seed)
+        # The scheduling policies draw from the global generator.
+        random.seed(seed)
+        self.events = []
+        self.event_seq = 0
+        self.master_cpu = 0.0
+        self.master_events = 0
+
+        self.deferred_worker = SimulatedDeferredWorker(self)
+        self.worker_pool = SimulatedWorkerPool(self, self.deferred_worker)
+        self.job_pool = JobPool(ciel.engine, None, None, None, self.deferred_worker, self.worker_pool)
+        self.worker_pool.job_pool = self.job_pool
+
+        self.bandwidth = bandwidth
+        self.worker_speed = {}
+        self.specs = {}
+        self.producers = {}
+        self.running = {}
+        self.finished_outputs = set()
+        self.waiting_for_streams = {}
+
+        self.tasks_started = 0
+        self.tasks_completed = 0
+        self.local_bytes = 0
+        self.remote_bytes = 0
+
+        for i in range(num_workers):
+            self.worker_pool.create_worker({'netloc': 'sim%d:8001' % i,
+                                            'features': [],
+                                            'scheduling_classes': {'*': slots}})
+        self.netlocs = sorted([w.netloc for w in self.worker_pool.get_all_workers()])
+        for i, netloc in enumerate(self.netlocs):
+            self.worker_speed[netloc] = slowdown if i < slow_workers else 1.0
+
+    def schedule_event(self, delay, callable):
+        heapq.heappush(self.events, (self.clock.now + delay, self.event_seq, False, callable))
+        self.event_seq += 1
+
+    def schedule_master_event(self, delay, callable):
+        heapq.heappush(self.events, (self.clock.now + delay, self.event_seq, True, callable))
+        self.event_seq += 1
+
+    def make_input(self, id, size, replicas=1):
+        """Returns a reference to an input that is already stored on some workers."""
+        return SW2_ConcreteReference(id, size, self.random.sample(self.netlocs, min(replicas, len(self.netlocs))))
+
+    def add_task(self, job, task_id, dependencies, expected_outputs, spec):
+        task = TaskPoolTask(task_id, None, 'sim', {}, dict([(ref.id, ref) for ref in dependencies]), expected_outputs, job=job)
+        self.specs[task_id] = spec
+        return task
+
+    def start_task(self, worker, task):
+        spec = self.specs[task.task_id]
+        start = self.clock.now
+        fetched = {}
+        fetch_time = {}
+        total_fetch_time = 0.0
+        stream_inputs = []
+        for ref in task.inputs.values():
+            if isinstance(ref, SW2_ConcreteReference):
+                size = ref.size_hint if ref.size_hint is not None else 0
+            elif isinstance(ref, SW2_StreamReference):
+                size = self.specs[self.producers[ref.id]].output_size
+                if ref.id not in self.finished_outputs:
+                    stream_inputs.append(ref.id)
+            else:
+                continue
+            if ref.has_location_hint(worker.netloc):
+                self.local_bytes += size
+            else:
+                self.remote_bytes += size
+                source = sorted(ref.location_hints)[0] if len(ref.location_hints) > 0 else worker.netloc
+                secs = size / self.bandwidth
+                fetched[source] = fetched.get(source, 0) + size
+                fetch_time[source] = fetch_time.get(source, 0.0) + secs
+                total_fetch_time += secs
+
+        duration = total_fetch_time + spec.duration * self.worker_speed[worker.netloc]
+        profiling = {'CREATED': start, 'STARTED': start + total_fetch_time, 'FETCHED': fetched, 'FETCH_TIME': fetch_time}
+        run = (worker, task, profiling, stream_inputs)
+        self.running[(worker, task.task_id)] = run
+        self.tasks_started += 1
+        self.schedule_event(duration, lambda: self.task_finished(run))
+
+        if spec.streaming:
+            refs = [SW2_StreamReference(id, [worker.netloc]) for id in task.expected_outputs]
+            self.schedule_master_event(0.0, lambda: self.publish_refs(task, refs))
+
+    def abort_task(self, worker, task):
+        try:
+            del self.running[(worker, task.task_id)]
+        except KeyError:
+            pass
+
+    def task_finished(self, run):
+        worker, task, profiling, stream_inputs = run
+        if self.running.get((worker, task.task_id)) is not run:
+            # The task was aborted.
+            return
+
+        # A streaming consumer cannot finish before its producers.
+        for id in stream_inputs:
+            if id not in self.finished_outputs:
+                try:
+                    self.waiting_for_streams[id].append(run)
+                except KeyError:
+                    self.waiting_for_streams[id] = [run]
+                return
+
+        del self.running[(worker, task.task_id)]
+        self.tasks_completed += 1
+        profiling['FINISHED'] = self.clock.now
+        spec = self.specs[task.task_id]
+        published = [SW2_ConcreteReference(id, spec.output_size, [worker.netloc]) for id in task.expected_outputs]
+        for id in task.expected_outputs:
+            self.finished_outputs.add(id)
+            for waiter in self.waiting_for_streams.pop(id, []):
+                self.schedule_event(0.0, lambda waiter=waiter: self.task_finished(waiter))
+
+        report = [(task.task_id, True, ([], published, profiling))]
+        self.schedule_master_event(0.0, lambda: task.job._report_tasks(report, task, worker))
+
+    def publish_refs(self, task, refs):
+        job = task.job
+        with job._lock:
+            tx = TaskGraphUpdate()
+            for ref in refs:
+                tx.publish(ref, task)
+            tx.commit(job.task_graph)
+        job.schedule()
+
+    def run_job(self, job, other_tasks):
+        """Runs the job, whose root task has already been created, to
+        completion and returns its metrics."""
+        for task in other_tasks + [job.root_task]:
+            for id in task.expected_outputs:
+                self.producers[id] = task.task_id
+
+        for task in other_tasks:
+            job.task_graph.spawn(task)
+        self.job_pool.add_job(job)
+
+        real_time = {}
+        real_time['job_pool'] = ciel.runtime.master.job_pool.time
+        real_time['fair_share'] = ciel.runtime.master.fair_share.time
+        ciel.runtime.master.job_pool.time = self.clock
+        ciel.runtime.master.fair_share.time = self.clock
+        try:
+            start = self.clock.now
+            self.job_pool.queue_job(job)
+            while len(self.events) > 0 and job.state not in (JOB_COMPLETED, JOB_FAILED):
+                at, _, is_master, callable = heapq.heappop(self.events)
+                self.clock.now = max(self.clock.now, at)
+                if is_master:
+                    cpu_start = time.clock()
+                    callable()
+                    self.master_cpu += time.clock() - cpu_start
+                    self.master_events += 1
+                else:
+                    callable()
+            end = self.clock.now
+        finally:
+            ciel.runtime.master.job_pool.time = real_time['job_pool']
+            ciel.runtime.master.fair_share.time = real_time['fair_share']
+
+        if job.state != JOB_COMPLETED:
+            ciel.log('Simulated job %s did not complete' % job.id, 'SIMULATOR', logging.ERROR)
+
+        locality_decisions = job.locality_hits + job.locality_misses
+        total_bytes = self.local_bytes + self.remote_bytes
+        return {'completed' : job.state == JOB_COMPLETED,
+                'makespan' : end - start,
+                'tasks' : self.tasks_completed,
+                'tasks_started' : self.tasks_started,
+                'locality_hit_rate' : job.locality_hits / float(locality_decisions) if locality_decisions > 0 else None,
+                'local_byte_fraction' : self.local_bytes / float(total_bytes) if total_bytes > 0 else None,
+                'remote_bytes' : self.remote_bytes,
+                'master_cpu' : self.master_cpu,
+                'master_cpu_per_task' : self.master_cpu / self.tasks_completed if self.tasks_completed > 0 else None,
+                'scheduling_throughput' : self.tasks_started / self.master_cpu if self.master_cpu > 0 else None,
+                'master_events' : self.master_events}
+
+    def duration(self, mean):
+        # Exponentially-distributed around the mean, with a floor to avoid
+        # degenerate zero-length tasks.
+        return max(mean * 0.1, self.random.expovariate(1.0 / mean)) if mean > 0 else 0.0
+
+def build_fan_out_fan_in(sim, job, options):
+    """A source task whose output is read by each of n tasks, and a sink task
+    that reads all of their outputs."""
+    source = sim.add_task(job, 'source', [], ['source:out'], SimulatedTask(sim.duration(options.duration), options.input_size))
+    middle = []
+    for i in range(options.width):
+        middle.append(sim.add_task(job, 'fan%d' % i, [SW2_FutureReference('source:out')], ['fan%d:out' % i], SimulatedTask(sim.duration(options.duration), options.output_size)))
+    sink = sim.add_task(job, 'sink', [SW2_FutureReference('fan%d:out' % i) for i in range(options.width)], ['sink:out'], SimulatedTask(sim.duration(options.duration), options.output_size))
+    return sink, [source] + middle
+
+def build_mapreduce(sim, job, options):
+    """n map tasks, each reading an input chunk that is already stored in the
+    cluster, and n / 4 reduce tasks that each read one partition from every
+    map task."""
+    num_reducers = max(1, options.width / 4)
+    tasks = []
+    for i in range(options.width):
+        chunk = sim.make_input('chunk%d' % i, options.input_size, options.replicas)
+        tasks.append(sim.add_task(job, 'map%d' % i, [chunk], ['map%d:%d' % (i, j) for j in range(num_reducers)], SimulatedTask(sim.duration(options.duration), options.output_size / num_reducers)))
+    for j in range(num_reducers):
+        tasks.append(sim.add_task(job, 'reduce%d' % j, [SW2_FutureReference('map%d:%d' % (i, j)) for i in range(options.width)], ['reduce%d:out' % j], SimulatedTask(sim.duration(options.duration), options.output_size)))
+    sink = sim.add_task(job, 'sink', [SW2_FutureReference('reduce%d:out' % j) for j in range(num_reducers)], ['sink:out'], SimulatedTask(0.0, 0))
+    return sink, tasks
+
+def build_streaming_chains(sim, job, options):
+    """n / 8 chains of eight tasks, where each task streams its output to the
+    next task in the chain."""
+    num_chains = max(1, options.width / 8)
+    tasks = []
+    heads = []
+    for c in range(num_chains):
+        previous = sim.make_input('chain%d:in' % c, options.input_size, options.replicas)
+        for i in range(8):
+            task_id = 'chain%d:%d' % (c, i)
+            tasks.append(sim.add_task(job, task_id, [previous], ['%s:out' % task_id], SimulatedTask(sim.duration(options.duration), options.output_size, streaming=True)))
+            previous = SW2_FutureReference('%s:out' % task_id)
+        heads.append(previous)
+    sink = sim.add_task(job, 'sink', heads, ['sink:out'], SimulatedTask(0.0, 0))
+    return sink, tasks
+
+GRAPHS = {'fan': build_fan_out_fan_in,
+          'mapreduce': build_mapreduce,
+          'streaming': build_streaming_chains}
+
+def simulate(options, job_options):
+    sim = Simulator(options.workers, options.slots, options.bandwidth, options.slow_workers, options.slowdown, options.seed)
+    job = Job('sim', None, None, JOB_CREATED, sim.job_pool, job_options, journal=False)
+    sink, tasks = GRAPHS[options.graph](sim, job, options)
+    job.root_task = sink
+    return sim.run_job(job, tasks)
+
+def main(args=sys.argv):
+    parser = OptionParser(usage='Usage: simulator.py [options]')
+    parser.add_option("-g", "--graph", action="store", dest="graph", help="Shape of the task graph (one of: %s)" % ', '.join(sorted(GRAPHS.keys())), metavar="NAME", default='mapreduce')
+    parser.add_option("-n", "--width", action="store", dest="width", help="Number of parallel tasks in the graph", metavar="N", type="int", default=100)
+    parser.add_option("-w", "--workers", action="store", dest="workers", help="Number of workers", metavar="N", type="int", default=20)
+    parser.add_option("-s", "--slots", action="store", dest="slots", help="Slots per worker", metavar="N", type="int", default=4)
+    parser.add_option("-d", "--duration", action="store", dest="duration", help="Mean task duration in seconds", metavar="SECS", type="float", default=10.0)
+    parser.add_option("-i", "--input-size", action="store", dest="input_size", help="Size of each input in bytes", metavar="BYTES", type="int", default=64 * 1048576)
+    parser.add_option("-O", "--output-size", action="store", dest="output_size", help="Size of each task output in bytes", metavar="BYTES", type="int", default=16 * 1048576)
+    parser.add_option("-r", "--replicas", action="store", dest="replicas", help="Replicas of each initial input", metavar="N", type="int", default=1)
+    parser.add_option("-B", "--bandwidth", action="store", dest="bandwidth", help="Per-worker fetch bandwidth in bytes per second", metavar="BYTES", type="float", default=100000000.0)
+    parser.add_option("-S", "--slow-workers", action="store", dest="slow_workers", help="Number of workers that run tasks more slowly", metavar="N", type="int", default=0)
+    parser.add_option("-x", "--slowdown", action="store", dest="slowdown", help="Slowdown factor for slow workers", metavar="X", type="float", default=4.0)
+    parser.add_option("-p", "--scheduler", action="store", dest="scheduler", help="Scheduling policy", metavar="NAME", default=None)
+    parser.add_option("-j", "--job-options", action="store", dest="job_options", help="Additional job options as a JSON object", metavar="JSON", default=None)
+    parser.add_option("-e", "--seed", action="store", dest="seed", help="Random seed", metavar="N", type="int", default=0)
+    parser.add_option("-o", "--output", action="store", dest="output", help="Write the metrics as JSON to FILE", metavar="FILE", default=None)
+    (options, _) = parser.parse_args(args=args)
+
+    ciel.set_log_level(logging.WARNING)
+
+    if options.graph not in GRAPHS:
+        parser.error('Unknown graph: %s' % options.graph)
+
+    job_options = {}
+    if options.job_options is not None:
+        job_options.update(simplejson.loads(options.job_options))
+    if options.scheduler is not None:
+        job_options['scheduler'] = options.scheduler
+
+    metrics = simulate(options, job_options)
+
+    for name in sorted(metrics.keys()):
+        print '%-24s %s' % (name, metrics[name])
+
+    if options.output is not None:
+        with open(options.output, 'w') as f:
+            simplejson.dump(metrics, f, indent=4)
+
+    if not metrics['completed']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,7 @@ from ciel.runtime.worker.upload_manager import UploadManager
 from ciel.runtime.master.deferred_work import DeferredWorkPlugin
 import ciel
 from ciel.runtime.worker.master_proxy import MasterProxy
+from ciel.public.wire_codec import get_codec_preferences
 from ciel.runtime.task_executor import TaskExecutorPlugin
 from ciel.runtime.block_store import BlockStore
 from ciel.runtime.worker.worker_view import WorkerRoot
@@ -60,6 +61,7 @@ class Worker(plugins.SimplePlugin):
         self.id = None
         self.port = port
         self.master_url = options.master
+        self.codecs = get_codec_preferences(options.wire_codec)
         self.master_proxy = MasterProxy(self, bus, self.master_url)
         self.master_proxy.subscribe()
         
@@ -126,7 +128,11 @@ class Worker(plugins.SimplePlugin):
         return '%s:%d' % (self.hostname, self.port)
 
     def as_descriptor(self):
-        return {'netloc': self.netloc(), 'features': self.runnable_executors, 'has_blocks': not self.block_store.is_empty(), 'scheduling_classes': self.scheduling_classes}
+        descriptor = {'netloc': self.netloc(), 'features': self.runnable_executors, 'has_blocks': not self.block_store.is_empty(), 'scheduling_classes': self.scheduling_classes, 'codecs': self.codecs, 'task_batches': True}
+        if descriptor['has_blocks']:
+            # The master uses the digest to find blocks for recovered jobs.
+            descriptor['block_digest'] = self.block_store.generate_block_digest().as_descriptor()
+        return descriptor
 
     def set_hostname(self, hostname):
         self.hostname = hostname
@@ -233,6 +239,7 @@ def main(args=sys.argv):
     #parser.add_option("-C", "--scheduling-classes", action="store", dest="scheduling_classes", help="List of semicolon-delimited scheduling classes", metavar="CLASS,N;CLASS,N;...", default=None)
     parser.add_option("-P", "--auxiliary-port", action="store", dest="aux_port", type="int", help="Listen port for auxiliary TCP connections (for workers)", metavar="PORT", default=None)
     parser.add_option("-v", "--verbose", action="callback", callback=lambda w, x, y, z: ciel.set_log_level(logging.DEBUG), help="Turns on debugging output")
+    parser.add_option("-W", "--wire-codec", action="store", dest="wire_codec", help="Preferred codec for messages to and from the master (binary or json)", metavar="CODEC", default="binary")
     parser.add_option("-i", "--pidfile", action="store", dest="pidfile", help="Record the PID of the process", default=None);
     (options, args) = parser.parse_args(args=args)
 
@@ -19,7 +19,8 @@ Created on 15 Apr 2010
 @author: dgm36
 '''
 from urlparse import urljoin
-from ciel.public.references import SWReferenceJSONEncoder
+from ciel.public.wire_codec import CODEC_JSON, negotiate_codec,\
+    encode_message, get_content_type
 from ciel.runtime.exceptions import MasterNotRespondingException,\
     WorkerShutdownException
 import logging
@@ -41,6 +42,8 @@ class MasterProxy:
         self.bus = bus
         self.worker = worker
         self.master_url = master_url
+        # Negotiated when the worker registers with the master.
+        self.codec = CODEC_JSON
         self.stop_event = Event()
 
     def subscribe(self):
@@ -52,6 +55,7 @@ class MasterProxy:
 
     def change_master(self, master_url):
         self.master_url = master_url
+        self.codec = CODEC_JSON
         
     def get_master_details(self):
         return {'netloc': self.master_url, 'id':str(self.worker.id)}
@@ -59,17 +63,17 @@ class MasterProxy:
     def handle_shutdown(self):
         self.stop_event.set()
     
-    def backoff_request(self, url, method, payload=None, need_result=True, callback=None):
+    def backoff_request(self, url, method, payload=None, need_result=True, callback=None, content_type="application/octet-stream"):
         if self.stop_event.is_set():
             return
         try:
             if method == "POST":
                 if need_result:
-                    content = post_string(url, payload)
+                    content = post_string(url, payload, content_type)
                 else:
                     if callback is None:
                         callback = self.master_post_result_callback
-                    post_string_noreturn(url, payload, result_callback=callback)
+                    post_string_noreturn(url, payload, result_callback=callback, content_type=content_type)
                     return
             elif method == "GET":
                 content = get_string(url)
@@ -117,27 +121,34 @@ class MasterProxy:
         message_payload = simplejson.dumps(self.worker.as_descriptor())
         message_url = urljoin(self.master_url, 'control/worker/')
         _, result = self.backoff_request(message_url, 'POST', message_payload)
-        self.worker.id = simplejson.loads(result)
+        result = simplejson.loads(result)
+        if isinstance(result, dict):
+            self.worker.id = result['worker_id']
+            self.codec = negotiate_codec(self.worker.codecs, result['codecs'])
+        else:
+            # Older masters reply with the worker ID, and only accept JSON.
+            self.worker.id = result
+            self.codec = CODEC_JSON
     
     def publish_refs(self, job_id, task_id, refs):
-        message_payload = simplejson.dumps(refs, cls=SWReferenceJSONEncoder)
+        message_payload = encode_message(refs, self.codec)
         message_url = urljoin(self.master_url, 'control/task/%s/%s/publish' % (job_id, task_id))
-        self.backoff_request(message_url, "POST", message_payload, need_result=False)
+        self.backoff_request(message_url, "POST", message_payload, need_result=False, content_type=get_content_type(self.codec))
 
     def log(self, job_id, task_id, timestamp, message):
-        message_payload = simplejson.dumps([timestamp, message], cls=SWReferenceJSONEncoder)
+        message_payload = encode_message([timestamp, message], self.codec)
         message_url = urljoin(self.master_url, 'control/task/%s/%s/log' % (job_id, task_id))
-        self.backoff_request(message_url, "POST", message_payload, need_result=False)
+        self.backoff_request(message_url, "POST", message_payload, need_result=False, content_type=get_content_type(self.codec))
 
     def report_tasks(self, job_id, root_task_id, report):
-        message_payload = simplejson.dumps({'worker' : self.worker.id, 'report' : report}, cls=SWReferenceJSONEncoder)
+        message_payload = encode_message({'worker' : self.worker.id, 'report' : report}, self.codec)
         message_url = urljoin(self.master_url, 'control/task/%s/%s/report' % (job_id, root_task_id))
-        self.backoff_request(message_url, "POST", message_payload, need_result=False)
+        self.backoff_request(message_url, "POST", message_payload, need_result=False, content_type=get_content_type(self.codec))
 
     def failed_task(self, job_id, task_id, reason=None, details=None, bindings={}):
-        message_payload = simplejson.dumps((reason, details, bindings), cls=SWReferenceJSONEncoder)
+        message_payload = encode_message((reason, details, bindings), self.codec)
         message_url = urljoin(self.master_url, 'control/task/%s/%s/failed' % (job_id, task_id))
-        self.backoff_request(message_url, "POST", message_payload, need_result=False)
+        self.backoff_request(message_url, "POST", message_payload, need_result=False, content_type=get_content_type(self.codec))
 
     def get_public_hostname(self):
         message_url = urljoin(self.master_url, "control/gethostname/")
@@ -134,20 +134,29 @@ class MultiWorker:
         with self._lock:
             return self.jobs[job_id]
     
-    def create_and_queue_taskset(self, task_descriptor):
+    def create_and_queue_taskset(self, task_descriptors):
+        """Accepts a single task descriptor, or a list of descriptors from a
+        batched dispatch."""
+        if not isinstance(task_descriptors, list):
+            task_descriptors = [task_descriptors]
+
+        tasksets = []
         with self._lock:
-            job_id = task_descriptor['job']
-            try:
-                job = self.jobs[job_id]
-            except:
-                job = WorkerJob(job_id, self.worker)
-                self.jobs[job_id] = job
-                
-            taskset = MultiWorkerTaskSetExecutionRecord(task_descriptor, self.worker.block_store, self.worker.master_proxy, self.worker.execution_features, self.worker, job, self)
-            job.add_taskset(taskset)
+            for task_descriptor in task_descriptors:
+                job_id = task_descriptor['job']
+                try:
+                    job = self.jobs[job_id]
+                except:
+                    job = WorkerJob(job_id, self.worker)
+                    self.jobs[job_id] = job
+                    
+                taskset = MultiWorkerTaskSetExecutionRecord(task_descriptor, self.worker.block_store, self.worker.master_proxy, self.worker.execution_features, self.worker, job, self)
+                job.add_taskset(taskset)
+                tasksets.append(taskset)
 
         # XXX: Don't want to do this immediately: instead block until the runqueue gets below a certain length.
-        taskset.start()
+        for taskset in tasksets:
+            taskset.start()
 
     def taskset_completed(self, taskset):
         with self._lock:
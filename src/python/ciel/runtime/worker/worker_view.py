@@ -23,13 +23,25 @@ Created on 8 Feb 2010
 from cherrypy.lib.static import serve_file
 from ciel.public.references import json_decode_object_hook,\
     SWReferenceJSONEncoder
+from ciel.public.wire_codec import decode_message, read_framed_message,\
+    get_codec_for_content_type
 from ciel.runtime.remote_stat import receive_stream_advertisment
 from ciel.runtime.producer_stat import subscribe_output, unsubscribe_output
 import sys
 import simplejson
 import cherrypy
+import logging
 import os
 
+def get_request_codec(codecs):
+    """Returns the codec of the current request's body, if the receiver
+    accepts codecs."""
+    try:
+        return get_codec_for_content_type(cherrypy.request.headers.get('Content-Type'), codecs)
+    except ValueError:
+        ciel.log('Rejecting a binary message from %s' % cherrypy.request.remote.ip, 'WIRE_CODEC', logging.WARNING)
+        raise cherrypy.HTTPError(415)
+
 class WorkerRoot:
     
     def __init__(self, worker):
@@ -44,6 +56,7 @@ class ControlRoot:
         self.master = RegisterMasterRoot(worker)
         self.task = TaskRoot(worker)
         self.data = DataRoot(worker.block_store)
+        self.inventory = InventoryRoot(worker.block_store, worker.codecs)
         self.streamstat = StreamStatRoot()
         self.features = FeaturesRoot(worker.execution_features)
         self.kill = KillRoot()
@@ -110,11 +123,32 @@ class TaskRoot:
     def index(self):
         if cherrypy.request.method == 'POST':
             ciel.stopwatch.multi(starts=["worker_task"], laps=["end_to_end"])
-            task_descriptor = simplejson.loads(cherrypy.request.body.read(), object_hook=json_decode_object_hook)
+            task_descriptor = decode_message(cherrypy.request.body.read(), get_request_codec(self.worker.codecs))
             if task_descriptor is not None:
                 self.worker.multiworker.create_and_queue_taskset(task_descriptor)
                 return
         raise cherrypy.HTTPError(405)
+
+    @cherrypy.expose
+    def batch(self):
+        if cherrypy.request.method == 'POST':
+            ciel.stopwatch.multi(starts=["worker_task"], laps=["end_to_end"])
+            codec = get_request_codec(self.worker.codecs)
+            body = cherrypy.request.body
+            task_descriptors = []
+            while True:
+                try:
+                    task_descriptor = read_framed_message(body, codec)
+                except ValueError:
+                    ciel.log('Invalid task batch from %s' % cherrypy.request.remote.ip, 'WORKER', logging.WARNING, True)
+                    raise cherrypy.HTTPError(400)
+                if task_descriptor is None:
+                    # Reached the end of the batch.
+                    break
+                task_descriptors.append(task_descriptor)
+            self.worker.multiworker.create_and_queue_taskset(task_descriptors)
+            return
+        raise cherrypy.HTTPError(405)
     
     # TODO: Add some way of checking up on the status of a running task.
     #       This should grow to include a way of getting the present activity of the task
@@ -165,6 +199,16 @@ class LogRoot:
         else:
             raise cherrypy.HTTPError(405)
 
+def serve_block_file(filename):
+    if cherrypy.request.wsgi_environ.get('SERVER_SOFTWARE', '').startswith('lighttpd'):
+        # Blocks are not under lighttpd's document root in the sharded
+        # layout, but it can still send them.
+        if not os.path.exists(filename):
+            raise cherrypy.HTTPError(404)
+        cherrypy.response.headers['X-Sendfile'] = filename
+        return ''
+    return serve_file(filename)
+
 class DataRoot:
     
     def __init__(self, block_store, backup_sender=None):
@@ -175,13 +219,16 @@ class DataRoot:
     def default(self, id):
         safe_id = id
         if cherrypy.request.method == 'GET':
+            if safe_id.startswith('.producer:'):
+                # Streaming from a block that is still being produced.
+                return serve_block_file(self.block_store.producer_filename(safe_id[10:]))
             filename = self.block_store.filename(safe_id)
             try:
-                response_body = serve_file(filename)
+                response_body = serve_block_file(filename)
                 return response_body
             except cherrypy.HTTPError as he:
                 if he.status == 404:
-                    response_body = serve_file(self.block_store.producer_filename(safe_id))
+                    response_body = serve_block_file(self.block_store.producer_filename(safe_id))
                     return response_body
                 else:
                     raise
@@ -196,7 +243,7 @@ class DataRoot:
             return simplejson.dumps(new_ref, cls=SWReferenceJSONEncoder)
         
         elif cherrypy.request.method == 'HEAD':
-            if os.path.exists(self.block_store.filename(id)):
+            if self.block_store.is_block_local(id):
                 return
             else:
                 raise cherrypy.HTTPError(404)
@@ -223,6 +270,22 @@ class DataRoot:
     # TODO: Also might investigate a way for us to have a spanning tree broadcast
     #       for common files.
     
+class InventoryRoot:
+    
+    def __init__(self, block_store, codecs):
+        self.block_store = block_store
+        self.codecs = codecs
+        
+    @cherrypy.expose
+    def index(self):
+        # The master posts a list of block IDs that it needs, and we return
+        # the ID and size of each one that we have.
+        if cherrypy.request.method == 'POST':
+            ids = decode_message(cherrypy.request.body.read(), get_request_codec(self.codecs))
+            return simplejson.dumps(self.block_store.get_block_sizes(ids))
+        else:
+            raise cherrypy.HTTPError(405)
+    
 class UploadRoot:
     
     def __init__(self, upload_manager):